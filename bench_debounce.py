@@ -0,0 +1,150 @@
+"""
+bench_debounce.py - Debounce / dedup state: legacy dicts vs expiry.ExpiryWindow
+
+Replays a simulated multi-day event (one utterance every --interval seconds
+of simulated time, drawn from --classes x --intents distinct keys) through
+both implementations with an injected clock, and reports time per call, the
+entries each keeps at the end and the memory they hold (tracemalloc).
+
+Legacy is the previous classifier code: _last_sent never evicts, and every
+is_duplicate_result builds str(sorted(...)) + an MD5 key and scans the
+whole _recent_results dict for stale entries.
+
+Usage:
+    python bench_debounce.py [--days 3] [--interval 0.5] [--classes 3000] [--intents 8]
+"""
+
+import argparse
+import hashlib
+import itertools
+import random
+import time
+import tracemalloc
+
+import config
+config.DEBUG = False  # log.py then logs at INFO
+from config import DEBOUNCE_SECONDS, DEDUP_WINDOW_MS, DEBOUNCE_MAX_ENTRIES, DEDUP_MAX_ENTRIES
+from expiry import ExpiryWindow
+
+
+# ===========================
+# Legacy path (unbounded dicts, full-scan cleanup)
+# ===========================
+class Legacy:
+    def __init__(self):
+        self.last_sent = {}
+        self.recent_results = {}
+
+    def should_send(self, canonical_class, intent, now):
+        key = (canonical_class, intent)
+        if now - self.last_sent.get(key, 0) < DEBOUNCE_SECONDS:
+            return False
+        self.last_sent[key] = now
+        return True
+
+    def is_duplicate_result(self, result_classes, intent, now):
+        key = hashlib.md5(str(sorted(result_classes) + [intent]).encode()).hexdigest()
+        now_ms = now * 1000
+        stale = [k for k, ts in self.recent_results.items() if (now_ms - ts) > DEDUP_WINDOW_MS * 2]
+        for k in stale:
+            del self.recent_results[k]
+        if key in self.recent_results and (now_ms - self.recent_results[key]) < DEDUP_WINDOW_MS:
+            return True
+        self.recent_results[key] = now_ms
+        return False
+
+    def sizes(self):
+        return len(self.last_sent), len(self.recent_results)
+
+
+# ===========================
+# Current path (classifier.should_send / is_duplicate_result)
+# ===========================
+class Windowed:
+    def __init__(self):
+        self.debounce = ExpiryWindow(DEBOUNCE_SECONDS, DEBOUNCE_MAX_ENTRIES)
+        self.dedup = ExpiryWindow(DEDUP_WINDOW_MS / 1000, DEDUP_MAX_ENTRIES)
+
+    def should_send(self, canonical_class, intent, now):
+        return not self.debounce.check_and_set((canonical_class, intent), now)
+
+    def is_duplicate_result(self, result_classes, intent, now):
+        return self.dedup.check_and_set((tuple(sorted(result_classes)), intent), now)
+
+    def sizes(self):
+        return len(self.debounce), len(self.dedup)
+
+
+# ===========================
+# Workload
+# ===========================
+def make_workload(days, interval, n_classes, n_intents, seed=7):
+    """[(now, [classes], intent)]: mostly 1 class, sometimes 2-3, popular classes repeat."""
+    rng = random.Random(seed)
+    classes = [f"Class {i}" for i in range(n_classes)]
+    intents = [f"INTENT_{i}" for i in range(n_intents)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(n_classes)))  # Zipf-like
+    steps = int(days * 86400 / interval)
+    start = 1_000_000.0  # a monotonic clock reading well past the first window
+    workload = []
+    for step in range(steps):
+        k = rng.choices((1, 2, 3), (0.8, 0.15, 0.05))[0]
+        workload.append((start + step * interval, rng.choices(classes, cum_weights=cum_weights, k=k), rng.choice(intents)))
+    return workload
+
+
+def replay(impl, workload):
+    sent = suppressed = 0
+    for now, classes, intent in workload:
+        if impl.is_duplicate_result(classes, intent, now):
+            suppressed += 1
+            continue
+        for cls in classes:
+            if impl.should_send(cls, intent, now):
+                sent += 1
+            else:
+                suppressed += 1
+    return sent, suppressed
+
+
+def run(make_impl, workload):
+    """Timed replay, then a second replay under tracemalloc for the memory the state holds."""
+    impl = make_impl()
+    t0 = time.perf_counter()
+    sent, suppressed = replay(impl, workload)
+    elapsed = time.perf_counter() - t0
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    traced = make_impl()
+    replay(traced, workload)
+    held = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return impl, elapsed, held, sent, suppressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--days", type=float, default=3.0, help="simulated event length")
+    parser.add_argument("--interval", type=float, default=0.5, help="simulated seconds between utterances")
+    parser.add_argument("--classes", type=int, default=3000)
+    parser.add_argument("--intents", type=int, default=8)
+    args = parser.parse_args()
+
+    workload = make_workload(args.days, args.interval, args.classes, args.intents)
+    print(f"{len(workload):,} utterances over {args.days:g} simulated days, "
+          f"{args.classes * args.intents:,} distinct class/intent keys")
+    print(f"{'':<10} {'us/call':>9} {'sent':>9} {'suppressed':>11} {'debounce':>9} {'dedup':>7} {'held KiB':>9}")
+    results = {}
+    for name, make_impl in (("legacy", Legacy), ("windowed", Windowed)):
+        impl, elapsed, held, sent, suppressed = run(make_impl, workload)
+        debounce_n, dedup_n = impl.sizes()
+        results[name] = (sent, suppressed)
+        print(f"{name:<10} {elapsed / len(workload) * 1e6:>9.2f} {sent:>9,} {suppressed:>11,} "
+              f"{debounce_n:>9,} {dedup_n:>7,} {held / 1024:>9.0f}")
+    if results["legacy"] != results["windowed"]:
+        print("WARNING: the implementations made different send / suppress decisions")
+
+
+if __name__ == "__main__":
+    main()
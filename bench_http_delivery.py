@@ -0,0 +1,171 @@
+"""
+bench_http_delivery.py - HTTP delivery throughput: per-call requests.post vs queue_sender
+
+Starts a local stub of the notification backend (POST /notify, and
+POST /notify/batch taking {"messages": [...]}, gzip or plain) and pushes
+the same messages through:
+
+  legacy          requests.post per message (new connection every time)
+  session         queue_sender.send_now, one pooled keep-alive connection
+  session xN      queue_sender.send_now from N threads (HTTP_MAX_CONCURRENCY)
+  batched         queue_sender.send_batch, OUTBOX_BATCH_SIZE messages per POST
+
+Localhost has no real handshake cost, so the stub sleeps --connect-ms when a
+new connection is accepted (a TLS handshake to a hosted backend is typically
+50-200 ms) and --request-ms per request. Pass --no-batch to make the batch
+endpoint answer 404 and check the per-message fallback.
+
+Usage:
+    python bench_http_delivery.py [--messages 200] [--connect-ms 80] [--request-ms 10] [--concurrency 4]
+"""
+
+import argparse
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import config
+config.DEBUG = False  # log.py then logs at INFO
+import queue_sender as qs
+
+PAYLOAD = {
+    "class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+    "transcription": "Super Pro to the lanes, super pro to the lanes",
+    "message_text": "Super Pro to the lanes", "timestamp": "2026-06-01T12:00:00Z",
+}
+
+# ===========================
+# Stub backend
+# ===========================
+_stats = {"connections": 0, "requests": 0, "messages": 0, "bytes": 0}
+_stats_lock = threading.Lock()
+_latency = {"connect_ms": 80, "request_ms": 10}
+_batch_enabled = True
+
+
+class StubNotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with _stats_lock:
+            _stats["connections"] += 1
+        time.sleep(_latency["connect_ms"] / 1000)  # stands in for the TCP + TLS handshake
+
+    def _reply(self, status: int):
+        body = b'{"ok": true}' if status == 200 else b'{"error": "not found"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers["Content-Length"]))
+        body = gzip.decompress(raw) if self.headers.get("Content-Encoding") == "gzip" else raw
+
+        if self.path == "/notify":
+            count = 1
+            json.loads(body)
+        elif self.path == "/notify/batch" and _batch_enabled:
+            count = len(json.loads(body)["messages"])
+        else:
+            return self._reply(404)
+
+        time.sleep(_latency["request_ms"] / 1000)
+        with _stats_lock:
+            _stats["requests"] += 1
+            _stats["messages"] += count
+            _stats["bytes"] += len(raw)
+        self._reply(200)
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNotifyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ===========================
+# Benchmark
+# ===========================
+def legacy_send(payload):
+    """The previous send_now: no session, so a new connection per call."""
+    r = requests.post(qs.PUSH_ENDPOINT, json=payload, timeout=3.0)
+    r.raise_for_status()
+
+
+def run_case(name, fn, n):
+    with _stats_lock:
+        _stats.update(connections=0, requests=0, messages=0, bytes=0)
+    qs.close_session()  # every case starts without pooled connections
+
+    t0 = time.perf_counter()
+    fn(n)
+    elapsed = time.perf_counter() - t0
+
+    assert _stats["messages"] == n, (name, _stats)
+    print(f"{name:<16} {n / elapsed:>9.1f} {_stats['requests']:>9} {_stats['connections']:>6} "
+          f"{_stats['bytes'] / 1024:>9.1f}")
+
+
+def main():
+    global _batch_enabled
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--connect-ms", type=int, default=80, help="simulated handshake per new connection")
+    parser.add_argument("--request-ms", type=int, default=10, help="stub processing time per request")
+    parser.add_argument("--concurrency", type=int, default=config.HTTP_MAX_CONCURRENCY)
+    parser.add_argument("--no-batch", action="store_true", help="batch endpoint answers 404")
+    args = parser.parse_args()
+    _latency.update(connect_ms=args.connect_ms, request_ms=args.request_ms)
+    _batch_enabled = not args.no_batch
+
+    server = start_stub_server()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    qs.PUSH_ENDPOINT = f"{base}/notify"
+    qs.PUSH_BATCH_ENDPOINT = f"{base}/notify/batch"
+    qs.HTTP_MAX_CONCURRENCY = args.concurrency
+
+    def legacy(n):
+        for _ in range(n):
+            legacy_send(PAYLOAD)
+
+    def session(n):
+        for _ in range(n):
+            qs.send_now(PAYLOAD)
+
+    def session_concurrent(n):
+        with ThreadPoolExecutor(max_workers=args.concurrency * 2) as pool:
+            for f in [pool.submit(qs.send_now, PAYLOAD) for _ in range(n)]:
+                f.result()
+
+    def batched(n):
+        qs._batch_supported = True
+        for start in range(0, n, config.OUTBOX_BATCH_SIZE):
+            sent, error = qs.send_batch([PAYLOAD] * min(config.OUTBOX_BATCH_SIZE, n - start))
+            assert error is None, error
+
+    print(f"{args.messages} messages, {args.connect_ms} ms per new connection, "
+          f"{args.request_ms} ms per request, batches of {config.OUTBOX_BATCH_SIZE}"
+          + (" (batch endpoint disabled)" if args.no_batch else ""))
+    print(f"{'mode':<16} {'msgs/s':>9} {'requests':>9} {'conns':>6} {'KiB sent':>9}")
+    run_case("legacy", legacy, args.messages)
+    run_case("session", session, args.messages)
+    run_case(f"session x{args.concurrency}", session_concurrent, args.messages)
+    run_case("batched", batched, args.messages)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+bench_outbox.py - Enqueue / drain / ack rates: legacy outbox vs outbox.Outbox
+
+Legacy is the previous sender code path: a new sqlite3 connection per
+call, rollback journal, a commit per row and no index on `sent`.
+
+Run it on the same storage as production (e.g. the Pi's SD card) with
+--dir, since the difference is mostly fsyncs:
+    python bench_outbox.py [--rows 20000] [--backlog 50000] [--dir /path/on/sdcard]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import config
+config.DEBUG = False  # log.py then logs at INFO
+import outbox as outbox_mod
+from outbox import Outbox
+
+PAYLOAD = {
+    "class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+    "transcription": "Super Pro to the lanes, super pro to the lanes",
+    "message_text": "Super Pro to the lanes", "timestamp": "2026-06-01T12:00:00Z",
+    "event_id": "sonoma-nationals-2026",
+}
+BATCH = 50
+
+
+def payloads(n):
+    """n distinct messages: identical class + intent would supersede each other in Outbox."""
+    return [dict(PAYLOAD, class_name=f"Class {i}") for i in range(n)]
+
+
+# ===========================
+# Legacy path (per-call connections)
+# ===========================
+def legacy_init(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT,
+        created_at REAL,
+        sent INTEGER DEFAULT 0)""")
+    conn.commit(); conn.close()
+
+
+def legacy_put(path, payload):
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO outbox (payload, created_at, sent) VALUES (?, ?, 0)",
+                 (json.dumps(payload), time.time()))
+    conn.commit(); conn.close()
+
+
+def legacy_drain_batch(path, limit):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT id, payload FROM outbox WHERE sent=0 LIMIT ?", (limit,)).fetchall()
+    for id_, payload_text in rows:
+        json.loads(payload_text)
+        conn.execute("UPDATE outbox SET sent=1 WHERE id=?", (id_,))
+        conn.commit()
+    conn.close()
+    return len(rows)
+
+
+# ===========================
+# Benchmark
+# ===========================
+def rate(n, seconds):
+    return f"{n / seconds:>10,.0f}/s"
+
+
+def backfill(path, n, sent):
+    """Bulk-load n rows (already sent or not) to simulate an old, large outbox."""
+    conn = sqlite3.connect(path)
+    text = json.dumps(PAYLOAD)
+    conn.executemany("INSERT INTO outbox (payload, created_at, sent) VALUES (?, ?, ?)",
+                     ((text, time.time(), sent) for _ in range(n)))
+    conn.commit(); conn.close()
+
+
+def bench_legacy(path, rows, backlog):
+    legacy_init(path)
+    backfill(path, backlog, 1)
+
+    t0 = time.perf_counter()
+    for payload in payloads(rows):
+        legacy_put(path, payload)
+    enqueue = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    drained = 0
+    while True:
+        n = legacy_drain_batch(path, BATCH)
+        if not n:
+            break
+        drained += n
+    drain = time.perf_counter() - t0
+    return enqueue, drain, drained
+
+
+def bench_outbox(path, rows, backlog, batched):
+    Outbox(path).close()  # create schema
+    backfill(path, backlog, 1)
+    box = Outbox(path)
+    messages = payloads(rows)
+
+    t0 = time.perf_counter()
+    if batched:
+        for start in range(0, rows, BATCH):
+            box.put_many(messages[start:start + BATCH])
+    else:
+        for payload in messages:
+            box.put(payload)
+    enqueue = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    drained = 0
+    while True:
+        batch = box.pending(BATCH)
+        if not batch:
+            break
+        box.ack([id_ for id_, _ in batch])
+        drained += len(batch)
+    drain = time.perf_counter() - t0
+    box.close()
+    return enqueue, drain, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=20000, help="messages enqueued then drained")
+    parser.add_argument("--backlog", type=int, default=50000, help="already-sent rows in the table")
+    parser.add_argument("--dir", default=None, help="directory for the test databases")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        print(f"{args.rows:,} rows enqueued + drained in batches of {BATCH}, "
+              f"{args.backlog:,} sent rows already in the table, in {tmp}")
+        print(f"{'mode':<22} {'enqueue':>12} {'drain+ack':>12}")
+
+        cases = [
+            ("legacy", lambda p: bench_legacy(p, args.rows, args.backlog)),
+            ("Outbox.put", lambda p: bench_outbox(p, args.rows, args.backlog, False)),
+            (f"Outbox.put_many({BATCH})", lambda p: bench_outbox(p, args.rows, args.backlog, True)),
+        ]
+        for name, fn in cases:
+            path = os.path.join(tmp, f"{name.split('(')[0].replace('.', '_')}.db")
+            enqueue, drain, drained = fn(path)
+            assert drained == args.rows, (name, drained)
+            print(f"{name:<22} {rate(args.rows, enqueue)} {rate(drained, drain)}")
+
+
+if __name__ == "__main__":
+    main()
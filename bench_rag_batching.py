@@ -0,0 +1,281 @@
+"""
+bench_rag_batching.py - Throughput vs latency of RAG micro-batching
+
+Starts a local mock of the OpenAI embeddings / chat completions API, points
+the RAG classifier at it (OPENAI_BASE_URL) and replays bursts of concurrent
+transcripts with batching off and at several batch windows.
+
+The mock charges a fixed latency per request plus a small cost per
+transcript, roughly how a hosted model behaves for short prompts, so it
+shows the trade-off: batching adds up to one window of queueing delay but
+needs far fewer requests, which matters once the API is the bottleneck
+(--max-concurrent limits how many chat requests the mock serves at once,
+like a provider rate limit). "first ms" is the mean time from sending a
+chat request to the first streamed result (rag_classifier.get_latency_stats),
+"batch" the mean number of transcripts per batched request.
+
+The "pipeline" rows send the same bursts through main.on_transcript with
+every detected class escalated, so they show the batch sizes the production
+path produces (classification in the loop's executor, then classifier's
+LLM workers), not just those of callers on their own threads.
+
+Usage:
+    python bench_rag_batching.py [--bursts 10] [--burst-size 6] [--chat-ms 400] [--max-concurrent 2]
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# ===========================
+# Mock OpenAI server
+# ===========================
+EMBED_DIM = 64
+_stats = {"embeddings": 0, "chat": 0}
+_stats_lock = threading.Lock()
+_latency = {"embed_ms": 60, "chat_ms": 400, "per_item_ms": 25}
+_chat_slots = threading.BoundedSemaphore(64)  # concurrent chat requests the mock serves
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if self.path.endswith("/embeddings"):
+            inputs = req["input"] if isinstance(req["input"], list) else [req["input"]]
+            with _stats_lock:
+                _stats["embeddings"] += 1
+            time.sleep((_latency["embed_ms"] + 2 * len(inputs)) / 1000)
+            data = []
+            for i, text in enumerate(inputs):
+                seed = sum(map(ord, text)) or 1
+                vec = [((seed * (k + 1)) % 97) / 97 for k in range(EMBED_DIM)]
+                data.append({"object": "embedding", "index": i, "embedding": vec})
+            return self._reply({"object": "list", "data": data, "model": req["model"],
+                                "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+        if self.path.endswith("/chat/completions"):
+            user = req["messages"][-1]["content"]
+            n = len(re.findall(r"^=== TRANSCRIPT \d+ ===$", user, re.M))
+            with _stats_lock:
+                _stats["chat"] += 1
+            if n:
+                results = [{"utterance": i, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+                            "message_text": "Super Pro to the lanes"} for i in range(1, n + 1)]
+            else:
+                results = [{"class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+                            "message_text": "Super Pro to the lanes"}]
+            if req.get("stream"):
+                with _chat_slots:
+                    return self._stream(req, results)
+            with _chat_slots:
+                time.sleep((_latency["chat_ms"] + _latency["per_item_ms"] * len(results)) / 1000)
+            return self._reply({
+                "id": "mock", "object": "chat.completion", "created": int(time.time()),
+                "model": req["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant",
+                                         "content": json.dumps({"results": results})}}],
+                "usage": {"prompt_tokens": len(user) // 4, "completion_tokens": 20 * len(results),
+                          "total_tokens": len(user) // 4 + 20 * len(results)},
+            })
+
+        self.send_error(404)
+
+    def _stream(self, req: dict, results: list):
+        """Server-sent events: first token after chat_ms, then one result per per_item_ms."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def event(choices, usage=None):
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": req["model"], "choices": choices, "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        def content(piece):
+            event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+
+        time.sleep(_latency["chat_ms"] / 1000)
+        content('{"results":[')
+        for i, res in enumerate(results):
+            time.sleep(_latency["per_item_ms"] / 1000)
+            content(("," if i else "") + json.dumps(res))
+        content("]}")
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        event([], {"prompt_tokens": 0, "completion_tokens": 20 * len(results),
+                   "total_tokens": 20 * len(results)})
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_mock_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ===========================
+# Benchmark
+# ===========================
+TRANSCRIPTS = [
+    "Super Pro to the lanes, super pro",
+    "Pro stock on standby please",
+    "Super street and stock, make your way down",
+    "Junior dragsters listen for the call",
+    "Top sportsman head to the staging lanes",
+    "Super gas you are on deck",
+    "Bracket one to the lanes",
+    "Super comp be ready",
+]
+
+
+def reset_stats(rc):
+    with _stats_lock:
+        _stats.update(embeddings=0, chat=0)
+    with rc._latency_lock:
+        rc._latency_stats.update(requests=0, with_results=0, first_result_total=0.0,
+                                 first_result_max=0.0, complete_total=0.0)
+
+
+def batch_size(rc) -> str:
+    batcher = rc._batcher
+    if batcher is None or not batcher.batches:
+        return "1.0"
+    return f"{batcher.items / batcher.batches:.1f}"
+
+
+def run_case(rc, batched, window_ms, bursts, burst_size, gap_s):
+    rc.RAG_BATCH_ENABLED = batched
+    rc.RAG_BATCH_WINDOW_MS = window_ms
+    rc._batcher = None  # pick up the new window
+    reset_stats(rc)
+
+    latencies = []
+    lat_lock = threading.Lock()
+
+    def one(text):
+        t0 = time.perf_counter()
+        rc.classify_with_rag(text, "ts", candidate_classes=["Super Pro"], debounce=False,
+                             raise_errors=True)
+        with lat_lock:
+            latencies.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=burst_size * 2) as pool:
+        futures = []
+        for b in range(bursts):
+            for i in range(burst_size):
+                futures.append(pool.submit(one, TRANSCRIPTS[(b + i) % len(TRANSCRIPTS)]))
+            time.sleep(gap_s)
+        for f in futures:
+            f.result()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    n = len(latencies)
+    first = rc.get_latency_stats()["first_result_avg"]
+    label = f"batched {window_ms:>4} ms" if batched else "unbatched"
+    print(f"{label:<16} {n / elapsed:>8.1f} {statistics.median(latencies) * 1000:>8.0f} "
+          f"{latencies[int(n * 0.95) - 1] * 1000:>8.0f} {first * 1000:>9.0f} "
+          f"{_stats['embeddings']:>6} {_stats['chat']:>6} {batch_size(rc):>6}")
+
+
+def run_pipeline_case(rc, window_ms, bursts, burst_size, gap_s):
+    """The same bursts through main.on_transcript; reports requests and mean batch size."""
+    import asyncio
+    import classifier
+    import main as app
+
+    rc.RAG_BATCH_ENABLED = True
+    rc.RAG_BATCH_WINDOW_MS = window_ms
+    rc._batcher = None
+    reset_stats(rc)
+    classifier.LOCAL_ACCEPT_CONFIDENCE = 1.01  # escalate every transcript with a detected class
+
+    class Drainer:
+        async def deliver(self, messages):
+            pass
+
+    async def run():
+        app.drainer = Drainer()
+        app.classifier_ready = asyncio.get_running_loop().create_future()
+        app.classifier_ready.set_result(classifier.build_messages)
+        for b in range(bursts):
+            for i in range(burst_size):
+                await app.on_transcript(TRANSCRIPTS[(b + i) % len(TRANSCRIPTS)], "ts")
+            await asyncio.sleep(gap_s)
+        await asyncio.gather(*app._pending)
+
+    asyncio.run(run())
+    # Calls that missed LLM_DEADLINE_SECONDS are still being classified
+    time.sleep(2 * (_latency["chat_ms"] + _latency["embed_ms"]) / 1000)
+    print(f"{f'pipeline {window_ms:>3} ms':<16} {'':>8} {'':>8} {'':>8} {'':>9} "
+          f"{_stats['embeddings']:>6} {_stats['chat']:>6} {batch_size(rc):>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--burst-size", type=int, default=6, help="transcripts arriving together")
+    parser.add_argument("--gap", type=float, default=0.5, help="seconds between bursts")
+    parser.add_argument("--chat-ms", type=int, default=400, help="mock chat latency per request")
+    parser.add_argument("--max-concurrent", type=int, default=0,
+                        help="chat requests the mock serves at once (0 = unlimited)")
+    args = parser.parse_args()
+    global _chat_slots
+    _latency["chat_ms"] = args.chat_ms
+    if args.max_concurrent:
+        _chat_slots = threading.BoundedSemaphore(args.max_concurrent)
+
+    server = start_mock_server()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+    import config
+    config.DEBUG = False  # log.py then logs at INFO
+    import rag_classifier as rc
+    import classifier
+
+    # Mock embeddings and the bench's class index stay out of the real caches
+    rc.RAG_EMBEDDING_CACHE_PATH = None
+    classifier.CLASS_INDEX_PATH = Path(tempfile.mkdtemp()) / "class_index.pkl"
+    rc.initialize_knowledge_base()
+    if not rc._kb_initialized:
+        raise SystemExit("knowledge base failed to initialize against the mock server")
+
+    print(f"{args.bursts} bursts x {args.burst_size} transcripts, {args.gap}s apart, "
+          f"mock chat {args.chat_ms} ms + {_latency['per_item_ms']} ms/transcript, "
+          f"max concurrent chat {args.max_concurrent or 'unlimited'}")
+    print(f"{'mode':<16} {'tput/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'first ms':>9} "
+          f"{'embed':>6} {'chat':>6} {'batch':>6}")
+    run_case(rc, False, 0, args.bursts, args.burst_size, args.gap)
+    for window_ms in (25, 75, 150):
+        run_case(rc, True, window_ms, args.bursts, args.burst_size, args.gap)
+    for window_ms in (25, 150):
+        run_pipeline_case(rc, window_ms, args.bursts, args.burst_size, args.gap)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
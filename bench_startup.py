@@ -0,0 +1,127 @@
+"""
+bench_startup.py - Import cost of the pipeline modules, from python -X importtime
+
+Each module is imported in a fresh interpreter (--runs times, median taken)
+so nothing is cached between measurements. For `main` it also lists the
+heaviest imports in its tree and checks that the modules main is meant to defer
+(boto3, sounddevice, the classifier / RAG stack) are not in its import tree:
+those load in main's warm-up executor or on first use instead.
+
+With --warm-up, also times classifier.warm_up() (alias map, RAG knowledge
+base embeddings, Bedrock client), which needs the same credentials and
+network access as production.
+
+Run it on the Pi itself; import times there are several times those of a
+desktop and are most of the time from reboot to the first lanes call:
+    python bench_startup.py [--runs 5] [--top 15] [--warm-up]
+"""
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+MODULES = ["config", "outbox", "mqtt_sender", "queue_sender", "classifier",
+           "transcribe_ws", "rag_classifier", "main"]
+DEFERRED = ["boto3", "sounddevice", "classifier", "rag_classifier", "openai",
+            "transcribe_ws", "aiohttp", "jellyfish", "rapidfuzz"]
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+WARM_UP_SNIPPET = """
+import json, time
+t0 = time.perf_counter()
+import classifier
+t1 = time.perf_counter()
+classifier.warm_up()
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "warm_up": t2 - t1}))
+"""
+
+
+# ===========================
+# Measurement
+# ===========================
+def importtime(module):
+    """
+    Import module in a fresh interpreter; returns [(depth, name, self_us,
+    cumulative_us)] in import order, or raises RuntimeError if it fails.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            entries.append((len(m.group(3)) // 2, m.group(4), int(m.group(1)), int(m.group(2))))
+    return entries
+
+
+def measure(module, runs):
+    """Median cumulative import time (ms) of module, plus the last run's entries."""
+    totals, entries = [], []
+    for _ in range(runs):
+        entries = importtime(module)
+        totals.append(next(cum for depth, name, _, cum in entries
+                           if depth == 0 and name == module))
+    return statistics.median(totals) / 1000, entries
+
+
+# ===========================
+# Benchmark
+# ===========================
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument("--top", type=int, default=15, help="heaviest imports listed for main")
+    parser.add_argument("--warm-up", action="store_true", help="also time classifier.warm_up()")
+    args = parser.parse_args()
+
+    print(f"median cumulative import time over {args.runs} runs")
+    print(f"{'module':<16} {'ms':>8}")
+    main_entries = None
+    for module in MODULES:
+        try:
+            ms, entries = measure(module, args.runs)
+        except RuntimeError as e:
+            print(f"{module:<16} {'failed':>8}  ({e})")
+            continue
+        print(f"{module:<16} {ms:>8.1f}")
+        if module == "main":
+            main_entries = entries
+
+    if main_entries is not None:
+        # importtime lists a module's imports before it: main's tree is the
+        # block between the previous top-level line and main's own
+        end = max(i for i, e in enumerate(main_entries) if e[0] == 0 and e[1] == "main")
+        start = end
+        while start > 0 and main_entries[start - 1][0] > 0:
+            start -= 1
+        top = sorted(main_entries[start:end], key=lambda e: -e[3])[:args.top]
+        print(f"\nheaviest imports under main (cumulative ms, nested ones included)")
+        for _, name, _, cum in top:
+            print(f"  {name:<28} {cum / 1000:>8.1f}")
+
+        loaded = {name for _, name, _, _ in main_entries}
+        eager = [m for m in DEFERRED if m in loaded]
+        print(f"\ndeferred past `import main`: {', '.join(m for m in DEFERRED if m not in loaded)}")
+        if eager:
+            print(f"WARNING: imported eagerly by main: {', '.join(eager)}")
+
+    if args.warm_up:
+        proc = subprocess.run([sys.executable, "-c", WARM_UP_SNIPPET],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"\nwarm-up failed: {proc.stderr.strip().splitlines()[-1]}")
+        else:
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"\nimport classifier      {result['import'] * 1000:>8.1f} ms")
+            print(f"classifier.warm_up()   {result['warm_up'] * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
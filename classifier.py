@@ -1,15 +1,39 @@
+import gc
+import os
 import re
+import sys
 import time
+import pickle
 import hashlib
 import threading
 import json
-import boto3
+import logging
+import contextvars
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import jellyfish
 from rapidfuzz import fuzz, process
 from config import (
-    INTENT_PATTERNS, DEBOUNCE_SECONDS, DEDUP_WINDOW_MS, get_classmap, DEBUG,
-    USE_LLM_FRAMING, BEDROCK_MODEL_ID, AWS_REGION, USE_RAG_CLASSIFIER
+    INTENT_PATTERNS, DEBOUNCE_SECONDS, DEDUP_WINDOW_MS, DEBOUNCE_MAX_ENTRIES, DEDUP_MAX_ENTRIES,
+    get_classmap, CLASS_INDEX_PATH,
+    get_classmap_version, USE_LLM_FRAMING, BEDROCK_MODEL_ID, BEDROCK_PROMPT_CACHING,
+    AWS_REGION, USE_RAG_CLASSIFIER,
+    LLM_CANDIDATE_TOP_N, LLM_CANDIDATE_MIN_SCORE,
+    LOCAL_ACCEPT_CONFIDENCE, LOCAL_ESCALATE_MIN_SCORE,
+    LLM_DEADLINE_SECONDS, SPECULATIVE_EMIT_CONFIDENCE, LLM_MAX_WORKERS,
+    LLM_REQUEST_TIMEOUT, BREAKER_WINDOW_SECONDS, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATIO,
+    BREAKER_SLOW_CALL_SECONDS, BREAKER_OPEN_SECONDS
 )
+from track_scope import get_candidate_classes
+from prompt_utils import count_tokens, get_scoped_prompt
+from tracing import span
+from metrics import inc, register_collector
+from log import get_logger
+from expiry import ExpiryWindow
+
+log = get_logger("classifier")
+breaker_log = get_logger("breaker")
 
 # ===========================
 # Thread-safe alias mapping
@@ -17,7 +41,12 @@ from config import (
 _alias_to_canonical = {}
 _alias_choices = []
 _canonical_names = []          # flat list of all canonical class names
+_class_ids = {}                # canonical name → class id (debounce / dedup keys)
 _phonetic_index = {}           # metaphone → canonical name(s)
+_scoped_alias_cache = {}       # frozenset(candidates) → (sorted aliases, alias choices)
+_intent_choices = {}           # intent → lowercased patterns
+_alias_map_ready = False       # built on first use or by warm_up(), not at import
+_alias_map_key = None          # _class_index_key() of the inputs the indexes were built from
 _alias_lock = threading.RLock()
 
 
@@ -28,12 +57,19 @@ def rebuild_alias_map():
     Also rebuilds the phonetic index for Metaphone-based matching.
     """
     global _alias_to_canonical, _alias_choices, _canonical_names, _phonetic_index
+    global _intent_choices, _alias_map_ready, _alias_map_key, _class_ids
 
+    key = _class_index_key()
     classmap = get_classmap()
 
     with _alias_lock:
+        _alias_map_ready = True
+        _alias_map_key = key
+        _intent_choices = {intent: [p.lower() for p in patterns]
+                           for intent, patterns in INTENT_PATTERNS.items()}
         _alias_to_canonical.clear()
         _phonetic_index.clear()
+        _scoped_alias_cache.clear()
 
         # Map canonical name to itself (lowercase)
         for canon in classmap.keys():
@@ -47,6 +83,7 @@ def rebuild_alias_map():
 
         _alias_choices = list(_alias_to_canonical.keys())
         _canonical_names = list(classmap.keys())
+        _class_ids = _index_class_ids(classmap)
 
         # Build phonetic index — map Metaphone code to canonical names
         for alias_lower, canon in _alias_to_canonical.items():
@@ -58,9 +95,210 @@ def rebuild_alias_map():
             except Exception:
                 pass  # skip unparseable aliases (e.g. purely numeric)
 
-    if DEBUG:
-        print(f"[classifier] rebuilt alias map: {len(_alias_to_canonical)} entries, "
-              f"{len(_phonetic_index)} phonetic codes")
+    log.debug("rebuilt alias map: %s entries, %s phonetic codes",
+              len(_alias_to_canonical), len(_phonetic_index))
+
+
+def _ensure_alias_map():
+    """
+    Build the alias map if nothing has yet (startup defers it to warm_up()):
+    from the precompiled CLASS_INDEX_PATH artifact when it matches the
+    current class map, else from scratch, refreshing the artifact.
+    """
+    if not _alias_map_ready:
+        with _alias_lock:
+            if not _alias_map_ready and not load_class_index():
+                rebuild_alias_map()
+                try:
+                    save_class_index()
+                except OSError as e:
+                    log.warning("could not write %s: %s", CLASS_INDEX_PATH, e)
+
+
+# ===========================
+# Precompiled index artifact
+# ===========================
+# compile_class_index.py (or the first boot after a class map change) pickles
+# the built indexes next to class_config.json; later boots load them in one
+# read instead of re-encoding every alias. The artifact is trusted local
+# state like class_config.json itself, never something received remotely.
+_CLASS_INDEX_FORMAT = 1   # bump when the pickled layout changes
+
+
+def _class_index_key():
+    """Identity of an index's inputs: class map content hash + intent patterns."""
+    intents = json.dumps(INTENT_PATTERNS, sort_keys=True).encode("utf-8")
+    return f"{get_classmap_version()}:{hashlib.sha1(intents).hexdigest()[:12]}"
+
+
+def save_class_index(path: Path = None) -> Path:
+    """Write the current indexes to path (default CLASS_INDEX_PATH), atomically."""
+    path = CLASS_INDEX_PATH if path is None else Path(path)
+    _ensure_alias_map()
+    with _alias_lock:
+        artifact = {
+            "format": _CLASS_INDEX_FORMAT,
+            "key": _alias_map_key,
+            "alias_to_canonical": _alias_to_canonical,
+            "sorted_aliases": _alias_subset(None)[0],
+            "phonetic_index": _phonetic_index,
+            "intent_choices": _intent_choices,
+        }
+        data = pickle.dumps(artifact, protocol=pickle.HIGHEST_PROTOCOL)
+
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    log.debug("wrote class index %s (%s bytes, key %s)", path, len(data), artifact['key'])
+    return path
+
+
+def load_class_index(path: Path = None) -> bool:
+    """
+    Install the indexes from path (default CLASS_INDEX_PATH) if the artifact
+    was built from the current class map and intent patterns. Returns False
+    if it is missing, unreadable or stale.
+    """
+    global _alias_to_canonical, _alias_choices, _canonical_names, _phonetic_index
+    global _intent_choices, _alias_map_ready, _alias_map_key, _class_ids
+
+    path = CLASS_INDEX_PATH if path is None else Path(path)
+    # Tens of thousands of small containers: cyclic GC passes mid-load
+    # would cost about a third of the load time for nothing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with path.open("rb") as f:
+            artifact = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        log.warning("ignoring unreadable class index %s: %s", path, e)
+        return False
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    key = _class_index_key()
+    if artifact.get("format") != _CLASS_INDEX_FORMAT or artifact.get("key") != key:
+        log.debug("class index %s is stale, rebuilding", path)
+        return False
+
+    with _alias_lock:
+        _alias_to_canonical = artifact["alias_to_canonical"]
+        _phonetic_index = artifact["phonetic_index"]
+        _intent_choices = artifact["intent_choices"]
+        _alias_choices = list(_alias_to_canonical.keys())
+        classmap = get_classmap()
+        _canonical_names = list(classmap.keys())
+        _class_ids = _index_class_ids(classmap)
+        _scoped_alias_cache.clear()
+        _scoped_alias_cache[None] = (artifact["sorted_aliases"], _alias_choices)
+        _alias_map_key = key
+        _alias_map_ready = True
+
+    log.debug("loaded class index %s: %s entries, %s phonetic codes",
+              path, len(_alias_to_canonical), len(_phonetic_index))
+    return True
+
+
+def _class_alias_keys(canon, entry) -> set:
+    """Lowercased name + aliases a class map entry contributes to the alias map (none if absent)."""
+    if entry is None:
+        return set()
+    return {canon.lower()} | {alias.lower() for alias in entry.get("aliases", [])}
+
+
+def _metaphones(keys) -> set:
+    codes = set()
+    for key in keys:
+        try:
+            codes.add(jellyfish.metaphone(key))
+        except Exception:
+            pass  # skip unparseable aliases (e.g. purely numeric)
+    return codes
+
+
+def update_alias_map(changes: dict):
+    """
+    Incrementally update the alias and phonetic indexes for the classes a
+    class-map patch touched ({name: (old entry, new entry)}, as returned by
+    config.apply_classmap_patch), instead of rebuild_alias_map()'s full pass.
+    Every alias the patch touched is re-resolved against the current class
+    map, so one shared with an untouched class goes back to that class; only
+    the aliases of the classes involved are re-encoded.
+    """
+    global _alias_choices, _canonical_names, _alias_map_key, _class_ids
+
+    classmap = get_classmap()
+    with _alias_lock:
+        if not _alias_map_ready:
+            return  # the first build reads the already-patched class map
+        _alias_map_key = _class_index_key()
+        class_keys = {canon: _class_alias_keys(canon, old) | _class_alias_keys(canon, new)
+                      for canon, (old, new) in changes.items()}
+        touched = set().union(*class_keys.values())
+
+        # Same precedence as rebuild_alias_map(): an alias beats a class name,
+        # and a later class beats an earlier one
+        owners = {}
+        for canon in classmap:
+            if canon.lower() in touched:
+                owners[canon.lower()] = canon
+        for canon, data in classmap.items():
+            for alias in data.get("aliases", []):
+                if alias.lower() in touched:
+                    owners[alias.lower()] = canon
+
+        for key in touched:
+            previous = _alias_to_canonical.pop(key, None)
+            for canon in (previous, owners.get(key)):
+                if canon is not None and canon not in class_keys:
+                    class_keys[canon] = _class_alias_keys(canon, classmap.get(canon))
+            if key in owners:
+                _alias_to_canonical[key] = owners[key]
+
+        # A class is indexed under the codes of the keys it still owns
+        for canon, keys in class_keys.items():
+            owned = _metaphones(k for k in keys if _alias_to_canonical.get(k) == canon)
+            for code in _metaphones(keys) - owned:
+                names = _phonetic_index.get(code)
+                if names is not None:
+                    names.discard(canon)
+                    if not names:
+                        del _phonetic_index[code]
+            for code in owned:
+                _phonetic_index.setdefault(code, set()).add(canon)
+
+        _alias_choices = list(_alias_to_canonical.keys())
+        _canonical_names = list(classmap.keys())
+        _class_ids = _index_class_ids(classmap)
+        _scoped_alias_cache.clear()
+
+    log.debug("patched alias map for %s classes: %s entries, %s phonetic codes",
+              len(changes), len(_alias_to_canonical), len(_phonetic_index))
+
+
+def _alias_subset(candidates):
+    """
+    Return (aliases sorted longest-first, alias choices) restricted to the
+    given candidate classes, or over the whole map when candidates is None.
+    Scoped subsets are computed once per candidate set and cached until the
+    next rebuild_alias_map().
+    """
+    _ensure_alias_map()
+    with _alias_lock:
+        key = None if candidates is None else frozenset(candidates)
+        cached = _scoped_alias_cache.get(key)
+        if cached is None:
+            aliases = [a for a, canon in _alias_to_canonical.items()
+                       if key is None or canon in key]
+            cached = (sorted(aliases, key=len, reverse=True), aliases)
+            _scoped_alias_cache[key] = cached
+        return cached
 
 
 def normalize_text(s):
@@ -74,18 +312,23 @@ def normalize_text(s):
 # Fix 1 + Fix 2: Multi-class detection constrained to canonical list
 # ===========================
 
-def _exact_substring_scan(normalized_transcript):
+def _exact_substring_scan(normalized_transcript, candidates=None):
     """
     Scan transcript for exact alias substrings.
     Uses longest-match-first to avoid partial overlaps
     (e.g. "super comp" should not also match "comp" → Comp Eliminator
      when "Super Comp" is a valid class).
     """
+    return set(_exact_substring_matches(normalized_transcript, candidates).keys())
+
+
+def _exact_substring_matches(normalized_transcript, candidates=None):
+    """Like _exact_substring_scan, but returns {canonical_name: matched alias}."""
     found = {}  # canonical_name → matched alias (longest wins)
 
     with _alias_lock:
-        # Sort aliases longest-first so longer matches take priority
-        sorted_aliases = sorted(_alias_to_canonical.keys(), key=len, reverse=True)
+        # Aliases come pre-sorted longest-first so longer matches take priority
+        sorted_aliases, _ = _alias_subset(candidates)
         # Track which character positions have already been claimed
         claimed = set()
 
@@ -115,69 +358,77 @@ def _exact_substring_scan(normalized_transcript):
 
                 start = idx + 1
 
-    return set(found.keys())
+    return found
+
+
+def _sliding_windows(normalized_transcript):
+    """Unique 1-4 word fragments of the transcript, for targeted fuzzy/phonetic matching."""
+    words = normalized_transcript.split()
+    fragments = set()
+    for window_size in range(1, min(5, len(words) + 1)):
+        for i in range(len(words) - window_size + 1):
+            fragments.add(" ".join(words[i:i + window_size]))
+    return fragments
 
 
-def _fuzzy_scan(normalized_transcript, already_found, threshold=82):
+def _fuzzy_scan(normalized_transcript, already_found, threshold=82, candidates=None):
     """
     Fuzzy-match transcript against alias list.
     Only adds classes NOT already found by exact matching.
     Uses a higher threshold (82) to reduce false positives like
     "super street" → "street et".
     """
-    additional = set()
+    return set(_fuzzy_scan_scores(normalized_transcript, already_found, threshold, candidates))
+
+
+def _fuzzy_scan_scores(normalized_transcript, already_found, threshold=82, candidates=None):
+    """Like _fuzzy_scan, but returns {canonical_name: best fuzzy score}."""
+    additional = {}
 
     with _alias_lock:
-        # Split transcript into sliding windows of 1-4 words for targeted fuzzy
-        words = normalized_transcript.split()
-        candidates = set()
-        for window_size in range(1, min(5, len(words) + 1)):
-            for i in range(len(words) - window_size + 1):
-                fragment = " ".join(words[i:i + window_size])
-                candidates.add(fragment)
-
-        for fragment in candidates:
+        _, alias_choices = _alias_subset(candidates)
+
+        for fragment in _sliding_windows(normalized_transcript):
             matches = process.extract(
                 fragment,
-                _alias_choices,
+                alias_choices,
                 scorer=fuzz.ratio,  # Use full ratio, not partial_ratio, for precision
                 limit=2
             )
             for alias, score, _ in matches:
                 if score >= threshold:
                     canon = _alias_to_canonical[alias]
-                    if canon not in already_found:
-                        additional.add(canon)
+                    if canon not in already_found and score > additional.get(canon, 0):
+                        additional[canon] = score
 
     return additional
 
 
-def _phonetic_scan(normalized_transcript, already_found):
+def _phonetic_scan(normalized_transcript, already_found, candidates=None):
     """
     Phonetic matching using Metaphone to catch speech-to-text near-misses.
     Only returns classes that exist in the canonical list.
     """
     additional = set()
-    words = normalized_transcript.split()
 
+    _ensure_alias_map()
     with _alias_lock:
-        # Try 1-4 word combinations
-        for window_size in range(1, min(5, len(words) + 1)):
-            for i in range(len(words) - window_size + 1):
-                fragment = " ".join(words[i:i + window_size])
-                try:
-                    code = jellyfish.metaphone(fragment)
-                    if code in _phonetic_index:
-                        for canon in _phonetic_index[code]:
-                            if canon not in already_found:
-                                additional.add(canon)
-                except Exception:
-                    pass
+        for fragment in _sliding_windows(normalized_transcript):
+            try:
+                code = jellyfish.metaphone(fragment)
+                if code in _phonetic_index:
+                    for canon in _phonetic_index[code]:
+                        if candidates is not None and canon not in candidates:
+                            continue
+                        if canon not in already_found:
+                            additional.add(canon)
+            except Exception:
+                pass
 
     return additional
 
 
-def find_classes(transcript, threshold=82):
+def find_classes(transcript, threshold=82, candidates=None):
     """
     Find ALL matching class names from transcript.
     Implements a three-pass strategy:
@@ -186,44 +437,139 @@ def find_classes(transcript, threshold=82):
       3. Phonetic matching via Metaphone
 
     All results are constrained to the canonical class list — no class name
-    that is not in the class map will ever be returned.
+    that is not in the class map will ever be returned. If candidates is
+    given (e.g. the active track's classes), matching is restricted to them.
     """
     t = normalize_text(transcript)
     if not t:
         return []
 
+    found, _ = _detect_classes(t, threshold, candidates)
+
+    # Final validation: only return classes that exist in the current classmap
+    classmap = get_classmap()
+    validated = [cls for cls in found if cls in classmap]
+
+    if validated:
+        log.debug("detected classes: %s from: '%s'", validated, transcript)
+
+    return validated
+
+
+def _detect_classes(normalized_transcript, threshold=82, candidates=None):
+    """
+    Run the three detection passes on a normalized transcript.
+
+    Returns ({canonical_name: (pass, score)}, {canonical_name: exact alias})
+    where pass is "exact", "fuzzy" or "phonetic".
+    """
     # Pass 1: exact substring
-    found = _exact_substring_scan(t)
+    exact = _exact_substring_matches(normalized_transcript, candidates)
+    found = {canon: ("exact", 100) for canon in exact}
 
     # Pass 2: fuzzy matching (always runs — not gated by "if not found")
-    fuzzy_found = _fuzzy_scan(t, found, threshold=threshold)
-    found |= fuzzy_found
+    fuzzy_found = _fuzzy_scan_scores(normalized_transcript, found, threshold=threshold,
+                                     candidates=candidates)
+    for canon, score in fuzzy_found.items():
+        found[canon] = ("fuzzy", score)
 
     # Pass 3: phonetic matching
-    phonetic_found = _phonetic_scan(t, found)
-    found |= phonetic_found
+    for canon in _phonetic_scan(normalized_transcript, found, candidates):
+        found[canon] = ("phonetic", PHONETIC_MATCH_SCORE)
 
-    # Final validation: only return classes that exist in the current classmap
-    classmap = get_classmap()
-    validated = [cls for cls in found if cls in classmap]
+    inc("asr_classifier_scans_total")
+    for pass_name, _ in found.values():
+        inc("asr_classifier_pass_hits_total", **{"pass": pass_name})
+    return found, exact
 
-    if DEBUG and validated:
-        print(f"[classifier] detected classes: {validated} from: '{transcript}'")
 
-    return validated
+# ===========================
+# Candidate pruning for LLM prompts
+# ===========================
+PHONETIC_MATCH_SCORE = 85  # score given to a Metaphone hit when ranking candidates
+
+
+def score_class_candidates(transcript, candidates=None):
+    """
+    Score classes by local match evidence, for pruning the LLM class list.
+    Exact alias hit → 100, Metaphone hit → PHONETIC_MATCH_SCORE, otherwise the
+    best fuzzy ratio (capped at 99) of any 1-4 word window against the
+    class's aliases.
+    Only classes scoring at least LLM_CANDIDATE_MIN_SCORE are returned.
+
+    Returns {canonical_name: score}
+    """
+    t = normalize_text(transcript)
+    if not t:
+        return {}
+
+    scores = {canon: 100 for canon in _exact_substring_scan(t, candidates)}
+
+    with _alias_lock:
+        _, alias_choices = _alias_subset(candidates)
+        for fragment in _sliding_windows(t):
+            matches = process.extract(
+                fragment,
+                alias_choices,
+                scorer=fuzz.ratio,
+                limit=5,
+                score_cutoff=LLM_CANDIDATE_MIN_SCORE
+            )
+            for alias, score, _ in matches:
+                canon = _alias_to_canonical[alias]
+                # Cap below an exact hit: a window can equal an alias that
+                # the exact pass rejected (e.g. "pro" inside "super pro")
+                score = min(score, 99)
+                if score > scores.get(canon, 0):
+                    scores[canon] = score
+
+    for canon in _phonetic_scan(t, set(), candidates):
+        scores[canon] = max(scores.get(canon, 0), PHONETIC_MATCH_SCORE)
+
+    return scores
+
+
+def rank_candidate_classes(transcript, top_n=None, candidates=None, scores=None):
+    """
+    Return the top-N most plausible canonical classes for a transcript,
+    best first, or None when pruning is disabled or there is no evidence
+    (callers then fall back to the full catalogue). Pass scores from
+    score_class_candidates to avoid scoring the transcript twice.
+    """
+    if top_n is None:
+        top_n = LLM_CANDIDATE_TOP_N
+    if not top_n:
+        return None
+
+    if scores is None:
+        scores = score_class_candidates(transcript, candidates)
+    if not scores:
+        return None
+
+    ranked = sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))
+    return [canon for canon, _ in ranked[:top_n]]
 
 
 def find_intents_with_context(transcript):
     """Find matching intent types and their matched keywords from transcript."""
+    return [(intent, kw) for intent, kw, _ in _match_intents(transcript)]
+
+
+def _match_intents(transcript):
+    """
+    Find matching intents as (intent, matched keyword, score) tuples, where
+    score is 100 for an exact pattern hit, else the fuzzy partial ratio.
+    """
     t = normalize_text(transcript)
     intents = []
 
-    for intent, patterns in INTENT_PATTERNS.items():
+    _ensure_alias_map()
+    for intent, patterns in _intent_choices.items():
         matched = False
         # Exact match
         for p in patterns:
-            if p.lower() in t:
-                intents.append((intent, p.lower()))
+            if p in t:
+                intents.append((intent, p, 100))
                 matched = True
                 break
 
@@ -231,52 +577,133 @@ def find_intents_with_context(transcript):
         if not matched:
             matches = process.extract(
                 t,
-                [p.lower() for p in patterns],
+                patterns,
                 scorer=fuzz.partial_ratio,
                 limit=3
             )
             for pattern, score, _ in matches:
                 if score >= 80:  # threshold for intent match
-                    intents.append((intent, pattern))
+                    intents.append((intent, pattern, score))
                     break
 
     return intents
 
 
+# ===========================
+# Local confidence model (gates LLM escalation)
+# ===========================
+# Evidence weight per detection pass; fuzzy evidence is also scaled by its score
+_PASS_WEIGHTS = {"exact": 1.0, "fuzzy": 0.9, "phonetic": 0.7}
+_FUZZY_INTENT_WEIGHT = 0.9   # fuzzy intent hits count for less than exact pattern hits
+_CONFLICT_PENALTY = 0.5      # both "to the lanes" and "standby" wording in one utterance
+
+_gate_counts = {"local": 0, "escalated": 0, "dropped": 0}
+_gate_lock = threading.Lock()
+
+
+def _is_shadowed(canon, exact_aliases, classmap):
+    """
+    True if one of canon's aliases only appears inside a longer alias that
+    the exact pass already claimed (e.g. "pro" inside "super pro").
+    """
+    for alias in classmap.get(canon, {}).get("aliases", []) + [canon]:
+        a = f" {normalize_text(alias)} "
+        for claimed in exact_aliases:
+            if a in f" {claimed} ":
+                return True
+    return False
+
+
+def score_transcript(transcript, candidates=None):
+    """
+    Combine exact / fuzzy / phonetic class evidence with intent match
+    strength into a single confidence value in [0, 1].
+
+    Returns {
+      "classes": [...],          # detected classes (minus shadowed ones)
+      "shadowed": [...],         # fuzzy/phonetic hits inside an exact alias
+      "evidence": {class: 0-1},
+      "intents": {intent: 0-1},
+      "confidence": 0-1          # weakest class evidence × weakest intent
+    }
+    """
+    t = normalize_text(transcript)
+    result = {"classes": [], "shadowed": [], "evidence": {}, "intents": {}, "confidence": 0.0}
+    if not t:
+        return result
+
+    found, exact = _detect_classes(t, candidates=candidates)
+    classmap = get_classmap()
+
+    for canon, (pass_name, score) in found.items():
+        if canon not in classmap:
+            continue
+        if pass_name != "exact" and _is_shadowed(canon, exact.values(), classmap):
+            result["shadowed"].append(canon)
+            continue
+        result["classes"].append(canon)
+        result["evidence"][canon] = _PASS_WEIGHTS[pass_name] * score / 100
+
+    for intent, _, score in _match_intents(transcript):
+        weight = 1.0 if score == 100 else _FUZZY_INTENT_WEIGHT
+        result["intents"][intent] = max(result["intents"].get(intent, 0), weight * score / 100)
+
+    if result["classes"] and result["intents"]:
+        confidence = min(result["evidence"].values()) * min(result["intents"].values())
+        if "CLASS_TO_LANES" in result["intents"] and "CLASS_STANDBY" in result["intents"]:
+            confidence *= _CONFLICT_PENALTY
+        result["confidence"] = confidence
+
+    return result
+
+
+def _count_gate(decision):
+    with _gate_lock:
+        _gate_counts[decision] += 1
+
+
+def get_gate_stats():
+    """Counts of local / escalated / dropped transcripts and the escalation rate."""
+    with _gate_lock:
+        stats = dict(_gate_counts)
+    total = sum(stats.values())
+    stats["escalation_rate"] = stats["escalated"] / total if total else 0.0
+    return stats
+
+
 # ===========================
 # Debounce tracking (per class+intent, long window)
 # ===========================
-_last_sent = {}
-_debounce_lock = threading.RLock()
+_debounce = ExpiryWindow(DEBOUNCE_SECONDS, DEBOUNCE_MAX_ENTRIES, name="debounce")
 
 
-def should_send(canonical_class, intent):
-    """Check if we should send this message (debounce)."""
-    key = (canonical_class, intent)
-    now = time.time()
+def _index_class_ids(classmap):
+    """
+    Class ids by canonical name, for the debounce and dedup keys. Also grows
+    the debounce cap to one entry per class+intent pair, the most that can
+    be live at once, so the cap never evicts a live key.
+    """
+    _debounce.max_entries = max(DEBOUNCE_MAX_ENTRIES, len(classmap) * len(INTENT_PATTERNS))
+    return {canon: data["id"] for canon, data in classmap.items()}
 
-    with _debounce_lock:
-        if now - _last_sent.get(key, 0) < DEBOUNCE_SECONDS:
-            return False
-        _last_sent[key] = now
 
+def _class_key(canonical_class):
+    """The class's id (stable across a rename), or its name if the index does not know it yet."""
+    return _class_ids.get(canonical_class, canonical_class)
+
+
+def should_send(canonical_class, intent):
+    """Check if we should send this message (debounce)."""
+    if _debounce.check_and_set((_class_key(canonical_class), sys.intern(intent))):
+        inc("asr_suppressed_total", reason="debounce")
+        return False
     return True
 
 
 # ===========================
 # Fix 3: Utterance-level deduplication (short window)
 # ===========================
-_recent_results = {}
-_dedup_lock = threading.RLock()
-
-
-def _clean_stale_dedup_entries():
-    """Remove expired entries from the dedup cache to prevent memory leaks."""
-    now = time.time() * 1000
-    stale_keys = [k for k, ts in _recent_results.items()
-                  if (now - ts) > DEDUP_WINDOW_MS * 2]
-    for k in stale_keys:
-        del _recent_results[k]
+_dedup = ExpiryWindow(DEDUP_WINDOW_MS / 1000, DEDUP_MAX_ENTRIES, name="dedup")
 
 
 def is_duplicate_result(result_classes, intent):
@@ -286,20 +713,12 @@ def is_duplicate_result(result_classes, intent):
 
     Returns True if this is a duplicate (should be suppressed).
     """
-    key_data = str(sorted(result_classes) + [intent])
-    key = hashlib.md5(key_data.encode()).hexdigest()
-    now = time.time() * 1000
-
-    with _dedup_lock:
-        _clean_stale_dedup_entries()
-
-        if key in _recent_results and (now - _recent_results[key]) < DEDUP_WINDOW_MS:
-            if DEBUG:
-                print(f"[classifier] suppressing duplicate: classes={result_classes} intent={intent}")
-            return True
-
-        _recent_results[key] = now
-
+    # str: ids, plus the name of a class the index does not know yet, sort together
+    key = tuple(sorted((_class_key(c) for c in result_classes), key=str))
+    if _dedup.check_and_set((key, sys.intern(intent))):
+        log.debug("suppressing duplicate: classes=%s intent=%s", result_classes, intent)
+        inc("asr_suppressed_total", reason="dedup")
+        return True
     return False
 
 
@@ -311,32 +730,46 @@ _bedrock_client = None
 def get_bedrock_client():
     global _bedrock_client
     if _bedrock_client is None:
-        _bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION)
+        # boto3 adds ~100 ms of imports, so it is only loaded once Bedrock is used
+        import boto3
+        from botocore.config import Config as BotoConfig
+        # No client-side retries: the circuit breaker below handles failover
+        _bedrock_client = boto3.client(
+            'bedrock-runtime', region_name=AWS_REGION,
+            config=BotoConfig(connect_timeout=LLM_REQUEST_TIMEOUT, read_timeout=LLM_REQUEST_TIMEOUT,
+                              retries={"max_attempts": 1})
+        )
     return _bedrock_client
 
 
-def _build_canonical_class_list_str():
-    """Build a formatted string of all canonical class names for the LLM prompt."""
+def _build_canonical_class_list_str(candidates=None):
+    """
+    Build a formatted string of canonical class names for the LLM prompt.
+    If candidates is given, only those classes are listed.
+    """
     classmap = get_classmap()
+    if candidates is not None:
+        return ", ".join(sorted(c for c in classmap if c in candidates))
     return ", ".join(sorted(classmap.keys()))
 
 
-def build_messages_with_llm(transcript, timestamp, classes):
+def _build_bedrock_system_prompt(catalogue_classes=None):
     """
-    Use AWS Bedrock to dynamically frame intents based on keywords and context.
-    Updated prompt includes canonical class list constraint and multi-class instruction.
+    Build the static Bedrock system prompt (rules, intents, class catalogue
+    of catalogue_classes or the whole class map). Depends only on the class
+    map and track scope, so it is built once per classmap version + scope
+    and is a byte-identical prefix across calls.
     """
-    msgs = []
-    classmap = get_classmap()
-    canonical_list_str = _build_canonical_class_list_str()
+    canonical_list_str = _build_canonical_class_list_str(catalogue_classes)
 
-    system_prompt = f'''You are an expert drag racing announcer AI.
-You receive a transcript of what the human announcer just said, along with the racing classes detected in the transcript.
+    return f'''You are an expert drag racing announcer AI.
+You receive a transcript of what the human announcer just said, along with the racing classes detected in the transcript and the most likely candidate classes.
 Your job is to identify if there is an intent for any of the classes and frame a concise announcement text using the exact fancy terms or keywords the human used.
 
 IMPORTANT CONSTRAINTS:
 1. You must only use class names that exactly match one of the following valid classes. Do not infer, guess, or return any class name not on this list:
 [{canonical_list_str}]
+Prefer the candidate classes given with the transcript. If a racing class is clearly mentioned but is not on this list, use "OTHER" as its class_name.
 
 2. If the user mentions more than one racing class, return ALL of them as separate objects in the JSON array. Do not return only the first class mentioned.
 
@@ -351,7 +784,39 @@ Output ONLY a JSON array. Each object must have:
 - "message_text": a beautifully framed sentence combining the class name and the human's keywords (e.g. "Super Pro, please make your way down to the staging lanes")
 If no intent is detected, return an empty array [].'''
 
-    prompt = f"Transcript: {transcript}\nDetected Classes: {classes}\n\nOutput JSON array:"
+
+def build_messages_with_llm(transcript, timestamp, classes, candidate_classes=None, debounce=True,
+                            raise_errors=False):
+    """
+    Use AWS Bedrock to dynamically frame intents based on keywords and context.
+    Updated prompt includes canonical class list constraint and multi-class instruction.
+
+    The static system prompt is prebuilt per classmap version; only the
+    pruned candidate classes (see rank_candidate_classes), the detected
+    classes and the transcript vary per call and go in the user message.
+    With debounce=False the caller applies should_send itself.
+    With raise_errors=True a Bedrock failure is re-raised instead of
+    falling back locally (used by the circuit breaker chain).
+    """
+    msgs = []
+    classmap = get_classmap()
+    if candidate_classes is None:
+        candidate_classes = rank_candidate_classes(transcript, candidates=get_candidate_classes())
+    if candidate_classes is not None:
+        candidate_classes = set(candidate_classes) | set(classes)
+
+    system_prompt = get_scoped_prompt("bedrock_system", _build_bedrock_system_prompt)
+    system = system_prompt
+    if BEDROCK_PROMPT_CACHING:
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+    prompt = f"Candidate Classes: [{_build_canonical_class_list_str(candidate_classes)}]\n"
+    prompt += f"Transcript: {transcript}\nDetected Classes: {classes}\n\nOutput JSON array:"
+
+    if log.isEnabledFor(logging.DEBUG):
+        n_listed = len(candidate_classes) if candidate_classes is not None else len(classmap)
+        log.debug("Bedrock prompt ~%s static + ~%s per-call tokens (%s candidates)",
+                  count_tokens(system_prompt, BEDROCK_MODEL_ID), count_tokens(prompt, BEDROCK_MODEL_ID), n_listed)
 
     try:
         client = get_bedrock_client()
@@ -360,7 +825,7 @@ If no intent is detected, return an empty array [].'''
             body=json.dumps({
                 "anthropic_version": "bedrock-2023-05-31",
                 "max_tokens": 200,
-                "system": system_prompt,
+                "system": system,
                 "messages": [
                     {"role": "user", "content": prompt}
                 ]
@@ -371,6 +836,15 @@ If no intent is detected, return an empty array [].'''
         body = json.loads(response.get('body').read())
         content = body.get('content', [])[0].get('text', '[]')
 
+        usage = body.get("usage") or {}
+        for kind in ("input_tokens", "output_tokens", "cache_read_input_tokens"):
+            if usage.get(kind):
+                inc("asr_llm_tokens_total", usage[kind], backend="bedrock", kind=kind.replace("_tokens", ""))
+        if usage:
+            log.debug("Bedrock usage: input=%s (cache read=%s, cache write=%s) output=%s",
+                      usage.get('input_tokens'), usage.get('cache_read_input_tokens', 0),
+                      usage.get('cache_creation_input_tokens', 0), usage.get('output_tokens'))
+
         # Clean up any potential non-JSON prefix/suffix from Claude
         if "```json" in content:
             content = content.split("```json")[1].split("```")[0].strip()
@@ -385,7 +859,7 @@ If no intent is detected, return an empty array [].'''
             text = res.get("message_text")
 
             # Validate: class must be in the detected list AND in the classmap
-            if cls in classes and cls in classmap and should_send(cls, intent):
+            if cls in classes and cls in classmap and (not debounce or should_send(cls, intent)):
                 msgs.append({
                     "class_id": classmap[cls]["id"],
                     "class_name": cls,
@@ -396,16 +870,20 @@ If no intent is detected, return an empty array [].'''
                 })
 
     except Exception as e:
-        if DEBUG:
-            print(f"[classifier] Bedrock framing error: {e}")
+        log.warning("Bedrock framing error: %s", e)
+        if raise_errors:
+            raise
         # Fallback if LLM fails
-        return build_messages_fallback(transcript, timestamp, classes)
+        return build_messages_fallback(transcript, timestamp, classes, debounce)
 
     return msgs
 
 
-def build_messages_fallback(transcript, timestamp, classes):
-    """Fallback logic that uses the detected phrase/keywords to frame the message."""
+def build_messages_fallback(transcript, timestamp, classes, debounce=True):
+    """
+    Fallback logic that uses the detected phrase/keywords to frame the message.
+    With debounce=False the caller applies should_send itself.
+    """
     raw_intents = find_intents_with_context(transcript)
     
     # Unique the intents so we don't send multiple CLASS_TO_LANES just because 
@@ -420,12 +898,11 @@ def build_messages_fallback(transcript, timestamp, classes):
 
     for cls in classes:
         if cls not in classmap:
-            if DEBUG:
-                print(f"[classifier] warning: class '{cls}' not in classmap")
+            log.warning("class '%s' not in classmap", cls)
             continue
 
         for intent, matched_kw in unique_intents.items():
-            if should_send(cls, intent):
+            if not debounce or should_send(cls, intent):
                 class_id = classmap[cls]["id"]
 
                 if intent == "CLASS_TO_LANES":
@@ -450,64 +927,473 @@ def build_messages_fallback(transcript, timestamp, classes):
     return msgs
 
 
-def build_messages(transcript, timestamp):
+def _gate_decision(local, transcript, scope_classes):
     """
-    Build message list from transcript.
-    Routes to LLM framing or fallback based on config.
-    Applies utterance-level deduplication before returning.
+    Decide how to handle a transcript from its local score:
+      "local"     — confident enough to answer without an LLM call
+      "dropped"   — no class evidence at all (fillers, crowd chatter)
+      "escalated" — ambiguous; send to RAG / Bedrock
+    Returns (decision, candidate class scores or None).
     """
-    classes = find_classes(transcript)
+    if local["classes"]:
+        if local["confidence"] >= LOCAL_ACCEPT_CONFIDENCE:
+            return "local", None
+        return "escalated", None
+
+    # Nothing detected: only escalate if some class is a plausible near-miss
+    scores = score_class_candidates(transcript, scope_classes)
+    if max(scores.values(), default=0) >= LOCAL_ESCALATE_MIN_SCORE:
+        return "escalated", scores
+    return "dropped", scores
 
+
+# ===========================
+# Circuit breakers (per LLM backend)
+# ===========================
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker for one LLM backend.
+
+    closed    — calls go through; each outcome is recorded with its latency
+    open      — too many failed or slow calls in the window; calls are skipped
+                so transcripts go straight to the next tier
+    half_open — BREAKER_OPEN_SECONDS after opening, a single probe call is let
+                through; success closes the breaker, failure re-opens it
+
+    allow() hands out a ticket for each call it lets through; pass it back to
+    record() (or call()). Only the probe's own ticket decides the half-open
+    state, so a slow call admitted before the breaker opened cannot close or
+    re-open it by finishing while the probe is in flight.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self._state = self.CLOSED
+        self._calls = deque()        # (monotonic time, latency, ok) within the window
+        self._opened_at = 0.0
+        self._probe = None           # ticket of the half-open probe in flight
+        self._counts = {"calls": 0, "failures": 0, "skipped": 0, "opened": 0}
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        cutoff = now - BREAKER_WINDOW_SECONDS
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+    def _open(self, now):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probe = None
+        self._counts["opened"] += 1
+
+    def allow(self):
+        """
+        A ticket (truthy) if a call may go to the backend now, else False.
+        When half-open the ticket claims the probe.
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < BREAKER_OPEN_SECONDS:
+                    self._counts["skipped"] += 1
+                    return False
+                self._state = self.HALF_OPEN
+                breaker_log.debug("%s half-open, probing", self.name)
+            if self._state == self.HALF_OPEN:
+                if self._probe is not None:
+                    self._counts["skipped"] += 1
+                    return False
+                self._probe = object()
+                return self._probe
+            return True
+
+    def record(self, latency, ok, ticket=None):
+        """
+        Record a call outcome; calls slower than BREAKER_SLOW_CALL_SECONDS count
+        as failures. ticket is what allow() returned for the call.
+        """
+        ok = ok and latency <= BREAKER_SLOW_CALL_SECONDS
+        now = time.monotonic()
+        with self._lock:
+            self._counts["calls"] += 1
+            if not ok:
+                self._counts["failures"] += 1
+
+            if self._state == self.HALF_OPEN:
+                if ticket is None or ticket is not self._probe:
+                    return  # admitted before the breaker opened: not the probe
+                if ok:
+                    self._state = self.CLOSED
+                    self._probe = None
+                    self._calls = deque([(now, latency, ok)])
+                    breaker_log.info("%s closed (%.2fs probe)", self.name, latency)
+                else:
+                    self._open(now)
+                    breaker_log.warning("%s probe failed, re-opened", self.name)
+                return
+
+            self._calls.append((now, latency, ok))
+            self._trim(now)
+            if self._state == self.CLOSED and len(self._calls) >= BREAKER_MIN_CALLS:
+                failures = sum(1 for _, _, c_ok in self._calls if not c_ok)
+                if failures / len(self._calls) >= BREAKER_FAILURE_RATIO:
+                    self._open(now)
+                    breaker_log.warning("%s opened: %s/%s calls failed or slow in %ss",
+                                      self.name, failures, len(self._calls), BREAKER_WINDOW_SECONDS)
+
+    def call(self, fn, *args, ticket=None, **kwargs):
+        """Run fn under the breaker (ticket from allow()), recording its latency and outcome."""
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(time.monotonic() - start, ok=False, ticket=ticket)
+            raise
+        self.record(time.monotonic() - start, ok=True, ticket=ticket)
+        return result
+
+    def snapshot(self):
+        """State, window stats and lifetime counters for metrics."""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            latencies = sorted(lat for _, lat, _ in self._calls)
+            failures = sum(1 for _, _, ok in self._calls if not ok)
+            state = {
+                "state": self._state,
+                "window_calls": len(latencies),
+                "window_failure_ratio": failures / len(latencies) if latencies else 0.0,
+                "window_p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                "window_max_latency": latencies[-1] if latencies else None,
+                "open_for": now - self._opened_at if self._state != self.CLOSED else 0.0,
+            }
+            state.update(self._counts)
+            return state
+
+
+_breakers = {
+    "rag": CircuitBreaker("rag"),
+    "bedrock": CircuitBreaker("bedrock"),
+}
+
+
+def get_breaker_states():
+    """Per-backend breaker snapshot: {"rag": {...}, "bedrock": {...}}."""
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
+
+
+_BREAKER_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+def _metric_samples():
+    """Gate decisions, breaker states / counters and debounce / dedup sizes, read at scrape time."""
+    samples = [("asr_gate_decisions_total", {"decision": d}, n)
+               for d, n in get_gate_stats().items() if d != "escalation_rate"]
+    for name, snap in get_breaker_states().items():
+        samples.append(("asr_breaker_state", {"backend": name}, _BREAKER_STATE_VALUES[snap["state"]]))
+        samples.append(("asr_breaker_window_p50_seconds", {"backend": name}, snap["window_p50_latency"]))
+        for counter in ("calls", "failures", "skipped", "opened"):
+            samples.append((f"asr_breaker_{counter}_total", {"backend": name}, snap[counter]))
+    for name, window in (("debounce", _debounce), ("dedup", _dedup)):
+        samples.append(("asr_expiry_entries", {"set": name}, len(window)))
+        samples.append(("asr_expiry_evicted_total", {"set": name}, window.evicted))
+    return samples
+
+
+register_collector(_metric_samples)
+
+
+def _build_messages_with_escalation(transcript, timestamp, classes, candidate_classes,
+                                    debounce=True, on_message=None):
+    """
+    RAG → Bedrock → local fallback chain for transcripts the local matcher is unsure of.
+    A backend whose circuit breaker is open is skipped without being called.
+    on_message(msg) receives RAG messages as they stream in (see classify_with_rag).
+    """
     if USE_RAG_CLASSIFIER:
         try:
-            from rag_classifier import classify_with_rag, initialize_knowledge_base
-            # Ensure KB is initialized (no-op after first call)
-            initialize_knowledge_base()
-            msgs = classify_with_rag(transcript, timestamp)
-            if msgs:  # RAG succeeded and found results
-                pass  # use RAG results
-            elif classes:  # RAG returned nothing, fall through to existing pipeline
-                if DEBUG:
-                    print("[classifier] RAG returned no results, falling back")
-                if USE_LLM_FRAMING:
-                    msgs = build_messages_with_llm(transcript, timestamp, classes)
+            from rag_classifier import classify_with_rag
+            ticket = _breakers["rag"].allow()
+            if ticket:
+                # classify_with_rag initializes the KB first (a no-op once warm_up()
+                # has run), so a KB that fails to load counts against the breaker
+                with span("rag"):
+                    msgs = _breakers["rag"].call(classify_with_rag, transcript, timestamp,
+                                                 candidate_classes=candidate_classes,
+                                                 debounce=debounce, raise_errors=True,
+                                                 on_message=on_message, ticket=ticket)
+                if msgs:  # RAG succeeded and found results
+                    return msgs
+                if classes:  # RAG returned nothing, fall through to existing pipeline
+                    log.debug("RAG returned no results, falling back")
                 else:
-                    msgs = build_messages_fallback(transcript, timestamp, classes)
+                    return []
             else:
-                msgs = []
+                log.debug("RAG breaker open, skipping to next tier")
         except Exception as e:
-            if DEBUG:
-                print(f"[classifier] RAG error, falling back: {e}")
-            if classes:
-                if USE_LLM_FRAMING:
-                    msgs = build_messages_with_llm(transcript, timestamp, classes)
-                else:
-                    msgs = build_messages_fallback(transcript, timestamp, classes)
-            else:
-                msgs = []
-    elif classes:
-        if USE_LLM_FRAMING:
-            msgs = build_messages_with_llm(transcript, timestamp, classes)
+            log.warning("RAG error, falling back: %s", e)
+            if not classes:
+                return []
+
+    if not classes:
+        return []
+    if USE_LLM_FRAMING:
+        ticket = _breakers["bedrock"].allow()
+        if ticket:
+            try:
+                with span("bedrock"):
+                    return _breakers["bedrock"].call(build_messages_with_llm, transcript, timestamp,
+                                                     classes, candidate_classes, debounce,
+                                                     raise_errors=True, ticket=ticket)
+            except Exception:
+                pass  # already logged by build_messages_with_llm
         else:
+            log.debug("Bedrock breaker open, using local framing")
+    return build_messages_fallback(transcript, timestamp, classes, debounce)
+
+
+# ===========================
+# Speculative local + LLM execution
+# ===========================
+_llm_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_llm_executor():
+    """Lazily create the worker pool that runs LLM pipelines off the caller's thread."""
+    global _llm_executor
+    if _llm_executor is None:
+        with _executor_lock:
+            if _llm_executor is None:
+                _llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS,
+                                                   thread_name_prefix="llm")
+    return _llm_executor
+
+
+class _Reconciler:
+    """
+    Per-utterance emission record shared by the local and LLM results.
+    Each (class, intent) pair goes through should_send at most once, whichever
+    result offers it first, so reconciliation never double-fires a debounce.
+
+    LLM messages that stream in (stream()) are held for the caller until it
+    takes them with take_streamed(); any that arrive later go to on_late.
+    """
+
+    def __init__(self, on_late=None):
+        self._emitted = set()
+        self._streamed = []
+        self._returned = False
+        self._on_late = on_late
+        self._ready = threading.Event()   # set on the first streamed message or LLM completion
+        self._lock = threading.Lock()
+
+    def _accept_locked(self, msgs):
+        out = []
+        for m in msgs:
+            key = (m["class_name"], m["intent"])
+            if key in self._emitted:
+                continue
+            self._emitted.add(key)
+            if should_send(*key):
+                out.append(m)
+        return out
+
+    def accept(self, msgs):
+        with self._lock:
+            return self._accept_locked(msgs)
+
+    def stream(self, msg):
+        """Called from the LLM worker for each message as soon as it is parsed."""
+        with self._lock:
+            out = self._accept_locked([msg])
+            if out and not self._returned:
+                self._streamed.extend(out)
+                self._ready.set()
+                return
+        if out:
+            log.debug("LLM streamed: %s", [(m['class_name'], m['intent']) for m in out])
+            self._on_late(out)
+
+    def wake(self):
+        self._ready.set()
+
+    def wait(self, timeout):
+        return self._ready.wait(timeout)
+
+    def take_streamed(self):
+        """Hand streamed messages to the caller; later ones go to on_late."""
+        with self._lock:
+            self._returned = True
+            out, self._streamed = self._streamed, []
+            return out
+
+
+def _build_messages_speculative(transcript, timestamp, local, candidate_classes, on_late):
+    """
+    Run the LLM chain concurrently with the local result for an escalated
+    transcript. First acceptable result wins:
+      - local confidence ≥ SPECULATIVE_EMIT_CONFIDENCE → local result now,
+        the LLM result upgrades it when it arrives
+      - otherwise wait up to LLM_DEADLINE_SECONDS for the LLM, then fall
+        back to the local result and upgrade later
+    A streaming RAG response ends the wait at its first message; the rest
+    of the response follows through on_late as it is parsed.
+    Pairs the LLM adds after this returns are delivered via on_late(msgs).
+    """
+    classes = local["classes"]
+    reconciler = _Reconciler(on_late)
+    # The LLM job and its completion callback run in copies of this context,
+    # so their spans and late deliveries stay on the utterance's trace
+    future = _get_llm_executor().submit(
+        contextvars.copy_context().run, _build_messages_with_escalation,
+        transcript, timestamp, classes, candidate_classes, False, reconciler.stream
+    )
+    done_context = contextvars.copy_context()
+    future.add_done_callback(lambda f: reconciler.wake())
+    local_msgs = build_messages_fallback(transcript, timestamp, classes, debounce=False) if classes else []
+
+    if local_msgs and local["confidence"] >= SPECULATIVE_EMIT_CONFIDENCE:
+        msgs = reconciler.take_streamed() + reconciler.accept(local_msgs)
+    elif _wait_for_llm(reconciler):
+        msgs = reconciler.take_streamed()
+        if future.done():
+            try:
+                return msgs + reconciler.accept(future.result())
+            except Exception as e:
+                log.warning("LLM pipeline error: %s", e)
+                return msgs + reconciler.accept(local_msgs)
+    else:
+        log.debug("LLM missed %ss deadline, emitting local result", LLM_DEADLINE_SECONDS)
+        msgs = reconciler.take_streamed() + reconciler.accept(local_msgs)
+
+    def _on_llm_done(f):
+        try:
+            late = reconciler.accept(f.result())
+        except Exception as e:
+            log.warning("late LLM pipeline error: %s", e)
+            # The LLM may have failed mid-stream; fill in from the local result
+            late = reconciler.accept(local_msgs)
+        if late:
+            log.debug("LLM upgrade: %s", [(m['class_name'], m['intent']) for m in late])
+            on_late(late)
+
+    future.add_done_callback(lambda f: done_context.run(_on_llm_done, f))
+    return msgs
+
+
+def _wait_for_llm(reconciler):
+    """reconciler.wait under the LLM deadline, timed as the llm_wait stage."""
+    with span("llm_wait"):
+        return reconciler.wait(LLM_DEADLINE_SECONDS)
+
+
+def build_messages(transcript, timestamp, on_late=None):
+    """
+    Build message list from transcript.
+    Routes to LLM framing or fallback based on config.
+    Applies utterance-level deduplication before returning.
+
+    With an LLM enabled, the local confidence model gates escalation:
+    confident transcripts are answered locally, transcripts with no class
+    evidence are dropped, and only ambiguous ones reach RAG / Bedrock.
+
+    If on_late is given, escalated transcripts run the LLM speculatively
+    under a deadline (see _build_messages_speculative) and any messages it
+    adds afterwards are passed to on_late(msgs) from a worker thread.
+    Without it, escalation blocks until the LLM chain finishes.
+    """
+    scope_classes = get_candidate_classes()
+
+    if on_late is not None:
+        # LLM upgrades go through the same utterance dedup as the first result
+        deliver_late = on_late
+
+        def on_late(late):
+            late = _dedup_messages(late)
+            if late:
+                deliver_late(late)
+
+    if USE_RAG_CLASSIFIER or USE_LLM_FRAMING:
+        with span("local_match"):
+            local = score_transcript(transcript, candidates=scope_classes)
+        classes = local["classes"]
+        decision, scores = _gate_decision(local, transcript, scope_classes)
+        _count_gate(decision)
+
+        log.debug("gate=%s confidence=%.2f classes=%s intents=%s",
+                  decision, local['confidence'], classes, list(local['intents']))
+
+        if decision == "local":
             msgs = build_messages_fallback(transcript, timestamp, classes)
+        elif decision == "dropped":
+            msgs = []
+        else:
+            candidate_classes = rank_candidate_classes(transcript, candidates=scope_classes,
+                                                       scores=scores)
+            if on_late is not None:
+                msgs = _build_messages_speculative(transcript, timestamp, local,
+                                                   candidate_classes, on_late)
+            else:
+                msgs = _build_messages_with_escalation(transcript, timestamp, classes,
+                                                       candidate_classes)
     else:
-        msgs = []
+        with span("local_match"):
+            classes = find_classes(transcript, candidates=scope_classes)
+        msgs = build_messages_fallback(transcript, timestamp, classes) if classes else []
 
     # Fix 3: Utterance-level deduplication
-    # Group messages by intent to build dedup keys
-    if msgs:
-        # Build a combined dedup key from all classes + first intent
-        all_classes_in_msgs = [m["class_name"] for m in msgs]
-        all_intents_in_msgs = list(set(m["intent"] for m in msgs))
-
-        for intent in all_intents_in_msgs:
-            classes_for_intent = [m["class_name"] for m in msgs if m["intent"] == intent]
-            if is_duplicate_result(classes_for_intent, intent):
-                # Suppress all messages for this duplicate group
-                msgs = [m for m in msgs if m["intent"] != intent]
-
+    return _dedup_messages(msgs)
+
+
+def _dedup_messages(msgs):
+    """Drop each intent's group of messages whose class set was already emitted (is_duplicate_result)."""
+    if not msgs:
+        return msgs
+    for intent in set(m["intent"] for m in msgs):
+        classes_for_intent = [m["class_name"] for m in msgs if m["intent"] == intent]
+        if is_duplicate_result(classes_for_intent, intent):
+            # Suppress all messages for this duplicate group
+            msgs = [m for m in msgs if m["intent"] != intent]
     return msgs
 
 
-# Initialize alias map on import
-rebuild_alias_map()
+# ===========================
+# Staged startup
+# ===========================
+def warm_up(background=False):
+    """
+    Do the one-time work the first transcript would otherwise pay for:
+    build the alias/phonetic indexes, import rag_classifier and embed the
+    knowledge base (RAG), create the Bedrock client (framing). main runs
+    this in an executor while the Transcribe websocket connects. Safe to
+    call concurrently with build_messages: each step is idempotent and
+    locked, so a transcript arriving early waits on the same work.
+
+    With background=True it returns as soon as the indexes are built, which
+    is all the rule-based path needs, and leaves the KB and the Bedrock
+    client to a daemon thread; an escalation that arrives first waits on
+    the KB lock instead of every transcript waiting for the embeddings.
+    """
+    t0 = time.perf_counter()
+    _ensure_alias_map()
+    if background:
+        log.debug("alias map ready in %.0f ms", (time.perf_counter() - t0) * 1000)
+        threading.Thread(target=_warm_up_llm, args=(t0,), name="warm-up", daemon=True).start()
+    else:
+        _warm_up_llm(t0)
+
+
+def _warm_up_llm(t0):
+    """The escalation half of warm_up(): RAG knowledge base and Bedrock client."""
+    if USE_RAG_CLASSIFIER:
+        try:
+            from rag_classifier import initialize_knowledge_base
+            initialize_knowledge_base()
+        except Exception as e:
+            # classify_with_rag retries the KB on the first escalation
+            log.warning("RAG warm-up failed: %s", e)
+    if USE_LLM_FRAMING:
+        get_bedrock_client()
+    log.debug("warm-up done in %.0f ms", (time.perf_counter() - t0) * 1000)
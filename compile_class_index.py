@@ -0,0 +1,53 @@
+"""
+compile_class_index.py - Precompile the classifier index shipped next to class_config.json
+
+Builds the alias map, longest-first alias list, phonetic (Metaphone) index
+and normalized intent patterns from class_config.json (plus any journaled
+patches) and pickles them to CLASS_INDEX_PATH, keyed by the class map's
+content hash. classifier loads the artifact in one read at boot while the
+key matches and rebuilds (and rewrites it) once the class map changes.
+
+With --embeddings, also embeds the RAG knowledge base chunks into
+RAG_EMBEDDING_CACHE_PATH (needs OPENAI_API_KEY), so a reboot with network
+trouble still has retrieval.
+
+Usage:
+    python compile_class_index.py [--output class_index.pkl] [--embeddings]
+"""
+
+import argparse
+import time
+
+import config
+import classifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default=None, help=f"artifact path (default {config.CLASS_INDEX_PATH})")
+    parser.add_argument("--embeddings", action="store_true", help="also cache the RAG KB embeddings")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    classifier.rebuild_alias_map()
+    built = time.perf_counter() - t0
+    path = classifier.save_class_index(args.output)
+
+    t0 = time.perf_counter()
+    assert classifier.load_class_index(path), f"{path} did not load back"
+    loaded = time.perf_counter() - t0
+
+    print(f"{path}: {len(config.get_classmap())} classes, {len(classifier._alias_to_canonical)} aliases, "
+          f"{len(classifier._phonetic_index)} phonetic codes, {path.stat().st_size:,} bytes")
+    print(f"key {classifier._class_index_key()}: build {built * 1000:.1f} ms, load {loaded * 1000:.1f} ms")
+
+    if args.embeddings:
+        import rag_classifier
+        data = rag_classifier.load_knowledge_base()
+        texts = [c["text"] for c in rag_classifier.chunk_knowledge_base(data)]
+        embeddings = rag_classifier.embed_chunks_cached(texts)
+        print(f"{config.RAG_EMBEDDING_CACHE_PATH}: {embeddings.shape[0]} chunks x {embeddings.shape[1]} dims")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,53 @@ config.py - Centralized configuration with dynamic class loading
 
 This module now loads classes from a JSON file (class_config.json) and
 supports hot-reloading of the class map via MQTT.
+
+Class config messages are either a full snapshot
+    {"version": 7, "classes": [{"id": 0, "name": ..., "aliases": [...]}, ...]}
+or a patch against a known revision
+    {"base_version": 7, "version": 8, "ops": [
+        {"op": "add", "class": {"id": 90, "name": "Pro Mod", "aliases": ["pro mod"]}},
+        {"op": "remove", "name": "Stock"},
+        {"op": "alias", "name": "Super Gas", "add": ["sg"], "remove": ["gas"]}]}
+Patches are applied in place and appended to CLASS_CONFIG_JOURNAL_PATH (replayed
+on boot); class_config.json is rewritten only for snapshots and when the
+journal is compacted. A patch whose base_version is not the current revision
+is rejected so the caller can request a fresh snapshot.
 """
 
 import os
 import json
+import time
+import atexit
+import hashlib
+import logging
 from pathlib import Path
 import threading
 
+_log = logging.getLogger("asr.config")   # config is imported by log.py, so not log.get_logger
+
 # ===========================
 # Logging & Debugging
 # ===========================
 DEBUG = True
 VOCABULARY_NAME = "racetrack-classes"
+LOG_LEVEL = None         # Default level for every subsystem (log.py); None: "DEBUG" if DEBUG else "INFO"
+LOG_LEVELS = {"mic": "INFO"}  # Per-subsystem overrides, e.g. {"rag": "DEBUG", "mqtt": "WARNING"}; mic debug is per audio block
+LOG_FORMAT = "text"      # "text" ("[subsystem] message") or "json" (one JSON object per line)
+LOG_RATE_LIMIT = 5       # Records per second from any one log call below WARNING; None disables
+TRACING_ENABLED = True   # Per-utterance latency spans and per-stage histograms (tracing.py)
+TRACE_LOG_UTTERANCES = False  # Log each utterance's stage timeline ("trace" subsystem, debug) when it is delivered
+METRICS_PORT = 9108      # Serve /metrics (Prometheus text) and /metrics.json; None disables
+METRICS_BIND = "127.0.0.1"  # Interface for the metrics endpoint ("0.0.0.0" to scrape from another host)
+METRICS_JSON_PATH = None  # Also rewrite this file with the metrics as JSON every METRICS_JSON_INTERVAL s
+METRICS_JSON_INTERVAL = 30.0
+PROFILE_SIGNAL = "SIGUSR1"  # `kill -USR1 <pid>` starts a profiling capture (profiler.py); None disables
+PROFILE_ON_START = False  # Also capture once right after startup
+PROFILE_SECONDS = 30.0    # Length of one capture
+PROFILE_MODE = "sample"   # "sample" (stacks of all threads, flamegraph input) or "cprofile" (event loop thread)
+PROFILE_SAMPLE_HZ = 97    # Prime, so samples do not lock step with the 20 ms audio blocks
+PROFILE_TRACEMALLOC = False  # Diff tracemalloc snapshots over the capture (slows allocations; the end snapshot pauses every thread)
+PROFILE_DIR = Path("profiles")
 
 # ===========================
 # AWS Transcribe Configuration
@@ -34,11 +69,30 @@ MIC_DEVICE_INDEX = None  # Set to an integer to lock to a specific device, or No
 # Class Map Configuration (Dynamic)
 # ===========================
 CLASS_CONFIG_PATH = Path("class_config.json")
+CLASS_CONFIG_JOURNAL_PATH = Path("class_config.journal")  # Applied class-map patches, one JSON per line
+CLASS_CONFIG_JOURNAL_MAX = 100  # Patches in the journal before it is folded into class_config.json
+CLASS_CONFIG_WRITE_DELAY = 1.0  # Seconds a class_config.json write waits so bursts of updates coalesce
+CLASS_INDEX_PATH = Path("class_index.pkl")  # Precompiled classifier index (compile_class_index.py); rebuilt when stale
 
 _class_map = {}
+_class_map_version = ""  # content hash of _class_map, see classmap_hash()
+_class_map_revision = 0  # protocol "version" of the last applied snapshot / patch
+_journal_entries = 0
 _class_map_lock = threading.RLock()
 
 
+def load_class_config_data(path: Path = None) -> dict:
+    """Load the raw class config JSON ({"version": ..., "classes": [...]})."""
+    if path is None:
+        path = CLASS_CONFIG_PATH
+    
+    if not path.exists():
+        raise FileNotFoundError(f"Class config JSON not found: {path}")
+    
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 def load_class_config(path: Path = None) -> list:
     """
     Load class configuration from JSON file.
@@ -51,16 +105,7 @@ def load_class_config(path: Path = None) -> list:
       ]
     }
     """
-    if path is None:
-        path = CLASS_CONFIG_PATH
-    
-    if not path.exists():
-        raise FileNotFoundError(f"Class config JSON not found: {path}")
-    
-    with path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    
-    return data.get("classes", [])
+    return load_class_config_data(path).get("classes", [])
 
 
 def build_classmap(classes: list) -> dict:
@@ -87,17 +132,58 @@ def build_classmap(classes: list) -> dict:
     return classmap
 
 
+def classmap_hash(classmap: dict) -> str:
+    """Stable content hash of a class map (used to version prompts and indexes)."""
+    canonical = json.dumps(classmap, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+def classmap_to_classes(classmap: dict) -> list:
+    """Inverse of build_classmap: CLASS_MAP back to a list of {id, name, aliases}."""
+    return [{"id": data["id"], "name": name, "aliases": list(data.get("aliases", []))}
+            for name, data in classmap.items()]
+
+
 def initialize_classmap():
-    """Initialize CLASS_MAP at import time from default config file."""
-    global _class_map
+    """Initialize CLASS_MAP at import time from default config file (plus journaled patches)."""
+    global _class_map, _class_map_version, _class_map_revision
     try:
-        classes = load_class_config()
-        _class_map = build_classmap(classes)
-        if DEBUG:
-            print(f"[config] loaded {len(_class_map)} classes from {CLASS_CONFIG_PATH}")
+        data = load_class_config_data()
+        _class_map = build_classmap(data.get("classes", []))
+        _class_map_revision = data.get("version", 0)
+        _log.debug("loaded %s classes from %s", len(_class_map), CLASS_CONFIG_PATH)
     except FileNotFoundError as e:
-        print(f"[config] WARNING: {e}")
+        _log.warning("%s", e)
         _class_map = {}
+        _class_map_revision = 0
+    _replay_journal()
+    _class_map_version = classmap_hash(_class_map)
+
+
+def _replay_journal():
+    """Re-apply journaled patches that follow the loaded snapshot's revision."""
+    global _class_map, _class_map_revision, _journal_entries
+    _journal_entries = 0
+    if not CLASS_CONFIG_JOURNAL_PATH.exists():
+        return
+    replayed = 0
+    with CLASS_CONFIG_JOURNAL_PATH.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                patch = json.loads(line)
+            except json.JSONDecodeError:
+                break   # torn last line from a crash mid-append
+            _journal_entries += 1
+            if patch.get("base_version") != _class_map_revision:
+                continue   # already folded into the snapshot
+            new_map, _ = _apply_ops(_class_map, patch.get("ops", []))
+            if new_map is None:
+                break
+            _class_map = new_map
+            _class_map_revision = patch.get("version")
+            replayed += 1
+    if replayed:
+        _log.debug("replayed %s journaled class-map patches → version %s", replayed, _class_map_revision)
 
 
 def get_classmap() -> dict:
@@ -106,34 +192,232 @@ def get_classmap() -> dict:
         return dict(_class_map)
 
 
+def get_classmap_version() -> str:
+    """Content hash of the current CLASS_MAP; changes whenever the map does."""
+    with _class_map_lock:
+        return _class_map_version
+
+
+def get_classmap_revision():
+    """Protocol version of the current CLASS_MAP (the "version" of the last snapshot / patch)."""
+    with _class_map_lock:
+        return _class_map_revision
+
+
 def update_classmap_from_json(json_payload: dict):
     """
-    Update CLASS_MAP from a JSON payload and persist to file.
+    Update CLASS_MAP from a full snapshot payload and persist to file.
+    The in-memory swap is immediate; the file is written in the background
+    by _config_writer (coalesced, atomic, skipped if unchanged).
     
     Payload format:
     {
+      "version": 7,    (optional; the revision patches must build on)
       "classes": [
         {"id": 0, "name": "Class Name", "aliases": ["alias1", "alias2"]},
         ...
       ]
     }
     """
-    global _class_map
+    global _class_map, _class_map_version, _class_map_revision
     try:
         classes = json_payload.get("classes", [])
+        new_map = build_classmap(classes)
         with _class_map_lock:
-            _class_map = build_classmap(classes)
-        
-        # Persist to disk
-        with CLASS_CONFIG_PATH.open("w", encoding="utf-8") as f:
-            json.dump(json_payload, f, indent=2)
+            _class_map = new_map
+            _class_map_version = classmap_hash(new_map)
+            _class_map_revision = revision = json_payload.get("version", 0)
+
+        # The snapshot supersedes any journaled patches, but only once it is
+        # on disk: until then the old file + journal is what a restart loads
+        _config_writer.schedule(json_payload, on_written=lambda: _clear_journal_at(revision))
             
-        if DEBUG:
-            print(f"[config] updated and persisted CLASS_MAP with {len(_class_map)} classes")
-            print(f"[config] classes: {list(_class_map.keys())}")
+        _log.debug("updated CLASS_MAP with %s classes", len(_class_map))
+        _log.debug("classes: %s", list(_class_map.keys()))
     except Exception as e:
-        if DEBUG:
-            print(f"[config] failed to update/persist CLASS_MAP: {e}")
+        _log.warning("failed to update/persist CLASS_MAP: %s", e)
+
+
+class _ConfigWriter:
+    """
+    Persists class_config.json on a background thread. Writes requested
+    within CLASS_CONFIG_WRITE_DELAY of each other are coalesced (only the
+    latest payload is written), a payload whose canonical content hash
+    matches the file is skipped, and the file is replaced atomically (temp
+    file, fsync, rename) so a crash never leaves a truncated config.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending = None    # (payload, on_written) waiting to be written
+        self._due = 0.0
+        self._thread = None
+        self._last_hash = None  # content hash of the file on disk
+
+    @staticmethod
+    def _content_hash(payload) -> str:
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def schedule(self, payload: dict, on_written=None):
+        """Write payload after CLASS_CONFIG_WRITE_DELAY unless a newer one replaces it first."""
+        with self._cond:
+            self._pending = (payload, on_written)
+            self._due = time.monotonic() + CLASS_CONFIG_WRITE_DELAY
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="config-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """Write the pending payload now (at exit, or before reading the file back)."""
+        with self._cond:
+            item, self._pending = self._pending, None
+        if item is not None:
+            self._write(*item)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None or time.monotonic() < self._due:
+                    if self._pending is None:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(self._due - time.monotonic())
+                item, self._pending = self._pending, None
+            self._write(*item)
+
+    def _write(self, payload: dict, on_written=None):
+        path = CLASS_CONFIG_PATH
+        try:
+            with self._write_lock:
+                digest = self._content_hash(payload)
+                if self._last_hash is None and path.exists():
+                    try:
+                        self._last_hash = self._content_hash(load_class_config_data(path))
+                    except ValueError:
+                        pass  # unreadable file: rewrite it
+                if digest == self._last_hash:
+                    _log.debug("%s already up to date, write skipped", path)
+                else:
+                    tmp = path.with_name(path.name + ".tmp")
+                    with tmp.open("w", encoding="utf-8") as f:
+                        json.dump(payload, f, indent=2)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, path)
+                    try:
+                        dir_fd = os.open(path.parent, os.O_RDONLY)
+                        try:
+                            os.fsync(dir_fd)   # make the rename itself durable
+                        finally:
+                            os.close(dir_fd)
+                    except OSError:
+                        pass  # platforms without directory fsync
+                    self._last_hash = digest
+                    _log.debug("persisted %s classes to %s", len(payload.get('classes', [])), path)
+            if on_written is not None:
+                on_written()
+        except Exception as e:
+            _log.warning("failed to persist class config: %s", e)
+
+
+_config_writer = _ConfigWriter()
+atexit.register(_config_writer.flush)
+
+
+def _clear_journal_at(revision):
+    """Drop the journal after a snapshot (received or compacted) landed, unless patches arrived since."""
+    global _journal_entries
+    with _class_map_lock:
+        if _class_map_revision == revision:
+            CLASS_CONFIG_JOURNAL_PATH.unlink(missing_ok=True)
+            _journal_entries = 0
+
+
+def _apply_ops(classmap: dict, ops: list):
+    """
+    Apply patch ops to a copy of classmap. Returns (new map, {name: (old
+    entry or None, new entry or None)} for every class touched), or
+    (None, None) if an op is malformed or does not fit the map.
+    """
+    new_map = dict(classmap)
+    changes = {}
+
+    def touch(name):
+        if name not in changes:
+            changes[name] = (classmap.get(name), None)
+
+    for op in ops:
+        kind = op.get("op")
+        if kind == "add":
+            cls = op.get("class") or {}
+            name, cid = cls.get("name"), cls.get("id")
+            if name is None or cid is None:
+                return None, None
+            touch(name)
+            new_map[name] = {"id": cid, "aliases": list(cls.get("aliases", []))}
+        elif kind == "remove":
+            name = op.get("name")
+            if name not in new_map:
+                return None, None
+            touch(name)
+            del new_map[name]
+        elif kind == "alias":
+            name = op.get("name")
+            if name not in new_map:
+                return None, None
+            touch(name)
+            removed = {a.lower() for a in op.get("remove", [])}
+            aliases = [a for a in new_map[name].get("aliases", []) if a.lower() not in removed]
+            aliases += [a for a in op.get("add", []) if a not in aliases]
+            new_map[name] = dict(new_map[name], aliases=aliases)
+        else:
+            return None, None
+
+    return new_map, {name: (old, new_map.get(name)) for name, (old, _) in changes.items()}
+
+
+def apply_classmap_patch(patch: dict):
+    """
+    Apply a versioned class-map patch (see module docstring) in memory and
+    append it to the journal. Returns {name: (old entry, new entry)} for the
+    classes it touched (None = absent), or None if the patch was rejected
+    (base_version mismatch or an invalid op) and a full snapshot is needed.
+    """
+    global _class_map, _class_map_version, _class_map_revision, _journal_entries
+    with _class_map_lock:
+        if patch.get("base_version") != _class_map_revision or "version" not in patch:
+            _log.debug("patch %s→%s does not apply to version %s, need a snapshot",
+                       patch.get('base_version'), patch.get('version'), _class_map_revision)
+            return None
+        new_map, changes = _apply_ops(_class_map, patch.get("ops", []))
+        if new_map is None:
+            _log.debug("invalid patch ops, need a snapshot: %s", patch.get('ops'))
+            return None
+
+        _class_map = new_map
+        _class_map_version = classmap_hash(new_map)
+        _class_map_revision = patch["version"]
+
+        try:
+            with CLASS_CONFIG_JOURNAL_PATH.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(patch, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            _journal_entries += 1
+            if _journal_entries >= CLASS_CONFIG_JOURNAL_MAX:
+                # Fold the journal into a fresh snapshot; drop it once that is on disk
+                revision = _class_map_revision
+                _config_writer.schedule({"version": revision, "classes": classmap_to_classes(_class_map)},
+                                        on_written=lambda: _clear_journal_at(revision))
+        except OSError as e:
+            _log.warning("failed to journal class-map patch: %s", e)
+
+    _log.debug("applied patch → version %s: %s classes changed, %s total",
+               patch['version'], len(changes), len(_class_map))
+    return changes
 
 
 # Initialize on import
@@ -147,6 +431,7 @@ CLASS_MAP = _class_map
 # ===========================
 USE_LLM_FRAMING = False  # Set to True to use AWS Bedrock (Claude 3 Haiku) for intelligent intent framing
 BEDROCK_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+BEDROCK_PROMPT_CACHING = False  # Mark the static system prompt cacheable (only for Bedrock models that support it)
 
 # ===========================
 # OpenAI RAG Configuration
@@ -156,7 +441,48 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 OPENAI_MODEL = "gpt-4o-mini"               # Chat model for classification
 OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"  # Embedding model for retrieval
 RAG_KNOWLEDGE_BASE_PATH = Path("TrackTech announcements structure.txt")
+RAG_EMBEDDING_CACHE_PATH = Path("kb_embeddings.npz")  # Chunk embeddings keyed by model + chunk texts; None disables
 RAG_TOP_K = 3               # Number of knowledge base chunks to retrieve per query
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None  # OpenAI-compatible endpoint override (e.g. a local mock server)
+RAG_BATCH_ENABLED = False   # Micro-batch concurrent RAG calls into one embeddings + one chat request
+RAG_BATCH_WINDOW_MS = 150   # Max wait for more transcripts after the first one of a batch arrives
+RAG_BATCH_MAX_SIZE = 8      # Max transcripts per batched request
+RAG_STREAMING = True        # Stream the chat response and act on each class/intent as soon as it parses
+
+# ===========================
+# Track Scoping Configuration
+# ===========================
+TRACK_SCOPE_ENABLED = True   # Narrow RAG retrieval + class matching to the active event's track
+TRACK_SCOPE_MIN_MATCH = 0.5  # Min token match (0-1) for event_id → track / event family resolution
+
+# ===========================
+# LLM Prompt Pruning Configuration
+# ===========================
+LLM_CANDIDATE_TOP_N = 8       # Max candidate classes listed in RAG/Bedrock prompts (0 = full catalogue)
+LLM_CANDIDATE_MIN_SCORE = 60  # Min local match score (0-100) for a class to be a candidate
+
+# ===========================
+# Confidence-Gated LLM Escalation
+# ===========================
+LOCAL_ACCEPT_CONFIDENCE = 0.8  # Answer locally (no LLM call) at or above this confidence (0-1)
+LOCAL_ESCALATE_MIN_SCORE = 70  # With no class detected, escalate only if a candidate scores this (0-100), else drop
+
+# ===========================
+# Speculative LLM Execution
+# ===========================
+LLM_DEADLINE_SECONDS = 1.5         # Max wait for RAG/Bedrock before the local result is emitted
+SPECULATIVE_EMIT_CONFIDENCE = 0.75 # Escalated transcripts at/above this emit the local result immediately
+LLM_MAX_WORKERS = 4                # Concurrent LLM pipelines (late results keep running after the deadline)
+
+# ===========================
+# LLM Circuit Breakers (per backend: RAG, Bedrock)
+# ===========================
+LLM_REQUEST_TIMEOUT = 5.0          # Per-request timeout for OpenAI / Bedrock calls (seconds, no client retries)
+BREAKER_WINDOW_SECONDS = 60        # Rolling window of call outcomes per backend
+BREAKER_MIN_CALLS = 3              # Calls needed in the window before a breaker can open
+BREAKER_FAILURE_RATIO = 0.5        # Open when this fraction of windowed calls failed or were slow
+BREAKER_SLOW_CALL_SECONDS = 3.0    # Calls slower than this count as failures
+BREAKER_OPEN_SECONDS = 30          # Time a breaker stays open before a half-open probe is let through
 
 # ===========================
 # Intent Patterns (Fallback if LLM is disabled)
@@ -209,9 +535,29 @@ INTENT_PATTERNS = {
 # Delivery Configuration
 # ===========================
 PUSH_ENDPOINT = "https://YOUR_BACKEND/notify"
+PUSH_BATCH_ENDPOINT = None  # e.g. "https://YOUR_BACKEND/notify/batch", takes {"messages": [...]}; None = one POST per message
+HTTP_TIMEOUT = 3.0  # Seconds per delivery POST
+HTTP_MAX_CONCURRENCY = 4  # Delivery POSTs in flight at once (= pooled keep-alive connections)
+HTTP_GZIP_MIN_BYTES = 4096  # Batch bodies larger than this are sent gzip-compressed
 DEBOUNCE_SECONDS = 180
 DEDUP_WINDOW_MS = 5000  # Utterance-level deduplication window in milliseconds
+DEBOUNCE_MAX_ENTRIES = 20000  # Hard cap on remembered class+intent pairs (raised to classes x intents); the oldest is evicted past it
+DEDUP_MAX_ENTRIES = 5000  # Hard cap on remembered utterance results
 QUEUE_DB = "outbox.db"
+OUTBOX_BATCH_SIZE = 50  # Queued messages sent (and acked in one transaction) per outbox flush
+OUTBOX_DRAIN_INTERVAL = 5.0  # Seconds between outbox drain passes when no enqueue wakes the drainer
+OUTBOX_RETRY_BASE = 1.0  # First retry delay after a failed drain (doubles per failure, jittered)
+OUTBOX_RETRY_MAX = 60.0  # Cap on the drain retry delay
+OUTBOX_RETENTION_HOURS = 24  # Sent outbox rows older than this are deleted
+OUTBOX_MAX_BYTES = 50 * 1024 * 1024  # Size cap for the outbox file; beyond it stale unsent rows are dropped
+OUTBOX_DROP_ORDER = ["CLASS_TO_LANES", "CLASS_STANDBY", "GENERAL_ANNOUNCEMENT"]  # Unsent intents dropped first over the cap
+OUTBOX_MAINTENANCE_INTERVAL = 600  # Seconds between outbox retention / vacuum passes
+OUTBOX_TTL_SECONDS = {  # Queued messages older than this are never delivered (intents not listed never expire)
+    "CLASS_TO_LANES": 600,
+    "CLASS_STANDBY": 1200,
+    "GENERAL_ANNOUNCEMENT": 3600,
+}
+OUTBOX_SUPERSEDE_INTENTS = ["CLASS_TO_LANES", "CLASS_STANDBY"]  # A newer queued message replaces older unsent ones with the same class+intent
 
 # ===========================
 # MQTT Configuration
@@ -224,6 +570,12 @@ MQTT_CONFIG_REQUEST_TOPIC = "racetrack/config/request"  # Topic to request updat
 MQTT_USERNAME = None  # set if broker requires auth
 MQTT_PASSWORD = None
 MQTT_QOS = 1  # QoS 0, 1, or 2
+MQTT_INFLIGHT_WINDOW = 20  # Unacknowledged publishes in flight at once while draining the outbox
+MQTT_ACK_TIMEOUT = 10.0  # Seconds without a PUBACK before a publish counts as failed
+MQTT_BATCH_PUBLISH = False  # One publish per utterance carrying all its classes, on MQTT_TOPIC + "/batch/<encoding>"
+MQTT_BATCH_ENCODING = "jsonz"  # Batched payloads: "msgpack" (needs msgpack), "jsonz" (zlib-compressed JSON) or "json"
+MQTT_ASYNC = True  # Drive paho from the asyncio loop (mqtt_async) instead of its own network thread
+MQTT_SEND_QUEUE_SIZE = 200  # Publishes waiting for the async sender before publish_many waits for space
 
 DELIVERY_MODE = "MQTT"  # or "HTTP"
 
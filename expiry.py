@@ -0,0 +1,81 @@
+"""
+expiry.py - Fixed-window "seen recently" sets with O(1) expiry and a hard cap
+
+classifier's debounce (DEBOUNCE_SECONDS per class id+intent) and utterance
+dedup (DEDUP_WINDOW_MS per class id set+intent) both ask "was this key
+recorded less than `window` seconds ago, and if not, record it now".
+
+With one fixed window per set, keys expire in the order they were recorded,
+so an insertion-ordered dict is the whole timing structure: expiry pops
+from the front until it reaches a key that is still live, which is O(1)
+amortized per call instead of a scan of every entry. Past max_entries the
+oldest key is evicted early (counted in `evicted`), so a multi-day event
+with many classes cannot grow the set without bound. Every key left after
+expiry is still live, so an eviction forgets a key that should still be
+suppressed: it is logged as a warning, at most once per window.
+
+Times are time.monotonic(), so NTP steps (e.g. the Pi syncing its clock
+after boot) do not stretch or cut short a window.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from log import get_logger
+
+log = get_logger("expiry")
+
+
+class ExpiryWindow:
+    """Keys remembered for `window` seconds, oldest first, at most max_entries of them."""
+
+    def __init__(self, window, max_entries, name="expiry"):
+        self.window = window
+        self.max_entries = max_entries
+        self.name = name
+        self.evicted = 0
+        self._seen = OrderedDict()   # key → monotonic time recorded, oldest first
+        self._lock = threading.Lock()
+        self._warned_at = None       # time of the last eviction warning
+        self._warned_evicted = 0     # evicted at that warning
+
+    def _expire(self, now):
+        """Drop keys recorded at or before now - window; callers hold _lock."""
+        cutoff = now - self.window
+        seen = self._seen
+        while seen:
+            key = next(iter(seen))
+            if seen[key] > cutoff:
+                break
+            del seen[key]
+
+    def check_and_set(self, key, now=None) -> bool:
+        """
+        True if key was recorded within the window (the caller suppresses it;
+        the window is not extended). Otherwise records key at `now` and
+        returns False.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self.evicted += 1
+                if self._warned_at is None or now - self._warned_at >= self.window:
+                    log.warning("%s: over %s entries, evicted %s live key(s) early",
+                                self.name, self.max_entries, self.evicted - self._warned_evicted)
+                    self._warned_at, self._warned_evicted = now, self.evicted
+            return False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
@@ -0,0 +1,144 @@
+"""
+log.py - Queue-backed, structured logging for the pipeline
+
+Modules log through get_logger("<subsystem>"), a logger named
+"asr.<subsystem>" after the "[tag]" prefixes the old DEBUG prints used
+(mic, transcribe, classifier, rag, mqtt, outbox, ...). The calling thread
+only formats the message and puts the record on an in-memory queue; a
+QueueListener thread writes it out, so a slow serial console or journald
+can no longer stall the PortAudio callback or the event loop.
+
+  LOG_LEVEL / LOG_LEVELS   default and per-subsystem levels
+  LOG_FORMAT               "text" ("[subsystem] message", like the prints)
+                           or "json" (one object per line)
+  LOG_RATE_LIMIT           records per second from any one log call below
+                           WARNING; the excess is dropped and counted, and the
+                           count is reported with the next record let through
+
+Pass structured fields with extra={"fields": {...}}; JSON output includes them,
+along with context fields registered through add_context_fields (tracing adds
+the current utterance's trace_id and trace_ms). Those are read in the thread
+that logs, since the listener thread runs outside the caller's context.
+The listener starts on import and is flushed at exit.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Attach the queue before importing config, so config's own import-time
+# records are kept until the listener starts below
+_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_queue)
+_root = logging.getLogger("asr")
+_root.addHandler(_queue_handler)
+_root.setLevel(logging.DEBUG)
+_root.propagate = False
+
+import config  # noqa: E402
+
+
+_context_getters = []   # fn() → {field: value} or None, called for every record let through
+
+
+def get_logger(subsystem) -> logging.Logger:
+    """Logger for one subsystem ("asr.<subsystem>"), with its LOG_LEVELS level."""
+    return logging.getLogger(f"asr.{subsystem}")
+
+
+def add_context_fields(fn):
+    """Add fn()'s fields (a dict, or None for none) to every record, read in the logging thread."""
+    _context_getters.append(fn)
+
+
+class _RateLimitFilter(logging.Filter):
+    """Let at most LOG_RATE_LIMIT records per second through from each call site."""
+
+    def __init__(self, per_second):
+        super().__init__()
+        self._per_second = per_second
+        self._sites = {}   # (pathname, lineno) → [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= 1.0:
+                suppressed = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+            elif site[1] < self._per_second:
+                site[1] += 1
+                suppressed = 0
+            else:
+                site[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _ContextFilter(logging.Filter):
+    """Stamp records with the add_context_fields fields while still in the caller's thread."""
+
+    def filter(self, record):
+        for fn in _context_getters:
+            fields = fn()
+            if fields:
+                record.context = dict(getattr(record, "context", None) or {}, **fields)
+        return True
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        subsystem = record.name[4:] if record.name.startswith("asr.") else record.name
+        level = "" if record.levelno < logging.WARNING else f"{record.levelname}: "
+        text = f"[{subsystem}] {level}{record.getMessage()}"
+        if getattr(record, "suppressed", 0):
+            text += f" ({record.suppressed} similar suppressed)"
+        return text
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "subsystem": record.name[4:] if record.name.startswith("asr.") else record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if getattr(record, "context", None):
+            entry.update(record.context)
+        if getattr(record, "fields", None):
+            entry.update(record.fields)
+        return json.dumps(entry, default=str)
+
+
+def _configure():
+    level = config.LOG_LEVEL or ("DEBUG" if config.DEBUG else "INFO")
+    _root.setLevel(level)
+    for subsystem, sub_level in config.LOG_LEVELS.items():
+        get_logger(subsystem).setLevel(sub_level)
+    if config.LOG_RATE_LIMIT:
+        _queue_handler.addFilter(_RateLimitFilter(config.LOG_RATE_LIMIT))
+    _queue_handler.addFilter(_ContextFilter())   # after the rate limit: only for records kept
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_JsonFormatter() if config.LOG_FORMAT == "json" else _TextFormatter())
+    listener = QueueListener(_queue, handler, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+_configure()
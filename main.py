@@ -6,90 +6,178 @@ when messages arrive on racetrack/config/classes topic.
 """
 
 import asyncio
+import contextvars
 import signal
-from transcribe_ws import stream_audio
-from classifier import build_messages
-from config import DEBUG, DELIVERY_MODE
+import time
+from log import get_logger  # first: queues config's import-time records
+from config import (
+    DELIVERY_MODE, QUEUE_DB, MQTT_ASYNC, TRACING_ENABLED, PROFILE_SIGNAL, PROFILE_ON_START
+)
+from outbox import OutboxDrainer, get_outbox
+from tracing import span, format_trace_stats
+from metrics import register_collector, start_metrics, stop_metrics
+from profiler import start_profile, stop_profile
 
 if DELIVERY_MODE == "HTTP":
-    from queue_sender import init_db, queue_payload, flush_outbox, send_now
+    from queue_sender import init_db, queue_payloads, send_now, send_batch as send_many, close_session
+    SEND_BLOCKING = True   # requests.post: run sends in an executor
+elif DELIVERY_MODE == "MQTT" and MQTT_ASYNC:
+    from mqtt_sender import init_db, queue_payloads
+    from mqtt_async import AsyncMqttClient
+    SEND_BLOCKING = False  # publishes are awaited on the event loop
+    send_now = send_many = None  # bound to the AsyncMqttClient in main()
 elif DELIVERY_MODE == "MQTT":
-    from mqtt_sender import init_db, init_mqtt, queue_payload, flush_outbox, send_now
+    from mqtt_sender import init_db, init_mqtt, queue_payloads, send_now, publish_batch as send_many
+    SEND_BLOCKING = True   # send_now waits for the broker's PUBACK
 else:
     raise ValueError("Unknown DELIVERY_MODE in config.py")
 
+drainer = None  # OutboxDrainer, created in main()
+mqtt_client = None  # AsyncMqttClient with MQTT_ASYNC, created in main()
+classifier_ready = None  # future → build_messages once the alias map is built
+_pending = set()  # transcript tasks still classifying / delivering
+
+_t_start = time.perf_counter()
+
+log = get_logger("main")
+transcript_log = get_logger("transcript")
+
+
+def _warm_up():
+    """
+    Staged startup, off the event loop: import the classifier stack and
+    build its indexes (classifier.warm_up) while delivery connects and the
+    Transcribe websocket opens. Ready once the alias map is built; the KB
+    embeddings finish in the background, and an escalation that arrives
+    before them waits on the KB lock.
+    """
+    import classifier
+    classifier.warm_up(background=True)
+    log.debug("classifier ready at +%.0f ms", (time.perf_counter() - _t_start) * 1000)
+    return classifier.build_messages
+
 
 async def on_transcript(text, ts_iso):
-    """Process a transcribed text."""
-    if DEBUG:
-        print("[transcript]", text)
+    """
+    Hand a transcribed text to its own task and return, so the websocket
+    reader keeps reading while earlier transcripts are still classified.
+    """
+    transcript_log.debug("%s", text)
+    # create_task copies the context, so the utterance's trace goes along
+    task = asyncio.create_task(_process_transcript(text, ts_iso))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def _process_transcript(text, ts_iso):
+    """Classify off the event loop and deliver the messages."""
+    loop = asyncio.get_running_loop()
     
-    messages = build_messages(text, ts_iso)
+    def on_late(late_messages):
+        # LLM upgrades arrive on a worker thread; deliver them on the event loop
+        asyncio.run_coroutine_threadsafe(drainer.deliver(late_messages), loop)
     
-    for m in messages:
-        try:
-            flush_outbox()
-            send_now(m)
-            if DEBUG:
-                print("[sent]", m)
-        except Exception as e:
-            if DEBUG:
-                print("[queueing]", e)
-            queue_payload(m)
+    try:
+        # Only the first transcript can arrive before warm-up finishes
+        build_messages = await classifier_ready
+        # build_messages blocks for up to LLM_DEADLINE_SECONDS on escalated
+        # transcripts; in an executor the mic sender, the websocket reader and
+        # delivery keep running meanwhile
+        with span("classify"):
+            messages = await loop.run_in_executor(
+                None, contextvars.copy_context().run, build_messages, text, ts_iso, on_late
+            )
+        if messages:
+            await drainer.deliver(messages)
+    except Exception as e:
+        log.warning("processing transcript %r failed: %s", text, e)
 
 
 async def main():
     """Main async entry point."""
+    global drainer, mqtt_client, classifier_ready
+    
+    classifier_ready = asyncio.get_running_loop().run_in_executor(None, _warm_up)
+    
     init_db()
     
-    if DELIVERY_MODE == "MQTT":
+    send, send_batch = send_now, send_many
+    if DELIVERY_MODE == "MQTT" and MQTT_ASYNC:
+        mqtt_client = AsyncMqttClient()
+        await mqtt_client.start()
+        send, send_batch = mqtt_client.send, mqtt_client.publish_many
+    elif DELIVERY_MODE == "MQTT":
         init_mqtt()
     
-    flush_outbox()
+    # Backlog from a previous run drains in the background
+    outbox = get_outbox(QUEUE_DB)
+    drainer = OutboxDrainer(outbox, send, queue_payloads,
+                            blocking=SEND_BLOCKING, send_many=send_batch)
+    drainer.start()
+    
+    register_collector(outbox.metric_samples)
+    if mqtt_client is not None:
+        register_collector(mqtt_client.metric_samples)
+    start_metrics()
     
     # Create a task for the audio streaming
+    from transcribe_ws import stream_audio  # aiohttp + numpy, imported while warm-up runs
     audio_task = asyncio.create_task(stream_audio(on_transcript))
     
     # Graceful shutdown handler
     stop_event = asyncio.Event()
     
     def shutdown_signal():
-        if DEBUG:
-            print("[main] shutdown signal received")
+        log.debug("shutdown signal received")
         stop_event.set()
     
-    # Set up signal handlers for graceful shutdown
-    if hasattr(signal, 'SIGINT'):
-        signal.signal(signal.SIGINT, lambda s, f: shutdown_signal())
-    if hasattr(signal, 'SIGTERM'):
-        signal.signal(signal.SIGTERM, lambda s, f: shutdown_signal())
+    # Signal handlers run as event loop callbacks, not between bytecodes of
+    # whatever the main thread was doing
+    loop = asyncio.get_running_loop()
+    for name in ('SIGINT', 'SIGTERM'):
+        if hasattr(signal, name):
+            loop.add_signal_handler(getattr(signal, name), shutdown_signal)
+    
+    # On-demand profiling of the live pipeline: kill -USR1 <pid>
+    if PROFILE_SIGNAL and hasattr(signal, PROFILE_SIGNAL):
+        loop.add_signal_handler(getattr(signal, PROFILE_SIGNAL), start_profile)
+    if PROFILE_ON_START:
+        start_profile()
     
     try:
         # Wait until a shutdown signal
         await stop_event.wait()
     except KeyboardInterrupt:
-        if DEBUG:
-            print("[main] KeyboardInterrupt received")
+        log.debug("KeyboardInterrupt received")
         shutdown_signal()
     
-    if DEBUG:
-        print("[main] cancelling audio task...")
+    log.debug("cancelling audio task...")
     
     audio_task.cancel()
     
     try:
         await audio_task
     except asyncio.CancelledError:
-        if DEBUG:
-            print("[main] audio task cancelled cleanly")
+        log.debug("audio task cancelled cleanly")
+    
+    if _pending:
+        await asyncio.gather(*_pending, return_exceptions=True)
+    await drainer.stop()
+    
+    if DELIVERY_MODE == "HTTP":
+        close_session()
+    elif mqtt_client is not None:
+        await mqtt_client.close()
     
-    if DEBUG:
-        print("[main] exiting")
+    stop_profile()
+    stop_metrics()
+    if TRACING_ENABLED:
+        log.debug("stage latencies (ms):\n%s", format_trace_stats())
+    log.debug("exiting")
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        if DEBUG:
-            print("[main] KeyboardInterrupt caught, exiting")
+        log.debug("KeyboardInterrupt caught, exiting")
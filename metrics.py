@@ -0,0 +1,181 @@
+"""
+metrics.py - Pipeline counters and gauges, served as Prometheus text or JSON
+
+Hot paths only bump counters: inc("asr_transcripts_total") is one dict
+update under a lock, cheap enough to leave on during races (unlike debug
+logging). Stats that modules already keep are read when the metrics
+are scraped, through collectors they register, instead of being mirrored:
+
+  classifier       gate decisions, circuit breaker states and counts
+  rag_classifier   chat latency to first result / completion
+  main             Outbox.stats (depth, oldest age, expired ...) and
+                   AsyncMqttClient.get_publish_stats
+  tracing          per-stage latency histograms (always included)
+
+Export: render_prometheus() (text exposition format), snapshot() (dict, for
+JSON). start_metrics() serves both on METRICS_BIND:METRICS_PORT (/metrics,
+/metrics.json) and, with METRICS_JSON_PATH, rewrites that file every
+METRICS_JSON_INTERVAL seconds.
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_PORT, METRICS_BIND, METRICS_JSON_PATH, METRICS_JSON_INTERVAL
+from tracing import get_trace_stats
+from log import get_logger
+
+log = get_logger("metrics")
+
+_counters = {}     # (name, ((label, value), ...)) → number
+_counters_lock = threading.Lock()
+_collectors = []   # fn() → [(name, {labels}, value), ...]
+
+
+# ===========================
+# Recording
+# ===========================
+def inc(name, value=1, **labels):
+    """Add value to a counter (created on first use)."""
+    key = (name, tuple(sorted(labels.items())))
+    with _counters_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def register_collector(fn):
+    """Register fn() → [(name, labels dict, value)], called on every scrape."""
+    _collectors.append(fn)
+
+
+def _samples():
+    """All (name, labels dict, value) samples: counters, collectors, then stage histograms."""
+    with _counters_lock:
+        samples = [(name, dict(labels), value) for (name, labels), value in _counters.items()]
+    for fn in list(_collectors):
+        try:
+            samples.extend(fn())
+        except Exception as e:
+            log.warning("collector %s failed: %s", getattr(fn, '__qualname__', fn), e)
+    return samples
+
+
+# ===========================
+# Export
+# ===========================
+def _labels_text(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus() -> str:
+    """Prometheus text format; *_total samples are counters, the rest gauges."""
+    by_name = {}
+    for name, labels, value in _samples():
+        if value is None:
+            continue
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in by_name[name]:
+            lines.append(f"{name}{_labels_text(labels)} {float(value):g}")
+
+    lines.append("# TYPE asr_stage_seconds histogram")
+    for stage, hist in sorted(get_trace_stats().items()):
+        cumulative = 0
+        for bound, n in hist["buckets"].items():
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'asr_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'asr_stage_seconds_sum{{stage="{stage}"}} {hist["mean"] * hist["count"]:g}')
+        lines.append(f'asr_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """{"time", "metrics": {name: [{"labels", "value"}]}, "stages": {stage: summary}}."""
+    metrics = {}
+    for name, labels, value in _samples():
+        metrics.setdefault(name, []).append({"labels": labels, "value": value})
+    stages = {stage: {k: v for k, v in hist.items() if k != "buckets"}
+              for stage, hist in get_trace_stats().items()}
+    return {"time": time.time(), "metrics": metrics, "stages": stages}
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, ctype = render_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, ctype = json.dumps(snapshot()).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _write_json(path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _json_writer(stop):
+    while not stop.wait(METRICS_JSON_INTERVAL):
+        try:
+            _write_json(METRICS_JSON_PATH)
+        except Exception as e:
+            log.warning("could not write %s: %s", METRICS_JSON_PATH, e)
+
+
+_server = None
+_stop = threading.Event()
+
+
+def start_metrics():
+    """Start the HTTP endpoint and / or the JSON dump thread, as configured."""
+    global _server
+    if METRICS_PORT is not None and _server is None:
+        try:
+            _server = ThreadingHTTPServer((METRICS_BIND, METRICS_PORT), _MetricsHandler)
+        except OSError as e:
+            log.warning("cannot listen on %s:%s: %s", METRICS_BIND, METRICS_PORT, e)
+        else:
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            log.debug("serving http://%s:%s/metrics", METRICS_BIND, METRICS_PORT)
+    if METRICS_JSON_PATH:
+        threading.Thread(target=_json_writer, args=(_stop,), name="metrics-json", daemon=True).start()
+
+
+def stop_metrics():
+    """Stop serving; writes a final JSON dump if one is configured."""
+    global _server
+    _stop.set()
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if METRICS_JSON_PATH:
+        try:
+            _write_json(METRICS_JSON_PATH)
+        except Exception as e:
+            log.warning("could not write %s: %s", METRICS_JSON_PATH, e)
@@ -0,0 +1,325 @@
+"""
+mqtt_async.py - paho MQTT client driven by the asyncio event loop
+
+mqtt_sender runs paho on its own network thread (loop_start), so callbacks
+mutate shared state from that thread, and sends block a worker thread until
+the PUBACK arrives. AsyncMqttClient instead registers the client's socket
+with the event loop (paho's on_socket_* hooks: add_reader / add_writer, plus
+a once-a-second loop_misc for keepalive), so every callback runs on the loop
+thread:
+
+  - publish_many / send are awaitable and resolve on the broker's PUBACK
+  - publishes go through a bounded queue (MQTT_SEND_QUEUE_SIZE) to a single
+    sender task, which keeps at most MQTT_INFLIGHT_WINDOW unacknowledged
+  - event_id changes apply on the loop at once; track scoping and class
+    config updates (JSON parse, alias map rebuild or patch, journal) run
+    in a one-thread executor, in arrival order, off the loop; a rejected
+    patch requests a full snapshot
+  - a dropped connection is re-established from an executor with backoff;
+    publishes fail with ConnectionError until the broker's CONNACK, and
+    the unacknowledged ones fail when it drops (the caller still holds
+    them, so they are taken out of paho's replay queue rather than sent
+    twice)
+
+Message encoding (including MQTT_BATCH_PUBLISH) is shared with mqtt_sender.
+get_publish_stats() reports queue-to-PUBACK latency.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+import mqtt_sender
+from config import (
+    MQTT_CONFIG_TOPIC, MQTT_USERNAME, MQTT_PASSWORD, MQTT_QOS,
+    MQTT_INFLIGHT_WINDOW, MQTT_ACK_TIMEOUT, MQTT_SEND_QUEUE_SIZE
+)
+from track_scope import set_active_event
+from metrics import inc
+from log import get_logger
+
+log = get_logger("mqtt-async")
+
+_RECONNECT_MAX = 60.0  # seconds between reconnect attempts, at most
+
+
+class AsyncMqttClient:
+    """paho client whose socket I/O and callbacks run on the asyncio loop."""
+
+    def __init__(self):
+        self._loop = None
+        self._loop_thread = None
+        self._client = None
+        self._queue = None          # (unit, future, queued_at) awaiting publish
+        self._window = None         # semaphore: unacknowledged publishes
+        self._inflight = {}         # mid → (future, queued_at)
+        self._tasks = []
+        self._reconnect_task = None
+        self._connected = None      # set from CONNACK until the connection drops
+        self._closing = False
+        self._config_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mqtt-config")
+        self._stats = {"published": 0, "acked": 0, "failed": 0,
+                       "latency_total": 0.0, "latency_max": 0.0}
+
+    # ===========================
+    # Lifecycle
+    # ===========================
+    async def start(self):
+        """Connect to the broker and start the sender and housekeeping tasks."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._queue = asyncio.Queue(maxsize=MQTT_SEND_QUEUE_SIZE)
+        self._window = asyncio.Semaphore(MQTT_INFLIGHT_WINDOW)
+        self._connected = asyncio.Event()
+
+        client = mqtt.Client()
+        if MQTT_USERNAME:
+            client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        client.max_inflight_messages_set(MQTT_INFLIGHT_WINDOW)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.on_publish = self._on_publish
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._client = client
+
+        log.debug("connecting to %s:%s", mqtt_sender.MQTT_BROKER, mqtt_sender.MQTT_PORT)
+        try:
+            await self._loop.run_in_executor(
+                None, client.connect, mqtt_sender.MQTT_BROKER, mqtt_sender.MQTT_PORT, 60
+            )
+        except Exception as e:
+            log.warning("connect failed (%s), retrying in the background", e)
+            self._schedule_reconnect()
+
+        self._tasks = [self._loop.create_task(self._sender()),
+                       self._loop.create_task(self._misc())]
+
+    async def close(self):
+        """Disconnect and stop the background tasks; unsent publishes fail."""
+        self._closing = True
+        for task in self._tasks + [self._reconnect_task]:
+            if task is not None:
+                task.cancel()
+        if self._client is not None:
+            self._client.disconnect()
+        self._fail_pending(ConnectionError("MQTT client closed"))
+        self._config_executor.shutdown(wait=False)
+
+    # ===========================
+    # Socket integration (paho on_socket_* hooks)
+    # ===========================
+    def _on_loop(self, fn, *args):
+        """Run fn on the loop thread: now if already there, else scheduled."""
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._loop.add_reader, sock.fileno(), client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        fd = sock.fileno()
+        self._on_loop(self._loop.remove_reader, fd)
+        self._on_loop(self._loop.remove_writer, fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self._loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self._loop.remove_writer, sock.fileno())
+
+    async def _misc(self):
+        """Keepalive pings and timeouts (what paho's own loop does once a second)."""
+        while True:
+            await asyncio.sleep(1)
+            if self._client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                self._schedule_reconnect()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        mqtt_sender.on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            self._on_loop(self._connected.set)
+
+    def _on_disconnect(self, client, userdata, rc):
+        log.info("disconnected (rc=%s)", rc)
+        self._on_loop(self._connection_lost, rc)
+
+    def _connection_lost(self, rc):
+        self._connected.clear()
+        self._fail_inflight(ConnectionError(f"MQTT connection lost (rc={rc})"))
+        if not self._closing:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._closing or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """Reconnect with exponential backoff; the blocking TCP connect runs in an executor."""
+        delay = 1.0
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                await self._loop.run_in_executor(None, self._client.reconnect)
+                log.info("reconnected")
+                return
+            except Exception as e:
+                log.debug("reconnect failed: %s", e)
+                delay = min(_RECONNECT_MAX, delay * 2)
+
+    # ===========================
+    # Inbound messages
+    # ===========================
+    def _on_message(self, client, userdata, msg):
+        try:
+            payload_str = msg.payload.decode("utf-8").strip()
+        except UnicodeDecodeError as e:
+            log.warning("undecodable message on %s: %s", msg.topic, e)
+            return
+
+        if msg.topic == "racetrack/event":
+            # New messages carry the new event_id right away; scoping runs off the loop
+            mqtt_sender.event_id = payload_str
+            log.debug("event_id updated → %s", payload_str)
+            self._config_executor.submit(set_active_event, payload_str)
+        elif msg.topic == MQTT_CONFIG_TOPIC:
+            future = self._config_executor.submit(mqtt_sender.apply_config_update, payload_str)
+            future.add_done_callback(self._on_config_applied)
+
+    def _on_config_applied(self, future):
+        """A patch that did not fit our version: ask for a full snapshot (on the loop)."""
+        if not future.cancelled() and future.exception() is None and future.result() is False:
+            self._on_loop(mqtt_sender.request_config_snapshot, self._client)
+
+    # ===========================
+    # Publishing
+    # ===========================
+    async def publish_many(self, payloads, timeout=None):
+        """
+        Publish payloads in order and wait for their PUBACKs. Returns
+        (number delivered, error or None) like mqtt_sender.publish_batch;
+        waits for queue space when MQTT_SEND_QUEUE_SIZE publishes are queued.
+        """
+        timeout = MQTT_ACK_TIMEOUT if timeout is None else timeout
+        units = mqtt_sender._publish_units(payloads)
+        futures = []
+        for unit in units:
+            future = self._loop.create_future()
+            # Failures after an earlier one are not awaited; mark them retrieved
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            await self._queue.put((unit, future, time.monotonic()))
+            futures.append(future)
+
+        delivered = 0
+        for unit, future in zip(units, futures):
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                return delivered, TimeoutError(f"no PUBACK within {timeout}s")
+            except Exception as e:
+                return delivered, e
+            delivered += len(unit)
+        return delivered, None
+
+    async def send(self, payload):
+        """Publish one payload; raises unless the broker acknowledged it."""
+        _, error = await self.publish_many([payload])
+        if error is not None:
+            raise error
+
+    async def _sender(self):
+        """Publish queued units in order, keeping at most MQTT_INFLIGHT_WINDOW unacknowledged."""
+        while True:
+            unit, future, queued_at = await self._queue.get()
+            await self._window.acquire()
+            try:
+                if not self._connected.is_set():
+                    raise ConnectionError("MQTT not connected")
+                topic, data = mqtt_sender._encode(unit)
+                info = self._client.publish(topic, data, qos=MQTT_QOS)
+                if info.rc == mqtt.MQTT_ERR_NO_CONN:
+                    self._forget_in_paho([info.mid])
+                    raise ConnectionError("MQTT not connected")
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    raise RuntimeError(f"MQTT publish failed with code {info.rc}")
+            except Exception as e:
+                self._window.release()
+                self._stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self._stats["published"] += 1
+            self._inflight[info.mid] = (future, queued_at)
+            log.debug("published mid %s on %s: %s message(s), %s bytes",
+                      info.mid, topic, len(unit), len(data))
+
+    def _on_publish(self, client, userdata, mid):
+        entry = self._inflight.pop(mid, None)
+        if entry is None:
+            return   # not one of ours (e.g. the config request on connect)
+        future, queued_at = entry
+        inc("asr_mqtt_pubacks_total")
+        self._window.release()
+        latency = time.monotonic() - queued_at
+        self._stats["acked"] += 1
+        self._stats["latency_total"] += latency
+        self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+        if not future.done():
+            future.set_result(None)
+
+    def _forget_in_paho(self, mids):
+        """Drop publishes from paho's queue, which otherwise replays QoS 1 messages on reconnect."""
+        client = self._client
+        with client._out_message_mutex:
+            for mid in mids:
+                client._out_messages.pop(mid, None)
+
+    def _fail_inflight(self, error):
+        """Fail the unacknowledged publishes; their callers resend them."""
+        if not self._inflight:
+            return
+        self._forget_in_paho(list(self._inflight))
+        for future, _ in self._inflight.values():
+            self._window.release()
+            self._stats["failed"] += 1
+            if not future.done():
+                future.set_exception(error)
+        self._inflight.clear()
+
+    def _fail_pending(self, error):
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+        self._fail_inflight(error)
+
+    def metric_samples(self):
+        """Publish queue / in-flight gauges and PUBACK latency for metrics.py."""
+        stats = self.get_publish_stats()
+        return [("asr_mqtt_queued", {}, stats["queued"]),
+                ("asr_mqtt_inflight", {}, stats["inflight"]),
+                ("asr_mqtt_failed_total", {}, stats["failed"]),
+                ("asr_mqtt_ack_latency_avg_seconds", {}, stats["latency_avg"]),
+                ("asr_mqtt_ack_latency_max_seconds", {}, stats["latency_max"])]
+
+    def get_publish_stats(self) -> dict:
+        """Publish counters and queue-to-PUBACK latency (seconds)."""
+        acked = self._stats["acked"]
+        return {
+            "published": self._stats["published"],
+            "acked": acked,
+            "failed": self._stats["failed"],
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "inflight": len(self._inflight),
+            "latency_avg": self._stats["latency_total"] / acked if acked else 0.0,
+            "latency_max": self._stats["latency_max"],
+        }
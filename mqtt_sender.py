@@ -4,77 +4,163 @@ mqtt_sender.py - MQTT client with dynamic class config support
 This module now subscribes to two topics:
 1. racetrack/announcements - outbound announcements (existing)
 2. racetrack/config/classes - inbound class configuration updates
+
+A publish only counts as delivered once the broker acknowledges it
+(PUBACK for QoS 1, reported through on_publish with the message's mid), not
+when paho has merely queued it. Outbox rows are acked on that basis, and a
+backlog is drained with up to MQTT_INFLIGHT_WINDOW publishes pipelined.
+
+With MQTT_BATCH_PUBLISH, consecutive messages from the same utterance go
+out as one publish on MQTT_TOPIC/batch/<encoding>, so subscribers pick the
+format by topic. The envelope carries event_id, timestamp and transcription
+once, and a "messages" list with the per-class fields:
+    {"v": 1, "event_id": ..., "timestamp": ..., "transcription": ...,
+     "messages": [{"class_id": ..., "class_name": ..., "intent": ..., "message_text": ...}]}
+encoded as MessagePack ("msgpack"), zlib-compressed JSON ("jsonz") or JSON.
+JSON is serialized with orjson when it is installed.
 """
 
-import sqlite3
 import json
+import threading
 import time
+import zlib
 import paho.mqtt.client as mqtt
 from config import (
-    QUEUE_DB, MQTT_BROKER, MQTT_PORT, MQTT_TOPIC, MQTT_CONFIG_TOPIC,
+    QUEUE_DB, OUTBOX_BATCH_SIZE, MQTT_BROKER, MQTT_PORT, MQTT_TOPIC, MQTT_CONFIG_TOPIC,
     MQTT_CONFIG_REQUEST_TOPIC,
-    MQTT_USERNAME, MQTT_PASSWORD, MQTT_QOS, DEBUG
+    MQTT_USERNAME, MQTT_PASSWORD, MQTT_QOS, MQTT_INFLIGHT_WINDOW, MQTT_ACK_TIMEOUT,
+    MQTT_BATCH_PUBLISH, MQTT_BATCH_ENCODING
 )
-from config import update_classmap_from_json
-from classifier import rebuild_alias_map
+from config import update_classmap_from_json, apply_classmap_patch
+from track_scope import set_active_event
+from outbox import get_outbox
+from metrics import inc
+from log import get_logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = get_logger("mqtt")
+queue_log = get_logger("queue")
+outbox_log = get_logger("outbox")
 
 _client = None
 event_id = None  # global event_id, set from MQTT subscription
 
+# mid → monotonic time its PUBACK arrived. Keyed by mid, so bounded by the
+# 16-bit mid space; the time tells a fresh ack from one left over from an
+# earlier publish that reused the mid.
+_acked = {}
+_acked_cond = threading.Condition()
+
+# Set between CONNACK and the connection dropping. paho's is_connected()
+# keeps reporting True until its reconnect attempt starts.
+_connected = threading.Event()
+
 
 def on_connect(client, userdata, flags, rc):
     """Called when client connects to broker."""
-    if DEBUG:
-        print(f"[mqtt] connected with code {rc} to {MQTT_BROKER}:{MQTT_PORT}")
+    log.info("connected with code %s to %s:%s", rc, MQTT_BROKER, MQTT_PORT)
+    inc("asr_mqtt_connects_total")
+    if rc == 0:
+        _connected.set()
     
     # Subscribe to event updates
     client.subscribe("racetrack/event")
     
     # Subscribe to class config updates
     client.subscribe(MQTT_CONFIG_TOPIC)
-    if DEBUG:
-        print(f"[mqtt] subscribed to {MQTT_CONFIG_TOPIC}")
+    log.debug("subscribed to %s", MQTT_CONFIG_TOPIC)
     
     # Request latest config
     client.publish(MQTT_CONFIG_REQUEST_TOPIC, "GET", qos=MQTT_QOS)
-    if DEBUG:
-        print(f"[mqtt] requested latest config on {MQTT_CONFIG_REQUEST_TOPIC}")
+    log.debug("requested latest config on %s", MQTT_CONFIG_REQUEST_TOPIC)
 
 
-def on_message(client, userdata, msg):
-    """Called when a message is received on a subscribed topic."""
+def on_disconnect(client, userdata, rc):
+    """Called when the connection drops (or disconnect() completes)."""
+    _connected.clear()
+    if rc != 0:
+        log.warning("disconnected from %s:%s (code %s), reconnecting", MQTT_BROKER, MQTT_PORT, rc)
+
+
+def apply_event_update(new_event_id):
+    """Switch to a new event_id and scope retrieval + class matching to its track."""
     global event_id
     
+    event_id = new_event_id
+    log.debug("event_id updated → %s", event_id)
+    set_active_event(event_id)
+
+
+def apply_config_update(payload_str) -> bool:
+    """
+    Apply a class config message: a full snapshot replaces the class map and
+    rebuilds the alias map; a versioned patch ("ops") updates both in place.
+    Returns False if the patch did not fit the current version and a full
+    snapshot should be requested.
+    """
+    log.debug("received config update on %s", MQTT_CONFIG_TOPIC)
+    
+    # The classifier stack is imported by main's warm-up, not at startup
+    from classifier import rebuild_alias_map, update_alias_map
+
+    try:
+        config_json = json.loads(payload_str)
+        if "ops" in config_json:
+            changes = apply_classmap_patch(config_json)
+            if changes is None:
+                return False
+            update_alias_map(changes)
+        else:
+            update_classmap_from_json(config_json)
+            rebuild_alias_map()
+        log.debug("class config updated successfully")
+    except json.JSONDecodeError as e:
+        log.warning("invalid JSON in config message: %s", e)
+    except Exception as e:
+        log.warning("error updating config: %s", e)
+    return True
+
+
+def request_config_snapshot(client):
+    """Ask the backend for the full class config (sent after a patch version mismatch)."""
+    client.publish(MQTT_CONFIG_REQUEST_TOPIC, "GET", qos=MQTT_QOS)
+    log.debug("requested full config on %s", MQTT_CONFIG_REQUEST_TOPIC)
+
+
+def on_message(client, userdata, msg):
+    """Called when a message is received on a subscribed topic."""
     try:
         payload_str = msg.payload.decode("utf-8").strip()
         
         # Handle event_id updates
         if msg.topic == "racetrack/event":
-            event_id = payload_str
-            if DEBUG:
-                print(f"[mqtt] event_id updated → {event_id}")
+            apply_event_update(payload_str)
         
         # Handle class config updates
         elif msg.topic == MQTT_CONFIG_TOPIC:
-            if DEBUG:
-                print(f"[mqtt] received config update on {MQTT_CONFIG_TOPIC}")
-            
-            try:
-                config_json = json.loads(payload_str)
-                update_classmap_from_json(config_json)
-                rebuild_alias_map()
-                if DEBUG:
-                    print("[mqtt] class config updated successfully")
-            except json.JSONDecodeError as e:
-                if DEBUG:
-                    print(f"[mqtt] invalid JSON in config message: {e}")
-            except Exception as e:
-                if DEBUG:
-                    print(f"[mqtt] error updating config: {e}")
+            if not apply_config_update(payload_str):
+                request_config_snapshot(client)
     
     except Exception as e:
-        if DEBUG:
-            print(f"[mqtt] error in on_message: {e}")
+        log.warning("error in on_message: %s", e)
+
+
+def on_publish(client, userdata, mid):
+    """Called by paho once the broker acknowledged a publish (PUBACK for QoS 1)."""
+    # Runs on the network thread while paho holds its message lock: only
+    # record the ack here, never call back into the client.
+    with _acked_cond:
+        _acked[mid] = time.monotonic()
+        _acked_cond.notify_all()
+    inc("asr_mqtt_pubacks_total")
 
 
 def init_mqtt():
@@ -87,87 +173,211 @@ def init_mqtt():
         _client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     
     _client.on_connect = on_connect
+    _client.on_disconnect = on_disconnect
     _client.on_message = on_message
+    _client.on_publish = on_publish
+    _client.max_inflight_messages_set(MQTT_INFLIGHT_WINDOW)
     
     _client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
     _client.loop_start()
     
-    if DEBUG:
-        print(f"[mqtt] connecting to {MQTT_BROKER}:{MQTT_PORT}")
+    log.debug("connecting to %s:%s", MQTT_BROKER, MQTT_PORT)
 
 
 def init_db():
     """Initialize SQLite outbox database."""
-    conn = sqlite3.connect(QUEUE_DB)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS outbox (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            payload TEXT,
-            created_at REAL,
-            sent INTEGER DEFAULT 0
-        )
-    """)
-    conn.commit()
-    conn.close()
+    get_outbox(QUEUE_DB)
 
 
 def queue_payload(payload):
     """Queue a payload to outbox for later delivery."""
+    queue_payloads([payload])
+
+
+def queue_payloads(payloads):
+    """Queue several payloads to outbox in one transaction."""
     global event_id
     
-    p = dict(payload)
-    p["event_id"] = event_id
+    batch = []
+    for payload in payloads:
+        p = dict(payload)
+        p["event_id"] = event_id
+        batch.append(p)
     
-    conn = sqlite3.connect(QUEUE_DB)
-    conn.execute(
-        "INSERT INTO outbox (payload, created_at, sent) VALUES (?, ?, 0)",
-        (json.dumps(p), time.time())
-    )
-    conn.commit()
-    conn.close()
+    get_outbox(QUEUE_DB).put_many(batch)
     
-    if DEBUG:
-        print(f"[queue] queued {len(json.dumps(p))} bytes")
+    queue_log.debug("queued %s message(s)", len(batch))
+
+
+# ===========================
+# Payload encoding
+# ===========================
+_SHARED_FIELDS = ("event_id", "timestamp", "transcription")  # sent once per batched publish
 
 
-def send_now(payload):
-    """Send payload immediately via MQTT."""
-    global _client, event_id
+def _pick_batch_encoding(encoding) -> str:
+    """The configured batch encoding, or jsonz if it needs msgpack and that is not installed."""
+    if MQTT_BATCH_PUBLISH and encoding == "msgpack" and msgpack is None:
+        log.warning("msgpack is not installed, batching with jsonz instead")
+        return "jsonz"
+    return encoding
+
+
+_batch_encoding = _pick_batch_encoding(MQTT_BATCH_ENCODING)
+
+
+def _dumps(obj) -> bytes:
+    """Compact JSON bytes, via orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _publish_units(payloads) -> list:
+    """
+    Split payloads into the groups that go out as one publish each: single
+    payloads, or with MQTT_BATCH_PUBLISH runs from the same utterance
+    (same transcription and timestamp), keeping order.
+    """
+    if not MQTT_BATCH_PUBLISH:
+        return [[p] for p in payloads]
+    units = []
+    for p in payloads:
+        if units and all(units[-1][0].get(k) == p.get(k) for k in ("transcription", "timestamp")):
+            units[-1].append(p)
+        else:
+            units.append([p])
+    return units
+
+
+def _encode(unit) -> tuple:
+    """(topic, payload bytes) for one publish unit from _publish_units."""
+    if not MQTT_BATCH_PUBLISH:
+        p = dict(unit[0])
+        p["event_id"] = event_id
+        return MQTT_TOPIC, _dumps(p)
+
+    first = unit[0]
+    envelope = {
+        "v": 1,
+        "event_id": event_id,
+        "timestamp": first.get("timestamp"),
+        "transcription": first.get("transcription"),
+        "messages": [{k: v for k, v in p.items() if k not in _SHARED_FIELDS} for p in unit],
+    }
+    if _batch_encoding == "msgpack":
+        data = msgpack.packb(envelope)
+    elif _batch_encoding == "jsonz":
+        data = zlib.compress(_dumps(envelope))
+    else:
+        data = _dumps(envelope)
+    return f"{MQTT_TOPIC}/batch/{_batch_encoding}", data
+
+
+def _publish(unit):
+    """Publish one unit; returns (mid, monotonic time just before publishing)."""
+    global _client
     
     if not _client:
         raise RuntimeError("MQTT not initialized")
-    
-    p = dict(payload)
-    p["event_id"] = event_id
-    
-    msg = json.dumps(p)
-    result = _client.publish(MQTT_TOPIC, msg, qos=MQTT_QOS)
-    
-    if result.rc != 0:
+    # While disconnected paho would keep a QoS 1 message and replay it on
+    # reconnect, so the outbox row would go out twice: leave it queued instead.
+    if not _connected.is_set():
+        raise ConnectionError("MQTT not connected")
+
+    topic, data = _encode(unit)
+    since = time.monotonic()
+    result = _client.publish(topic, data, qos=MQTT_QOS)
+
+    if result.rc == mqtt.MQTT_ERR_NO_CONN and MQTT_QOS > 0:
+        # Dropped between the check and the publish: paho owns the message
+        # now and replays it under the same mid, so wait for that PUBACK.
+        log.debug("mid %s queued in paho until reconnect", result.mid)
+    elif result.rc != 0:
         raise RuntimeError(f"MQTT publish failed with code {result.rc}")
     
-    if DEBUG:
-        print(f"[mqtt] published on {MQTT_TOPIC}: {msg[:100]}...")
+    log.debug("published mid %s on %s: %s message(s), %s bytes",
+              result.mid, topic, len(unit), len(data))
+    return result.mid, since
+
+
+def _take_ack_locked(mid, since) -> bool:
+    """True (and forget the ack) if mid was acknowledged after since. Caller holds _acked_cond."""
+    acked_at = _acked.get(mid)
+    if acked_at is None or acked_at < since:
+        return False
+    del _acked[mid]
+    return True
+
+
+def send_now(payload, timeout=None):
+    """Publish payload and block until the broker acknowledges it (MQTT_ACK_TIMEOUT by default)."""
+    timeout = MQTT_ACK_TIMEOUT if timeout is None else timeout
+    mid, since = _publish([payload])
+    deadline = time.monotonic() + timeout
+    with _acked_cond:
+        while not _take_ack_locked(mid, since):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"no PUBACK for mid {mid} within {timeout}s")
+            _acked_cond.wait(remaining)
+
+
+def publish_batch(payloads, timeout=None):
+    """
+    Publish payloads in order with up to MQTT_INFLIGHT_WINDOW unacknowledged
+    at once (one publish per utterance with MQTT_BATCH_PUBLISH). Returns
+    (number delivered, error or None), where the delivered ones are the
+    acknowledged prefix of payloads.
+
+    Stops publishing at the first publish error; gives up when no further
+    ack arrives within timeout. A message acked after that is delivered
+    again later (QoS 1 is at-least-once anyway).
+    """
+    timeout = MQTT_ACK_TIMEOUT if timeout is None else timeout
+    units = _publish_units(payloads)
+    tracked = []   # (mid, since) per published unit
+    acked = 0      # leading units acknowledged
+    error = None
+    deadline = time.monotonic() + timeout
+
+    while acked < len(units):
+        # Top up the window
+        while error is None and len(tracked) < len(units) and len(tracked) - acked < MQTT_INFLIGHT_WINDOW:
+            try:
+                tracked.append(_publish(units[len(tracked)]))
+            except Exception as e:
+                error = e
+        if acked == len(tracked):
+            break   # publish failed with nothing left in flight
+
+        with _acked_cond:
+            progressed = False
+            while acked < len(tracked) and _take_ack_locked(*tracked[acked]):
+                acked += 1
+                progressed = True
+            if progressed:
+                deadline = time.monotonic() + timeout
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                error = error or TimeoutError(f"no PUBACK for mid {tracked[acked][0]} within {timeout}s")
+                break
+            _acked_cond.wait(remaining)
+
+    return sum(len(unit) for unit in units[:acked]), error
 
 
 def flush_outbox():
-    """Send all queued messages in outbox."""
-    conn = sqlite3.connect(QUEUE_DB)
-    cur = conn.cursor()
-    
-    for id_, payload_text in cur.execute(
-        "SELECT id, payload FROM outbox WHERE sent=0 LIMIT 10"
-    ):
-        try:
-            p = json.loads(payload_text)
-            send_now(p)
-            conn.execute("UPDATE outbox SET sent=1 WHERE id=?", (id_,))
-            conn.commit()
-            if DEBUG:
-                print(f"[outbox] flushed id {id_}")
-        except Exception as e:
-            if DEBUG:
-                print(f"[outbox] error flushing id {id_}: {e}")
-            break
-    
-    conn.close()
+    """Send the oldest queued messages in outbox (up to OUTBOX_BATCH_SIZE)."""
+    outbox = get_outbox(QUEUE_DB)
+    rows = outbox.pending(OUTBOX_BATCH_SIZE)
+    
+    sent, error = publish_batch([p for _, p in rows])
+    if error:
+        outbox_log.warning("error flushing id %s: %s", rows[sent][0], error)
+    
+    # Mark the acknowledged rows sent in one transaction
+    outbox.ack([id_ for id_, _ in rows[:sent]])
+    if sent:
+        outbox_log.debug("flushed %s message(s), %s still queued", sent, outbox.depth())
@@ -0,0 +1,529 @@
+"""
+outbox.py - Persistent SQLite outbox shared by the MQTT and HTTP senders
+
+Messages that could not be delivered are queued here and flushed later.
+The outbox keeps one long-lived connection per database instead of a
+connect / commit / close per row:
+  - WAL journal with synchronous=NORMAL: commits append to the WAL without
+    an fsync, so the SD card only sees checkpoint writes
+  - fixed SQL strings, reused from sqlite3's prepared statement cache
+  - put_many() / ack() write a whole batch in one transaction
+  - unsent rows are read through an index on (sent, id), so a drain stays
+    cheap however many sent rows have accumulated
+
+Storage stays bounded (Outbox.maintain, run periodically by the drainer):
+sent rows older than OUTBOX_RETENTION_HOURS are deleted, freed pages are
+returned with incremental vacuum, and past OUTBOX_MAX_BYTES the stalest
+unsent announcements are dropped, lanes calls first.
+
+Stale announcements are never replayed: each row stores a per-intent TTL
+(OUTBOX_TTL_SECONDS) that counts from created_at, and the drain query only
+selects rows still inside it. A newly queued message also supersedes older
+unsent rows with the same class+intent (OUTBOX_SUPERSEDE_INTENTS).
+
+OutboxDrainer delivers the backlog from an asyncio task, off the
+transcript path (see main.py).
+"""
+
+import asyncio
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from config import (
+    QUEUE_DB, OUTBOX_BATCH_SIZE, OUTBOX_DRAIN_INTERVAL, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX,
+    OUTBOX_RETENTION_HOURS, OUTBOX_MAX_BYTES, OUTBOX_DROP_ORDER, OUTBOX_MAINTENANCE_INTERVAL,
+    OUTBOX_TTL_SECONDS, OUTBOX_SUPERSEDE_INTENTS
+)
+from tracing import span, trace_delivered
+from metrics import inc
+from log import get_logger
+
+log = get_logger("outbox")
+drain_log = get_logger("drain")
+
+# `sent` column: 0 = unsent, 1 = sent, 2 = expired (TTL passed), 3 = superseded
+_SQL_INSERT = ("INSERT INTO outbox (payload, created_at, sent, class_name, intent, ttl) "
+               "VALUES (?, ?, 0, ?, ?, ?)")
+_SQL_PENDING = ("SELECT id, payload FROM outbox WHERE sent=0 AND (ttl IS NULL OR created_at + ttl > ?) "
+                "ORDER BY id LIMIT ?")
+_SQL_ACK = "UPDATE outbox SET sent=1 WHERE sent=0 AND id IN ({})"
+_SQL_DEPTH_BY_CLASS = "SELECT class_name, COUNT(*) FROM outbox WHERE sent=0 GROUP BY class_name"
+_SQL_CLASS_OF = "SELECT class_name FROM outbox WHERE sent=0 AND id IN ({})"
+_SQL_IS_UNSENT = "SELECT 1 FROM outbox WHERE id=? AND sent=0"
+_SQL_OLDEST_UNSENT = ("SELECT created_at FROM outbox WHERE sent=0 AND (ttl IS NULL OR created_at + ttl > ?) "
+                      "ORDER BY id LIMIT 1")
+_SQL_EXPIRED = "SELECT id, class_name FROM outbox WHERE sent=0 AND created_at + ttl <= ?"
+_SQL_SUPERSEDED = "SELECT id FROM outbox WHERE sent=0 AND class_name=? AND intent=?"
+_SQL_SET_STATUS = "UPDATE outbox SET sent=? WHERE id=?"
+_SQL_PURGE_SENT = ("DELETE FROM outbox WHERE id IN "
+                   "(SELECT id FROM outbox WHERE sent>0 AND created_at < ? ORDER BY id LIMIT ?)")
+
+# Columns added after the original schema, back-filled from the payload JSON
+_MIGRATED_COLUMNS = {"class_name": "$.class_name", "intent": "$.intent"}
+_DELETE_CHUNK = 500
+_ACK_CHUNK = 500      # ids per ack lookup / UPDATE; SQLite before 3.32 binds at most 999
+
+
+class Outbox:
+    """SQLite outbox on a single connection, safe to share between threads."""
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        if self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Incremental auto-vacuum only takes effect on an empty or freshly vacuumed file
+            self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._conn.execute("VACUUM")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT,
+                    created_at REAL,
+                    sent INTEGER DEFAULT 0
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+            for column, json_path in _MIGRATED_COLUMNS.items():
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+                    self._conn.execute(
+                        f"UPDATE outbox SET {column}=json_extract(payload, ?) WHERE sent=0", (json_path,)
+                    )
+            if "ttl" not in columns:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN ttl REAL")
+                self._conn.executemany("UPDATE outbox SET ttl=? WHERE sent=0 AND intent=?",
+                                       [(ttl, intent) for intent, ttl in OUTBOX_TTL_SECONDS.items()])
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_sent_id ON outbox (sent, id)")
+
+        self._class_depth = Counter()   # class_name → unsent rows
+        for class_name, n in self._conn.execute(_SQL_DEPTH_BY_CLASS):
+            self._class_depth[class_name] = n
+        self._depth = sum(self._class_depth.values())
+        self._purged_total = 0
+        self._dropped_total = 0
+        self._expired_total = 0
+        self._superseded_total = 0
+
+        log.debug("opened %s (WAL), %s unsent", self.path, self._depth)
+
+    def put(self, payload: dict):
+        """Queue one payload."""
+        self.put_many([payload])
+
+    def put_many(self, payloads: list):
+        """
+        Queue several payloads in one transaction. Each one supersedes older
+        unsent rows (and earlier payloads in the batch) with the same
+        class+intent, for intents in OUTBOX_SUPERSEDE_INTENTS.
+        """
+        if not payloads:
+            return
+
+        # Keep only the newest payload per supersedable class+intent
+        kept, seen = [], set()
+        for p in reversed(payloads):
+            key = (p.get("class_name"), p.get("intent"))
+            if key[1] in OUTBOX_SUPERSEDE_INTENTS:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(p)
+        kept.reverse()
+
+        now = time.time()
+        rows = [(json.dumps(p), now, p.get("class_name"), p.get("intent"),
+                 OUTBOX_TTL_SECONDS.get(p.get("intent"))) for p in kept]
+        with self._lock, self._conn:
+            superseded = []
+            for class_name, intent in seen:
+                for (id_,) in self._conn.execute(_SQL_SUPERSEDED, (class_name, intent)).fetchall():
+                    superseded.append((3, id_))
+                    self._forget_unsent([class_name])
+            self._conn.executemany(_SQL_SET_STATUS, superseded)
+            self._conn.executemany(_SQL_INSERT, rows)
+            self._depth += len(rows)
+            self._class_depth.update(row[2] for row in rows)
+            self._superseded_total += len(superseded) + len(payloads) - len(kept)
+
+        if superseded:
+            log.debug("%s queued message(s) superseded by newer ones", len(superseded))
+
+    def pending(self, limit: int) -> list:
+        """Oldest unsent rows as [(id, payload dict)], at most limit."""
+        with self._lock:
+            if self._depth == 0:
+                return []
+            rows = self._conn.execute(_SQL_PENDING, (time.time(), limit)).fetchall()
+        return [(id_, json.loads(payload_text)) for id_, payload_text in rows]
+
+    def expire(self) -> int:
+        """
+        Mark unsent rows whose TTL has passed as expired so they stop counting
+        towards depth. (pending() already skips them; this is bookkeeping.)
+        """
+        with self._lock, self._conn:
+            if self._depth == 0:
+                return 0
+            rows = self._conn.execute(_SQL_EXPIRED, (time.time(),)).fetchall()
+            self._conn.executemany(_SQL_SET_STATUS, [(2, id_) for id_, _ in rows])
+            self._forget_unsent(class_name for _, class_name in rows)
+            self._expired_total += len(rows)
+
+        if rows:
+            log.debug("%s queued message(s) expired undelivered", len(rows))
+        return len(rows)
+
+    def is_unsent(self, id_) -> bool:
+        """True while a row is still waiting to be sent (not sent, expired or superseded)."""
+        with self._lock:
+            return self._conn.execute(_SQL_IS_UNSENT, (id_,)).fetchone() is not None
+
+    def ack(self, ids: list):
+        """
+        Mark rows as sent in one transaction (one lookup + one UPDATE per
+        _ACK_CHUNK ids). Only rows still unsent change: one that expired or
+        was superseded meanwhile keeps that status and is not counted twice.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        class_names = []
+        with self._lock, self._conn:
+            for start in range(0, len(ids), _ACK_CHUNK):
+                chunk = ids[start:start + _ACK_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(_SQL_CLASS_OF.format(marks), chunk).fetchall()
+                if rows:   # none left unsent: already acked
+                    self._conn.execute(_SQL_ACK.format(marks), chunk)
+                    class_names += [row[0] for row in rows]
+            self._forget_unsent(class_names)
+
+    def depth(self, class_name=None) -> int:
+        """Number of unsent rows, overall or for one class (tracked in memory, no query)."""
+        with self._lock:
+            if class_name is None:
+                return self._depth
+            return self._class_depth.get(class_name, 0)
+
+    def _forget_unsent(self, class_names):
+        """Update the in-memory counters for unsent rows removed from the table."""
+        for class_name in class_names:
+            self._depth -= 1
+            self._class_depth[class_name] -= 1
+            if self._class_depth[class_name] <= 0:
+                del self._class_depth[class_name]
+
+    # ===========================
+    # Retention / compaction
+    # ===========================
+    def size_bytes(self) -> int:
+        """Size of the main database file (pages in use + free pages)."""
+        with self._lock:
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def _purge_sent(self, cutoff) -> int:
+        """Delete finished rows created before cutoff, in chunks so writers are not blocked long."""
+        purged = 0
+        while True:
+            with self._lock, self._conn:
+                n = self._conn.execute(_SQL_PURGE_SENT, (cutoff, _DELETE_CHUNK)).rowcount
+            purged += n
+            if n < _DELETE_CHUNK:
+                return purged
+
+    def _drop_unsent(self, intent, limit) -> int:
+        """
+        Drop up to limit of the oldest unsent rows with this intent (None: any
+        intent not in OUTBOX_DROP_ORDER). Returns how many were dropped.
+        """
+        if intent is None:
+            marks = ",".join("?" * len(OUTBOX_DROP_ORDER))
+            where, params = f"(intent IS NULL OR intent NOT IN ({marks}))", list(OUTBOX_DROP_ORDER)
+        else:
+            where, params = "intent = ?", [intent]
+
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                f"SELECT id, class_name FROM outbox WHERE sent=0 AND {where} ORDER BY id LIMIT ?",
+                params + [limit]
+            ).fetchall()
+            self._conn.executemany("DELETE FROM outbox WHERE id=?", [(id_,) for id_, _ in rows])
+            self._forget_unsent(class_name for _, class_name in rows)
+        return len(rows)
+
+    def _vacuum(self):
+        """Return free pages to the filesystem and fold the WAL back into the database."""
+        with self._lock:
+            # executescript steps the pragma to completion (execute() frees a single page)
+            self._conn.executescript("PRAGMA incremental_vacuum;")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def maintain(self) -> dict:
+        """
+        One retention / compaction pass:
+          1. delete sent / expired / superseded rows older than OUTBOX_RETENTION_HOURS
+          2. over OUTBOX_MAX_BYTES: delete all finished rows, then drop unsent
+             rows oldest first, intent by intent in OUTBOX_DROP_ORDER (the
+             ones that go stale fastest first), until back under the cap
+          3. incremental vacuum + WAL checkpoint
+        Returns {"purged", "dropped", "size_bytes"} for this pass.
+        """
+        purged = self._purge_sent(time.time() - OUTBOX_RETENTION_HOURS * 3600)
+        self._vacuum()
+
+        dropped = 0
+        if self.size_bytes() > OUTBOX_MAX_BYTES:
+            purged += self._purge_sent(float("inf"))
+            self._vacuum()
+            for intent in list(OUTBOX_DROP_ORDER) + [None]:
+                while self.size_bytes() > OUTBOX_MAX_BYTES:
+                    n = self._drop_unsent(intent, _DELETE_CHUNK)
+                    if not n:
+                        break
+                    dropped += n
+                    self._vacuum()
+
+        with self._lock:
+            self._purged_total += purged
+            self._dropped_total += dropped
+        size = self.size_bytes()
+
+        if purged or dropped:
+            log.debug("maintenance: purged %s finished, dropped %s unsent, %.0f KiB",
+                      purged, dropped, size / 1024)
+        if dropped:
+            log.warning("over %s bytes, dropped %s stale unsent messages", OUTBOX_MAX_BYTES, dropped)
+        return {"purged": purged, "dropped": dropped, "size_bytes": size}
+
+    def stats(self) -> dict:
+        """
+        Gauges: queue depth, age of the oldest deliverable row (s), file size,
+        and lifetime purged / dropped / expired / superseded counts.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(_SQL_OLDEST_UNSENT, (now,)).fetchone() if self._depth else None
+            stats = {
+                "depth": self._depth,
+                "oldest_unsent_age": now - row[0] if row else 0.0,
+                "purged": self._purged_total,
+                "dropped": self._dropped_total,
+                "expired": self._expired_total,
+                "superseded": self._superseded_total,
+            }
+        stats["size_bytes"] = self.size_bytes()
+        return stats
+
+    def metric_samples(self):
+        """stats() as metrics.py samples."""
+        stats = self.stats()
+        samples = [("asr_outbox_depth", {}, stats["depth"]),
+                   ("asr_outbox_oldest_unsent_age_seconds", {}, stats["oldest_unsent_age"]),
+                   ("asr_outbox_size_bytes", {}, stats["size_bytes"])]
+        for counter in ("purged", "dropped", "expired", "superseded"):
+            samples.append((f"asr_outbox_{counter}_total", {}, stats[counter]))
+        return samples
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ===========================
+# Background drain (asyncio)
+# ===========================
+class OutboxDrainer:
+    """
+    Delivers fresh messages and drains the outbox backlog from the event loop.
+
+    deliver() is the fast path for new messages: a message is sent right away
+    only if its class has nothing queued, otherwise it is queued behind that
+    class's backlog so per-class order holds. A backlog in other classes
+    never delays it. A failed send queues the message and the rest of its
+    batch. With send_many, an utterance's messages go out in one call.
+
+    The drain task wakes on enqueue or every OUTBOX_DRAIN_INTERVAL seconds
+    and sends up to OUTBOX_BATCH_SIZE rows per pass, oldest first, stopping
+    at the first failure. After a failed pass it waits with jittered
+    exponential backoff (OUTBOX_RETRY_BASE doubling up to OUTBOX_RETRY_MAX).
+
+    With blocking=True (HTTP, or MQTT waiting for its PUBACK) sends run in
+    the default executor so they never stall the event loop; coroutine
+    senders (mqtt_async) are awaited directly. A sender that can deliver
+    several messages at once passes send_many, which the drain then uses
+    for each batch.
+    """
+
+    def __init__(self, outbox: Outbox, send, queue, blocking: bool = False, send_many=None):
+        self._outbox = outbox
+        self._send = send          # send(payload), raises on failure
+        self._send_many = send_many  # send_many(payloads) -> (number delivered, error or None)
+        self._queue = queue        # queue(payloads), sender-specific enrichment (e.g. event_id)
+        self._blocking = blocking
+        self._wake = None
+        self._task = None
+        self._failures = 0
+        self._last_maintenance = 0.0
+
+    def start(self):
+        """Start the drain task on the running event loop."""
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._outbox.depth():
+            self._wake.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _call(self, fn, *args):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(*args)
+        if self._blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+        return fn(*args)
+
+    def _queue_and_wake(self, messages):
+        inc("asr_queued_total", len(messages))
+        self._queue(messages)
+        self.wake()
+
+    async def deliver(self, messages):
+        """Send fresh messages now unless their class has a queued backlog."""
+        fresh = []
+        for m in messages:
+            if self._outbox.depth(m.get("class_name")):
+                drain_log.debug("%s has a backlog, queueing behind it", m.get('class_name'))
+                self._queue_and_wake([m])
+            else:
+                fresh.append(m)
+        if not fresh:
+            return
+
+        try:
+            n, error = await self._send_payloads(fresh)
+        except Exception as e:
+            n, error = 0, e
+        if n:
+            trace_delivered()
+            drain_log.debug("sent %s", fresh[:n])
+        if error is not None:
+            drain_log.debug("queueing after send error: %s", error)
+            self._queue_and_wake(fresh[n:])
+
+    async def _send_payloads(self, payloads, ids=None):
+        """
+        Send payloads in order; returns (number handled, error or None).
+        With the outbox row ids, a row superseded by a newer message while
+        earlier ones were being sent one by one is skipped (and still counts
+        as handled). send_many takes the whole batch in one call straight
+        after pending(), so nothing can supersede its rows in between.
+        """
+        delivered = 0
+        with span("deliver"):
+            if self._send_many is not None:
+                n, error = await self._call(self._send_many, payloads)
+                delivered = n
+            else:
+                n, error = len(payloads), None
+                for i, p in enumerate(payloads):
+                    if ids is not None and i and not self._outbox.is_unsent(ids[i]):
+                        drain_log.debug("skipping superseded %s", p.get("class_name"))
+                        continue
+                    try:
+                        await self._call(self._send, p)
+                    except Exception as e:
+                        n, error = i, e
+                        break
+                    delivered += 1
+        inc("asr_delivered_total", delivered)
+        if error is not None:
+            inc("asr_delivery_errors_total")
+        return n, error
+
+    async def _drain_once(self) -> tuple:
+        """Send one batch of the backlog; returns (rows fetched, True if they all went out)."""
+        self._outbox.expire()
+        rows = self._outbox.pending(OUTBOX_BATCH_SIZE)
+        if not rows:
+            return 0, True
+        n, error = await self._send_payloads([p for _, p in rows], [id_ for id_, _ in rows])
+        self._outbox.ack([id_ for id_, _ in rows[:n]])
+        drain_log.debug("sent %s/%s, %s still queued%s",
+                        n, len(rows), self._outbox.depth(), f" ({error})" if error else "")
+        return len(rows), error is None
+
+    async def _maybe_maintain(self):
+        """Run Outbox.maintain in the executor every OUTBOX_MAINTENANCE_INTERVAL seconds."""
+        if time.monotonic() - self._last_maintenance < OUTBOX_MAINTENANCE_INTERVAL:
+            return
+        self._last_maintenance = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._outbox.maintain)
+        except Exception as e:
+            log.warning("maintenance error: %s", e)
+
+    async def _run(self):
+        while True:
+            await self._maybe_maintain()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=OUTBOX_DRAIN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            while True:
+                await self._maybe_maintain()
+                try:
+                    fetched, ok = await self._drain_once()
+                except Exception as e:
+                    drain_log.info("error: %s", e)
+                    fetched, ok = None, False
+                if ok:
+                    self._failures = 0
+                    # A short batch means the backlog is empty (rows queued
+                    # since then set _wake); decide from the rows, not depth()
+                    if fetched < OUTBOX_BATCH_SIZE:
+                        break
+                    await asyncio.sleep(0)  # let fresh deliveries interleave with the drain
+                    continue
+                self._failures += 1
+                delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (self._failures - 1))
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                drain_log.debug("retrying in %.1fs (failure %s)", delay, self._failures)
+                await asyncio.sleep(delay)
+
+
+# ===========================
+# Process-wide instances (one connection per database file)
+# ===========================
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox(path=QUEUE_DB) -> Outbox:
+    """Return the shared Outbox for a database file, opening it on first use."""
+    key = str(path)
+    with _outboxes_lock:
+        if key not in _outboxes:
+            _outboxes[key] = Outbox(key)
+        return _outboxes[key]
@@ -0,0 +1,245 @@
+"""
+profiler.py - Opt-in, on-device profiling captures
+
+A capture runs for PROFILE_SECONDS while the pipeline keeps going, then
+writes its results to PROFILE_DIR. Start one with `kill -USR1 <pid>`
+(PROFILE_SIGNAL), at boot with PROFILE_ON_START, or with start_profile().
+
+  PROFILE_MODE = "sample"    a background thread samples the stack of every
+                             thread (event loop, PortAudio callback, paho,
+                             LLM workers, ...) PROFILE_SAMPLE_HZ times a
+                             second: <stamp>-stacks.txt, in collapsed-stack
+                             format ("thread;outer;...;inner count") for
+                             flamegraph.pl, inferno or speedscope
+  PROFILE_MODE = "cprofile"  deterministic cProfile of the event loop thread
+                             only (start it from that thread): <stamp>.pstats,
+                             for pstats / snakeviz / flameprof
+
+With PROFILE_TRACEMALLOC, allocations are traced for the capture and
+<stamp>-memory.txt lists the lines whose memory grew the most, overall and
+in the modules that keep long-lived state (outbox counters, the debounce and
+dedup dicts, alias caches). <stamp>.tracemalloc is the raw end snapshot.
+Tracing slows every allocation down while it is on, and the end snapshot
+holds the GIL while it copies every traced block (about half a second per
+300k blocks), pausing the event loop even though the writer thread takes
+it, so it is off by default. Sampling costs one stack walk per thread per
+sample.
+"""
+
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from config import (
+    PROFILE_SECONDS, PROFILE_MODE, PROFILE_SAMPLE_HZ, PROFILE_TRACEMALLOC, PROFILE_DIR
+)
+from log import get_logger
+
+log = get_logger("profile")
+
+# Modules whose allocations are reported separately in the memory diff
+_WATCHED_FILES = ("outbox.py", "classifier.py", "rag_classifier.py", "mqtt_sender.py",
+                  "mqtt_async.py", "config.py")
+_TOP_LINES = 25
+
+_capture = None
+_capture_lock = threading.RLock()  # re-entered if a plain signal handler lands while this thread holds it
+
+
+# ===========================
+# Stack sampling
+# ===========================
+_frame_labels = {}  # code object → "function (file.py:line)"
+
+
+def _frame_label(code):
+    label = _frame_labels.get(code)
+    if label is None:
+        name = code.co_name.replace(";", ":")
+        label = _frame_labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def _sample_stacks(counts, stop, interval, until):
+    """Count (thread name, stack of code objects) every interval seconds until `until` or stop."""
+    me = threading.get_ident()
+    next_at = time.monotonic()
+    while next_at < until:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            counts[(names.get(ident, f"thread-{ident}"), tuple(codes))] += 1
+        next_at += interval
+        if stop.wait(max(0.0, next_at - time.monotonic())):
+            return
+
+
+def _write_collapsed(path, counts):
+    """Collapsed stacks, root first: "thread;outer;...;inner count"."""
+    merged = Counter()
+    for (thread, codes), n in counts.items():
+        merged[";".join([thread.replace(";", ":")] + [_frame_label(c) for c in reversed(codes)])] += n
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, n in sorted(merged.items()):
+            f.write(f"{stack} {n}\n")
+
+
+# ===========================
+# Memory growth
+# ===========================
+def _write_memory_report(path, before, after, seconds, traced):
+    lines = [f"tracemalloc growth over {seconds:.1f}s (size diff, count diff, line)", ""]
+
+    def top(stats, title):
+        lines.append(title)
+        grown = [s for s in stats if s.size_diff > 0][:_TOP_LINES]
+        for s in grown:
+            frame = s.traceback[0]
+            lines.append(f"  {s.size_diff / 1024:>+10.1f} KiB  {s.count_diff:>+8}  "
+                         f"{frame.filename}:{frame.lineno}")
+        if not grown:
+            lines.append("  (no growth)")
+        lines.append("")
+
+    own = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+    after, before = after.filter_traces(own), before.filter_traces(own)
+    top(after.compare_to(before, "lineno"), "all modules")
+    watched = [tracemalloc.Filter(True, f"*{os.sep}{name}") for name in _WATCHED_FILES]
+    top(after.filter_traces(watched).compare_to(before.filter_traces(watched), "lineno"),
+        f"pipeline state ({', '.join(_WATCHED_FILES)})")
+
+    current, peak = traced
+    lines.append(f"traced now {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# ===========================
+# Captures
+# ===========================
+class _Capture:
+    """One profiling run; finish() stops it and writes the results off the caller's thread."""
+
+    def __init__(self, seconds, mode):
+        self.seconds = seconds
+        self.mode = mode
+        self.stamp = time.strftime("%Y%m%d-%H%M%S")
+        self._started = None
+        self._stop = threading.Event()
+        self._counts = Counter()
+        self._sampler = None
+        self._profile = None
+        self._timer = None
+        self._own_tracemalloc = False
+        self._mem_before = None
+        self._finished = False
+
+    def start(self):
+        # cProfile only sees the thread that enables it: this one, the event loop
+        loop = asyncio.get_running_loop() if self.mode == "cprofile" else None
+        if PROFILE_TRACEMALLOC:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._own_tracemalloc = True
+            self._mem_before = tracemalloc.take_snapshot()
+        self._started = time.monotonic()
+
+        if loop is not None:
+            self._timer = loop.call_later(self.seconds, self.finish)
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = threading.Thread(target=self._run_sampler, name="profiler", daemon=True)
+            self._sampler.start()
+        log.info("%s capture for %gs started", self.mode, self.seconds)
+
+    def _run_sampler(self):
+        _sample_stacks(self._counts, self._stop, 1.0 / PROFILE_SAMPLE_HZ, self._started + self.seconds)
+        self.finish()
+
+    def finish(self):
+        """Stop collecting (on the event loop thread for cProfile) and write the results."""
+        with _capture_lock:
+            if self._finished:
+                return
+            self._finished = True
+        elapsed = time.monotonic() - self._started
+        if self._profile is not None:
+            self._profile.disable()
+            self._timer.cancel()
+        self._stop.set()
+        threading.Thread(target=self._write, args=(elapsed,), name="profiler-write", daemon=False).start()
+
+    def _write(self, elapsed):
+        global _capture
+        # The end snapshot walks every traced block: take it here rather than
+        # on the thread finish() runs on, the event loop in cprofile mode
+        mem_after = traced = None
+        if self._mem_before is not None:
+            mem_after = tracemalloc.take_snapshot()
+            traced = tracemalloc.get_traced_memory()
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+        with _capture_lock:
+            if _capture is self:
+                _capture = None  # only now, so the next capture cannot see our tracing stop under it
+        if self._sampler is not None:
+            self._sampler.join()  # its last sample may still be in progress
+        try:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            base = PROFILE_DIR / self.stamp
+            written = []
+            if self._profile is not None:
+                self._profile.dump_stats(f"{base}.pstats")
+                written.append(f"{base}.pstats")
+            else:
+                _write_collapsed(f"{base}-stacks.txt", self._counts)
+                written.append(f"{base}-stacks.txt")
+            if mem_after is not None:
+                _write_memory_report(f"{base}-memory.txt", self._mem_before, mem_after, elapsed, traced)
+                mem_after.dump(f"{base}.tracemalloc")
+                written += [f"{base}-memory.txt", f"{base}.tracemalloc"]
+            log.info("%s capture (%.1fs) written: %s", self.mode, elapsed, ", ".join(written))
+        except Exception as e:
+            log.warning("could not write %s capture: %s", self.mode, e)
+
+
+def start_profile(seconds=None, mode=None) -> bool:
+    """
+    Start a capture of `seconds` (default PROFILE_SECONDS) in `mode`
+    (default PROFILE_MODE). Returns False if one is already running.
+    main runs it on the event loop (loop.add_signal_handler), which
+    "cprofile" needs; it is also safe from a plain signal handler.
+    """
+    global _capture
+    with _capture_lock:
+        if _capture is not None:
+            log.info("capture already running, ignoring request")
+            return False
+        _capture = _Capture(seconds or PROFILE_SECONDS, mode or PROFILE_MODE)
+        capture = _capture
+    try:
+        capture.start()
+    except Exception as e:
+        with _capture_lock:
+            _capture = None
+        log.warning("could not start %s capture: %s", capture.mode, e)
+        return False
+    return True
+
+
+def stop_profile():
+    """Finish a running capture early (at shutdown) so its results are still written."""
+    capture = _capture
+    if capture is not None:
+        capture.finish()
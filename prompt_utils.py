@@ -0,0 +1,103 @@
+"""
+prompt_utils.py - Shared helpers for the LLM prompt builders
+
+Used by both the OpenAI RAG path (rag_classifier) and the Bedrock framing
+path (classifier.build_messages_with_llm).
+
+Prompt layout: everything that only depends on the class map and the
+active track (role, rules, intents, the track's class catalogue) goes in a
+static system prompt built once per classmap version and track scope, so it
+is a byte-identical prefix that provider-side prompt caching can reuse for
+the whole event. Per-transcript content (retrieved context, the top-N
+candidate classes, the transcript) goes last, in the user message.
+
+The catalogue is scoped rather than the full class map so the model is not
+offered classes that do not run at this track, and the prefix is smaller:
+with the bundled class_config.json (88 classes) and knowledge base, a
+track's 13-40 classes take the RAG system prompt from ~1,000 to ~740-840
+tokens and the Bedrock one from ~670 to ~400-500. Switching events costs
+one uncached request; with no active scope the whole class map is listed.
+"""
+
+import hashlib
+import threading
+
+from config import OPENAI_MODEL, get_classmap_version
+from track_scope import get_candidate_classes
+from log import get_logger
+
+log = get_logger("prompt")
+
+# ===========================
+# Token counting (tiktoken, lazy)
+# ===========================
+_encodings = {}        # model → tiktoken encoding, or None if unavailable
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding(model: str):
+    """Load the tiktoken encoding for a model once; None if it cannot be loaded."""
+    if model not in _encodings:
+        with _encoding_lock:
+            if model not in _encodings:
+                try:
+                    import tiktoken
+                    try:
+                        enc = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        # Non-OpenAI models (e.g. Claude on Bedrock): approximate
+                        enc = tiktoken.get_encoding("o200k_base")
+                except Exception as e:
+                    # tiktoken fetches its BPE files on first use; offline → estimate
+                    log.debug("tiktoken unavailable for %s, estimating: %s", model, e)
+                    enc = None
+                _encodings[model] = enc
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """
+    Count prompt tokens for a model with tiktoken.
+    Falls back to a ~4 chars/token estimate if the encoding can't be loaded.
+    """
+    enc = _get_encoding(model or OPENAI_MODEL)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text))
+
+
+# ===========================
+# Versioned static prompts
+# ===========================
+_prompt_cache = {}     # name → (classmap version, prompt text)
+_prompt_lock = threading.Lock()
+
+
+def get_versioned_prompt(name: str, version: str, build) -> str:
+    """
+    Return the static prompt `name` for a classmap version, calling build()
+    only the first time that version is seen.
+    """
+    cached = _prompt_cache.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _prompt_lock:
+        cached = _prompt_cache.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, build())
+            _prompt_cache[name] = cached
+            log.debug("built '%s' for classmap %s: ~%s tokens", name, version, count_tokens(cached[1]))
+    return cached[1]
+
+
+def get_scoped_prompt(name: str, build) -> str:
+    """
+    Static prompt `name` listing the active track's class catalogue:
+    build(classes) gets track_scope.get_candidate_classes() (None = the
+    whole class map) and runs once per classmap version + scope.
+    """
+    classes = get_candidate_classes()
+    scope_key = "\n".join(sorted(classes)) if classes is not None else "*"
+    version = f"{get_classmap_version()}:{hashlib.sha1(scope_key.encode('utf-8')).hexdigest()[:12]}"
+    return get_versioned_prompt(name, version, lambda: build(classes))
@@ -1,38 +1,128 @@
-import sqlite3, json, time, requests
-from config import QUEUE_DB, PUSH_ENDPOINT, DEBUG
+"""
+queue_sender.py - HTTP delivery to PUSH_ENDPOINT
+
+All POSTs go through one shared requests.Session, so the TCP connection
+and TLS session to the backend are kept alive and reused instead of paying
+a new handshake per message. The session pools HTTP_MAX_CONCURRENCY
+connections and blocks further requests until one is free; that bounds the
+senders that run at once in executor threads (fresh deliveries of several
+utterances and the outbox drain). Within one send_batch the POSTs go out
+one after another, so the delivered messages are always an ordered prefix.
+
+With PUSH_BATCH_ENDPOINT set, send_batch delivers a whole outbox batch as
+one POST of {"messages": [...]} (gzip-compressed above HTTP_GZIP_MIN_BYTES).
+If the backend answers 404 / 405 / 415 / 501 there, the sender falls back
+to one POST per message for the rest of the run.
+"""
+
+import gzip
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    QUEUE_DB, OUTBOX_BATCH_SIZE, PUSH_ENDPOINT, PUSH_BATCH_ENDPOINT,
+    HTTP_TIMEOUT, HTTP_MAX_CONCURRENCY, HTTP_GZIP_MIN_BYTES
+)
+from outbox import get_outbox
+from log import get_logger
+
+log = get_logger("http")
+
+_session = None
+_session_lock = threading.Lock()
+_batch_supported = PUSH_BATCH_ENDPOINT is not None
+_BATCH_UNSUPPORTED_STATUS = {404, 405, 415, 501}
+
 
 def init_db():
-    conn = sqlite3.connect(QUEUE_DB)
-    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        payload TEXT,
-        created_at REAL,
-        sent INTEGER DEFAULT 0)""")
-    conn.commit(); conn.close()
+    get_outbox(QUEUE_DB)
 
 def queue_payload(payload):
-    conn = sqlite3.connect(QUEUE_DB)
-    conn.execute("INSERT INTO outbox (payload, created_at, sent) VALUES (?, ?, 0)",
-                 (json.dumps(payload), time.time()))
-    conn.commit(); conn.close()
-    if DEBUG: print("[queue] queued", payload)
-
-def send_now(payload, timeout=3.0):
-    if DEBUG: print("[send_now]", payload)
-    r = requests.post(PUSH_ENDPOINT, json=payload, timeout=timeout)
+    queue_payloads([payload])
+
+def queue_payloads(payloads):
+    get_outbox(QUEUE_DB).put_many(payloads)
+    log.debug("queued %s", payloads)
+
+
+# ===========================
+# Pooled HTTP client
+# ===========================
+def _get_session() -> requests.Session:
+    """Lazily create the shared keep-alive session."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_MAX_CONCURRENCY,
+                                      pool_block=True, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def _post(url, body: bytes, headers: dict, timeout: float) -> requests.Response:
+    return _get_session().post(url, data=body, headers=headers, timeout=timeout)
+
+def close_session():
+    """Close pooled connections (on shutdown)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# ===========================
+# Delivery
+# ===========================
+def send_now(payload, timeout=HTTP_TIMEOUT):
+    log.debug("send_now %s", payload)
+    body = json.dumps(payload).encode("utf-8")
+    r = _post(PUSH_ENDPOINT, body, {"Content-Type": "application/json"}, timeout)
     r.raise_for_status()
 
-def flush_outbox():
-    conn = sqlite3.connect(QUEUE_DB)
-    cur = conn.cursor()
-    for id_, payload_text in cur.execute("SELECT id, payload FROM outbox WHERE sent=0"):
-        p = json.loads(payload_text)
+def send_batch(payloads, timeout=HTTP_TIMEOUT):
+    """
+    Deliver payloads in order. Returns (number delivered, error or None);
+    the delivered ones are always a prefix of payloads.
+
+    Uses one POST to PUSH_BATCH_ENDPOINT (all or nothing) when the backend
+    supports it, otherwise one POST per message, stopping at the first error.
+    """
+    global _batch_supported
+    if _batch_supported and len(payloads) > 1:
+        body = json.dumps({"messages": payloads}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if len(body) > HTTP_GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
         try:
-            send_now(p)
-            conn.execute("UPDATE outbox SET sent=1 WHERE id=?", (id_,))
-            conn.commit()
-            if DEBUG: print("[outbox] sent id", id_)
+            r = _post(PUSH_BATCH_ENDPOINT, body, headers, timeout)
+            if r.status_code not in _BATCH_UNSUPPORTED_STATUS:
+                r.raise_for_status()
+                log.debug("send_batch: %s messages in one POST (%s bytes)", len(payloads), len(body))
+                return len(payloads), None
         except Exception as e:
-            if DEBUG: print("[outbox] failed id", id_, str(e))
-            break
-    conn.close()
+            return 0, e
+        _batch_supported = False
+        log.warning("%s answered %s, falling back to one POST per message",
+                    PUSH_BATCH_ENDPOINT, r.status_code)
+
+    for i, p in enumerate(payloads):
+        try:
+            send_now(p, timeout)
+        except Exception as e:
+            return i, e
+    return len(payloads), None
+
+def flush_outbox():
+    outbox = get_outbox(QUEUE_DB)
+    rows = outbox.pending(OUTBOX_BATCH_SIZE)
+    sent, error = send_batch([p for _, p in rows])
+    log.debug("outbox sent %s/%s%s", sent, len(rows), f" ({error})" if error else "")
+    outbox.ack([id_ for id_, _ in rows[:sent]])
@@ -6,24 +6,44 @@ contextual class/event information to OpenAI GPT for more accurate
 transcription → class ID + intent mapping.
 
 Flow:
-  1. Load knowledge base JSON → chunk per track + shared class sets
+  1. Load knowledge base JSON → chunk per track + shared class sets,
+     plus one chunk per (track, event family) for scoped retrieval
   2. Embed chunks via OpenAI text-embedding-3-small (cached in memory)
-  3. On each transcript: retrieve top-k chunks via cosine similarity
-  4. Send transcript + retrieved context + class list to GPT
-  5. Parse structured JSON response into message dicts
+  3. On each transcript: retrieve top-k chunks via cosine similarity,
+     restricted to the active track's sub-index when the event is known
+  4. Send static system prompt (rules + the active track's class catalogue,
+     built once per classmap version and track scope) + retrieved context
+     + candidate classes + transcript
+  5. Stream the strict-schema JSON response and turn each result object
+     into a message dict as soon as it has been parsed
+
+With RAG_BATCH_ENABLED, concurrent calls are micro-batched (see _RagBatcher):
+one embeddings request and one multi-transcript chat request per batch.
 """
 
+import os
 import json
+import time
+import hashlib
+import logging
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import numpy as np
 from pathlib import Path
 from openai import OpenAI
 
 from config import (
     OPENAI_API_KEY, OPENAI_MODEL, OPENAI_EMBEDDING_MODEL,
-    RAG_KNOWLEDGE_BASE_PATH, RAG_TOP_K, DEBUG,
+    RAG_KNOWLEDGE_BASE_PATH, RAG_EMBEDDING_CACHE_PATH, RAG_TOP_K, LLM_REQUEST_TIMEOUT, OPENAI_BASE_URL,
+    RAG_BATCH_ENABLED, RAG_BATCH_WINDOW_MS, RAG_BATCH_MAX_SIZE, RAG_STREAMING, LLM_MAX_WORKERS,
     get_classmap
 )
+from track_scope import load_track_index, get_active_scope, get_candidate_classes
+from prompt_utils import count_tokens, get_scoped_prompt
+from metrics import inc, register_collector
+from log import get_logger
+
+log = get_logger("rag")
 
 # ===========================
 # OpenAI client (lazy init)
@@ -38,7 +58,9 @@ def _get_client():
     if _openai_client is None:
         with _client_lock:
             if _openai_client is None:
-                _openai_client = OpenAI(api_key=OPENAI_API_KEY)
+                # No client-side retries: classifier's circuit breaker handles failover
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL,
+                                        timeout=LLM_REQUEST_TIMEOUT, max_retries=0)
     return _openai_client
 
 
@@ -47,6 +69,9 @@ def _get_client():
 # ===========================
 _chunks = []           # list of {"text": str, "metadata": dict}
 _chunk_embeddings = None  # numpy array of shape (n_chunks, embed_dim)
+_global_indices = None    # chunk indices searched when no event scope is active
+_track_chunk_index = {}   # track_name → numpy array of its event family chunk indices
+_family_chunk_index = {}  # (track_name, family_name) → chunk index
 _kb_lock = threading.Lock()
 _kb_initialized = False
 
@@ -62,10 +87,8 @@ def load_knowledge_base(path: Path = None) -> dict:
     with path.open("r", encoding="utf-8") as f:
         data = json.load(f)
 
-    if DEBUG:
-        n_tracks = len(data.get("tracks", []))
-        n_shared = len(data.get("shared_class_sets", {}))
-        print(f"[rag] loaded knowledge base: {n_tracks} tracks, {n_shared} shared class sets")
+    log.debug("loaded knowledge base: %s tracks, %s shared class sets",
+              len(data.get("tracks", [])), len(data.get("shared_class_sets", {})))
 
     return data
 
@@ -77,6 +100,8 @@ def chunk_knowledge_base(data: dict) -> list:
     Strategy:
       - One chunk for the shared class sets (global reference)
       - One chunk per track (containing all its event families + classes)
+      - One chunk per (track, event family), used when the active event
+        scopes retrieval to a single track
       - Each chunk is a self-contained text block that GPT can use as context
 
     Returns list of {"text": str, "metadata": dict}
@@ -116,19 +141,30 @@ def chunk_knowledge_base(data: dict) -> list:
             class_refs = family.get("class_set_refs", [])
             custom = family.get("custom_classes", [])
 
-            lines.append(f"  Event Family: {family_name}")
+            family_lines = [f"  Event Family: {family_name}"]
             if examples:
-                lines.append(f"    Event Examples: {', '.join(examples)}")
+                family_lines.append(f"    Event Examples: {', '.join(examples)}")
             if class_refs:
                 # Resolve shared class set references
                 resolved_classes = []
                 for ref in class_refs:
                     resolved_classes.extend(shared.get(ref, []))
-                lines.append(f"    Classes (from {', '.join(class_refs)}): {', '.join(resolved_classes)}")
+                family_lines.append(f"    Classes (from {', '.join(class_refs)}): {', '.join(resolved_classes)}")
             if custom:
-                lines.append(f"    Custom Classes: {', '.join(custom)}")
+                family_lines.append(f"    Custom Classes: {', '.join(custom)}")
+
+            lines.extend(family_lines)
             lines.append("")
 
+            chunks.append({
+                "text": "\n".join([f"=== TRACK: {track_name} ({state}) ==="] + family_lines),
+                "metadata": {
+                    "type": "event_family",
+                    "track_name": track_name,
+                    "family_name": family_name,
+                }
+            })
+
         chunk_text = "\n".join(lines)
         chunks.append({
             "text": chunk_text,
@@ -140,8 +176,7 @@ def chunk_knowledge_base(data: dict) -> list:
             }
         })
 
-    if DEBUG:
-        print(f"[rag] created {len(chunks)} chunks from knowledge base")
+    log.debug("created %s chunks from knowledge base", len(chunks))
 
     return chunks
 
@@ -167,10 +202,75 @@ def embed_texts(texts: list) -> np.ndarray:
     return np.array(embeddings, dtype=np.float32)
 
 
-def initialize_knowledge_base():
+def _embeddings_cache_key(texts: list) -> str:
+    """Embedding model + chunk texts: the cache is reused only if neither changed."""
+    h = hashlib.sha1(OPENAI_EMBEDDING_MODEL.encode("utf-8"))
+    for text in texts:
+        h.update(b"\0" + text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def embed_chunks_cached(texts: list, path: Path = None) -> np.ndarray:
+    """
+    embed_texts(texts) through the RAG_EMBEDDING_CACHE_PATH cache (.npz):
+    a reboot with an unchanged knowledge base loads the embeddings from
+    disk instead of calling the API. A stale or unreadable cache is
+    recomputed and rewritten.
+    """
+    path = RAG_EMBEDDING_CACHE_PATH if path is None else Path(path)
+    if path is None:
+        return embed_texts(texts)
+
+    key = _embeddings_cache_key(texts)
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            if str(cached["key"]) == key:
+                log.debug("loaded cached embeddings from %s", path)
+                return cached["embeddings"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("ignoring unreadable embedding cache %s: %s", path, e)
+
+    embeddings = embed_texts(texts)
+    tmp = path.with_name(path.stem + ".tmp.npz")  # np.savez appends .npz otherwise
+    try:
+        np.savez(tmp, key=np.array(key), embeddings=embeddings)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("could not write embedding cache %s: %s", path, e)
+    return embeddings
+
+
+def _build_chunk_indices(chunks: list):
+    """
+    Precompute the global and per-track sub-indices over the chunk list.
+    Global retrieval only sees the shared + whole-track chunks; scoped
+    retrieval only sees the active track's event family chunks.
+    """
+    global _global_indices, _track_chunk_index, _family_chunk_index
+
+    global_idx = []
+    per_track = {}
+    per_family = {}
+    for i, chunk in enumerate(chunks):
+        meta = chunk["metadata"]
+        if meta.get("type") == "event_family":
+            per_track.setdefault(meta["track_name"], []).append(i)
+            per_family[(meta["track_name"], meta["family_name"])] = i
+        else:
+            global_idx.append(i)
+
+    _global_indices = np.array(global_idx, dtype=np.int64)
+    _track_chunk_index = {t: np.array(idx, dtype=np.int64) for t, idx in per_track.items()}
+    _family_chunk_index = per_family
+
+
+def initialize_knowledge_base(raise_errors: bool = False):
     """
     Load knowledge base, chunk it, and compute embeddings.
-    Call once at startup. Thread-safe.
+    Call once at startup. Thread-safe. A failure is logged and retried on
+    the next call, or re-raised with raise_errors=True.
     """
     global _chunks, _chunk_embeddings, _kb_initialized
 
@@ -180,22 +280,25 @@ def initialize_knowledge_base():
 
         try:
             data = load_knowledge_base()
+            load_track_index(data)
             _chunks = chunk_knowledge_base(data)
+            _build_chunk_indices(_chunks)
 
             if not _chunks:
-                print("[rag] WARNING: no chunks generated from knowledge base")
+                log.warning("no chunks generated from knowledge base")
                 return
 
             texts = [c["text"] for c in _chunks]
-            _chunk_embeddings = embed_texts(texts)
+            _chunk_embeddings = embed_chunks_cached(texts)
             _kb_initialized = True
 
-            if DEBUG:
-                print(f"[rag] embeddings computed: shape={_chunk_embeddings.shape}")
+            log.debug("embeddings computed: shape=%s", _chunk_embeddings.shape)
 
         except Exception as e:
-            print(f"[rag] ERROR initializing knowledge base: {e}")
+            log.error("initializing knowledge base failed: %s", e)
             _kb_initialized = False
+            if raise_errors:
+                raise
 
 
 # ===========================
@@ -210,44 +313,67 @@ def _cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
     return np.dot(b_norm, a_norm)
 
 
-def retrieve_relevant_chunks(query: str, top_k: int = None) -> list:
+def _needs_query_embedding(scope: dict = None) -> bool:
+    """True if retrieval for this scope searches by similarity (i.e. embeds the query)."""
+    if not _kb_initialized or _chunk_embeddings is None:
+        return False
+    return scope is None or (scope["track_name"], scope["family_name"]) not in _family_chunk_index
+
+
+def retrieve_relevant_chunks(query: str, top_k: int = None, scope: dict = None,
+                             query_embedding: np.ndarray = None) -> list:
     """
     Retrieve the top-k most relevant knowledge base chunks for a query.
 
+    With a scope (see track_scope.get_active_scope) the search is restricted
+    to the active track's event family chunks; when the event family itself
+    is known its chunk is returned directly, without embedding the query.
+    Pass query_embedding if the query was already embedded (batched calls).
+    The knowledge base must have been initialized (classify_with_rag does
+    so first); until then there is nothing to retrieve.
+
     Returns list of {"text": str, "metadata": dict, "score": float}
     """
     if top_k is None:
         top_k = RAG_TOP_K
 
     if not _kb_initialized or _chunk_embeddings is None:
-        if DEBUG:
-            print("[rag] knowledge base not initialized, attempting init...")
-        initialize_knowledge_base()
-
-    if not _kb_initialized or _chunk_embeddings is None:
+        log.debug("knowledge base not initialized, no context retrieved")
         return []
 
+    candidates = _global_indices
+    if scope is not None:
+        family_idx = _family_chunk_index.get((scope["track_name"], scope["family_name"]))
+        if family_idx is not None:
+            chunk = _chunks[family_idx]
+            log.debug("scoped to event family: %s / %s", scope['track_name'], scope['family_name'])
+            return [{"text": chunk["text"], "metadata": chunk["metadata"], "score": 1.0}]
+        if scope["track_name"] in _track_chunk_index:
+            candidates = _track_chunk_index[scope["track_name"]]
+
     # Embed the query
-    query_embedding = embed_texts([query])[0]
+    if query_embedding is None:
+        query_embedding = embed_texts([query])[0]
 
-    # Compute cosine similarities
-    similarities = _cosine_similarity(query_embedding, _chunk_embeddings)
+    # Compute cosine similarities over the candidate sub-index only
+    similarities = _cosine_similarity(query_embedding, _chunk_embeddings[candidates])
 
     # Get top-k indices
     top_indices = np.argsort(similarities)[::-1][:top_k]
 
     results = []
-    for idx in top_indices:
+    for pos in top_indices:
+        idx = candidates[pos]
         results.append({
             "text": _chunks[idx]["text"],
             "metadata": _chunks[idx]["metadata"],
-            "score": float(similarities[idx])
+            "score": float(similarities[pos])
         })
 
-    if DEBUG:
+    if log.isEnabledFor(logging.DEBUG):
         for r in results:
             meta_str = r["metadata"].get("track_name", r["metadata"].get("type", "?"))
-            print(f"[rag] retrieved chunk: {meta_str} (score={r['score']:.3f})")
+            log.debug("retrieved chunk: %s (score=%.3f)", meta_str, r['score'])
 
     return results
 
@@ -256,12 +382,23 @@ def retrieve_relevant_chunks(query: str, top_k: int = None) -> list:
 # RAG Classification
 # ===========================
 
-def _build_canonical_class_list_str() -> str:
-    """Build a formatted string of all canonical class names and their aliases."""
+OTHER_CLASS = "OTHER"  # escape hatch for classes outside the pruned candidate list
+
+
+def _build_canonical_class_list_str(candidates=None) -> str:
+    """
+    Build a formatted string of canonical class names and their aliases.
+    If candidates is given, only those classes are listed (in the given
+    order, best candidate first).
+    """
     classmap = get_classmap()
     lines = []
-    for cls, data in sorted(classmap.items()):
-        aliases = data.get("aliases", [])
+    if candidates is None:
+        names = sorted(classmap)
+    else:
+        names = [c for c in candidates if c in classmap]
+    for cls in names:
+        aliases = classmap[cls].get("aliases", [])
         if aliases:
             lines.append(f"- {cls} (aliases/phonetics: {', '.join(aliases)})")
         else:
@@ -269,142 +406,623 @@ def _build_canonical_class_list_str() -> str:
     return "\n".join(lines)
 
 
-def classify_with_rag(transcript: str, timestamp: str) -> list:
+def _build_system_prompt(catalogue_classes=None) -> str:
     """
-    Main RAG classification entry point.
-
-    1. Retrieve relevant knowledge base chunks
-    2. Build system prompt with context
-    3. Call OpenAI GPT for class + intent classification
-    4. Parse and validate response
-    5. Return list of message dicts matching pipeline schema
-
-    Falls back to empty list on error (caller handles fallback).
+    Build the static system prompt: role, intents, rules, output format and
+    the canonical class catalogue (catalogue_classes, or the whole class
+    map). It depends only on the class map and track scope, so it is built
+    once per classmap version + scope (see _get_system_prompt) and stays a
+    byte-identical prefix across calls for OpenAI prompt caching.
     """
-    from classifier import should_send  # avoid circular import
-
-    classmap = get_classmap()
-    if not classmap:
-        return []
+    catalogue = ", ".join(sorted(c for c in get_classmap()
+                                 if catalogue_classes is None or c in catalogue_classes))
 
-    # Step 1: Retrieve relevant context
-    retrieved = retrieve_relevant_chunks(transcript)
-    context_text = "\n\n".join([r["text"] for r in retrieved]) if retrieved else "No specific track context available."
-
-    # Step 2: Build the prompt
-    canonical_list_str = _build_canonical_class_list_str()
-
-    system_prompt = f"""You are an expert drag racing track announcer AI assistant.
+    return f"""You are an expert drag racing track announcer AI assistant.
 You receive a raw audio transcript from a live drag strip announcer and your job is to:
 1. Identify which racing class(es) are being mentioned
 2. Determine the intent of the announcement
 3. Frame a clean, professional announcement message
 
-You have access to a knowledge base of track and event information to help you understand context:
-
---- KNOWLEDGE BASE CONTEXT ---
-{context_text}
---- END CONTEXT ---
-
-VALID CLASS NAMES (and their common aliases/mispronunciations):
-{canonical_list_str}
+VALID CLASS NAMES:
+{catalogue}
 
 VALID INTENTS AND EXACT TRIGGERS:
 - CLASS_TO_LANES: The announcer is ACTIVELY directing a class to move right now (e.g., "to the lanes", "make your way down", "pull up"). 
 - CLASS_STANDBY: The announcer is telling a class to hold, wait, get ready, or standby (e.g., "on standby", "be ready", "on deck", "listen for the call").
 - GENERAL_ANNOUNCEMENT: Other important notices, updates, meetings, or information about a class.
 
+Each request gives you, in order: knowledge base context about the track and event, the LIKELY CLASSES for this transcript (best local matches, with their common aliases/mispronunciations), and the transcript itself.
+
 RULES:
-1. ONLY return the primary canonical class name (e.g., "Super Pro", not an alias).
+1. ONLY return the primary canonical class name from VALID CLASS NAMES (e.g., "Super Pro", not an alias). When LIKELY CLASSES are given, class_name must be one of them. If a racing class is clearly mentioned but is not among the LIKELY CLASSES or not a valid class name, return "{OTHER_CLASS}" as its class_name.
 2. The audio is from a race announcer, so the transcription may be messy. Perform fuzzy matching and contextual deduction to match the transcription to the most accurate class and intent.
 3. CRITICAL INTENT MATCHING: You must compare the EXACT words and context in the transcript to determine the intent. If the speaker says "standby" but uses the word "lanes" in a future tense ("we might call you to the lanes soon"), the immediate intent is ONLY "CLASS_STANDBY". Do NOT trigger CLASS_TO_LANES unless the immediate instruction is to move to the lanes right now.
-4. CRITICAL CLASS MATCHING: If MULTIPLE classes are mentioned in a single announcement (e.g., "super street and stock"), you MUST return ALL of them as separate objects in the JSON array. Do not miss any. Each class gets its own independent object.
+4. CRITICAL CLASS MATCHING: If MULTIPLE classes are mentioned in a single announcement (e.g., "super street and stock"), you MUST return ALL of them as separate objects in the results array, in the order the announcer calls them. Do not miss any. Each class gets its own independent object.
 5. Do not hallucinate intents. If the announcer explicitly says "put [class] on standby", the intent is STRICTLY CLASS_STANDBY.
 6. The "message_text" should be a clean, professional version of what the announcer said, using the exact class name and preserving the announcer's intent/keywords.
-7. If no valid class or intent can be identified, return an empty array [].
+7. If no valid class or intent can be identified, return an empty results array.
 
-Output ONLY a valid JSON array. Each object must have:
+Output ONLY a JSON object {{"results": [...]}}. Each result object must have:
 - "class_name": string (must exactly match a valid primary canonical class name)
 - "intent": string (one of the valid intents)
 - "message_text": string (clean announcement text)
 
-If nothing relevant is found, return: []"""
+If nothing relevant is found, return: {{"results": []}}"""
 
-    user_prompt = f"Transcript: \"{transcript}\"\n\nIdentify all class mentions and intents. Output JSON array:"
 
-    # Step 3: Call OpenAI
-    try:
-        client = _get_client()
-        response = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1,  # Low temperature for consistent, deterministic output
-            max_tokens=500,
-            response_format={"type": "json_object"}  # Force JSON mode
-        )
+def _get_system_prompt() -> str:
+    """Static system prompt for the current classmap version and track scope (prebuilt once)."""
+    return get_scoped_prompt("rag_system", _build_system_prompt)
 
-        content = response.choices[0].message.content.strip()
 
-        if DEBUG:
-            print(f"[rag] OpenAI response: {content}")
+VALID_INTENTS = {"CLASS_TO_LANES", "CLASS_STANDBY", "GENERAL_ANNOUNCEMENT"}
 
-        # Step 4: Parse response
-        parsed = json.loads(content)
 
-        # Handle both {"results": [...]} and direct [...] formats
-        if isinstance(parsed, dict):
-            results = parsed.get("results", parsed.get("announcements", parsed.get("classes", [])))
-            if not isinstance(results, list):
-                results = []
-        elif isinstance(parsed, list):
-            results = parsed
-        else:
-            results = []
-
-        # Step 5: Validate and build message dicts
-        msgs = []
-        for res in results:
-            cls_name = res.get("class_name", "")
-            intent = res.get("intent", "")
-            message_text = res.get("message_text", "")
-
-            # Validate class exists in classmap
-            if cls_name not in classmap:
-                if DEBUG:
-                    print(f"[rag] skipping unknown class: '{cls_name}'")
-                continue
+def _resolve_candidate_classes(transcript: str, candidate_classes: list = None):
+    """
+    Candidate classes to offer the model for a transcript: the given list,
+    else the local ranking (classifier.rank_candidate_classes), else the
+    track-scoped catalogue. None means the full catalogue.
+    """
+    from classifier import rank_candidate_classes  # avoid circular import
 
-            # Validate intent
-            valid_intents = {"CLASS_TO_LANES", "CLASS_STANDBY", "GENERAL_ANNOUNCEMENT"}
-            if intent not in valid_intents:
-                if DEBUG:
-                    print(f"[rag] skipping unknown intent: '{intent}'")
-                continue
+    if candidate_classes is None:
+        candidate_classes = rank_candidate_classes(transcript, candidates=get_candidate_classes())
+    if candidate_classes is None:
+        candidate_classes = get_candidate_classes()
+        if candidate_classes is not None:
+            candidate_classes = sorted(candidate_classes)
+    return candidate_classes
+
+
+def _transcript_prompt_parts(transcript: str, retrieved: list, candidate_classes) -> list:
+    """Per-transcript user prompt lines: retrieved context, likely classes, transcript."""
+    context_text = "\n\n".join([r["text"] for r in retrieved]) if retrieved else "No specific track context available."
+
+    parts = [
+        "--- KNOWLEDGE BASE CONTEXT ---",
+        context_text,
+        "--- END CONTEXT ---",
+        "",
+    ]
+    if candidate_classes:
+        parts += [
+            "LIKELY CLASSES (and their common aliases/mispronunciations):",
+            _build_canonical_class_list_str(candidate_classes),
+            "",
+        ]
+    parts += [
+        f"Transcript: \"{transcript}\"",
+        "",
+    ]
+    return parts
+
+
+# ===========================
+# Structured output + streaming
+# ===========================
+def _response_format(batched: bool = False, class_names=None) -> dict:
+    """
+    Strict JSON schema for the classification response: {"results": [...]}.
+    With class_names (the candidate classes), class_name is limited to them
+    plus OTHER_CLASS. Batched requests also tag every result with its
+    transcript number.
+    """
+    class_name = {"type": "string"}
+    if class_names:
+        class_name["enum"] = sorted(set(class_names)) + [OTHER_CLASS]
+    properties = {
+        "class_name": class_name,
+        "intent": {"type": "string", "enum": sorted(VALID_INTENTS)},
+        "message_text": {"type": "string"},
+    }
+    if batched:
+        properties["utterance"] = {"type": "integer"}
+
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "announcements",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": properties,
+                            "required": list(properties),
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["results"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+class ResultStreamParser:
+    """
+    Incremental parser for a streamed {"results": [{...}, ...]} document
+    (a bare [{...}, ...] array also works).
+
+    feed() takes the next piece of text and returns every result object it
+    completed, so each one can be acted on before the rest has arrived.
+    """
 
-            # Check debounce
-            if not should_send(cls_name, intent):
-                if DEBUG:
-                    print(f"[rag] debounced: {cls_name} / {intent}")
+    def __init__(self):
+        self._stack = []             # open containers, "{" or "["
+        self._in_string = False
+        self._escape = False
+        self._capture_depth = None   # stack depth of the result object being captured
+        self._buf = []
+
+    def feed(self, text: str) -> list:
+        done = []
+        for ch in text:
+            if self._capture_depth is not None:
+                self._buf.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{" or ch == "[":
+                # A result is an object directly inside the (top-level or "results") array
+                if (ch == "{" and self._capture_depth is None and len(self._stack) <= 2
+                        and self._stack and self._stack[-1] == "["):
+                    self._capture_depth = len(self._stack)
+                    self._buf = [ch]
+                self._stack.append(ch)
+            elif ch == "}" or ch == "]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._capture_depth == len(self._stack):
+                    try:
+                        obj = json.loads("".join(self._buf))
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        done.append(obj)
+                    self._capture_depth = None
+                    self._buf = []
+        return done
+
+
+def _parse_results(content: str) -> list:
+    """Parse a complete (non-streamed) response into its list of result objects."""
+    return ResultStreamParser().feed(content)
+
+
+_latency_stats = {"requests": 0, "with_results": 0, "first_result_total": 0.0,
+                  "first_result_max": 0.0, "complete_total": 0.0}
+_latency_lock = threading.Lock()
+
+
+def _record_latency(first_result, complete):
+    with _latency_lock:
+        _latency_stats["requests"] += 1
+        _latency_stats["complete_total"] += complete
+        if first_result is not None:
+            _latency_stats["with_results"] += 1
+            _latency_stats["first_result_total"] += first_result
+            _latency_stats["first_result_max"] = max(_latency_stats["first_result_max"], first_result)
+
+
+def get_latency_stats() -> dict:
+    """Chat request latency: mean time to the first parsed result and to completion (seconds)."""
+    with _latency_lock:
+        stats = dict(_latency_stats)
+    stats["first_result_avg"] = (stats["first_result_total"] / stats["with_results"]
+                                 if stats["with_results"] else None)
+    stats["complete_avg"] = stats["complete_total"] / stats["requests"] if stats["requests"] else None
+    return stats
+
+
+def _metric_samples():
+    """Chat latency and batch sizes for metrics.py (the per-call distribution is the "rag" trace stage)."""
+    stats = get_latency_stats()
+    samples = [
+        ("asr_rag_requests_total", {}, stats["requests"]),
+        ("asr_rag_first_result_avg_seconds", {}, stats["first_result_avg"]),
+        ("asr_rag_first_result_max_seconds", {}, stats["first_result_max"]),
+        ("asr_rag_complete_avg_seconds", {}, stats["complete_avg"]),
+    ]
+    if _batcher is not None:
+        samples += [("asr_rag_batches_total", {}, _batcher.batches),
+                    ("asr_rag_batched_calls_total", {}, _batcher.items)]
+    return samples
+
+
+register_collector(_metric_samples)
+
+
+def _complete(system_prompt: str, user_prompt: str, max_tokens: int = 500,
+              on_result=None, batched: bool = False, class_names=None) -> list:
+    """
+    Run the classification chat completion with the strict response schema
+    (class_name limited to class_names, if given) and return its result
+    objects.
+
+    With RAG_STREAMING the response is streamed and parsed incrementally;
+    on_result(res) is called for each result object as soon as it is
+    complete (without streaming, for each one once the response is in).
+    """
+    client = _get_client()
+    request = dict(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.1,  # Low temperature for consistent, deterministic output
+        max_tokens=max_tokens,
+        response_format=_response_format(batched, class_names),
+    )
+
+    start = time.monotonic()
+    first_result = None
+    results = []
+    usage = None
+
+    def _emit(new_results):
+        nonlocal first_result
+        if new_results and first_result is None:
+            first_result = time.monotonic() - start
+        for res in new_results:
+            results.append(res)
+            if on_result is not None:
+                on_result(res)
+
+    if RAG_STREAMING:
+        parser = ResultStreamParser()
+        content = []
+        stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True},
+                                                **request)
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
                 continue
+            piece = chunk.choices[0].delta.content
+            if piece:
+                content.append(piece)
+                _emit(parser.feed(piece))
+            if chunk.choices[0].finish_reason == "length":
+                log.warning("response truncated at max_tokens=%s", max_tokens)
+        content = "".join(content)
+    else:
+        response = client.chat.completions.create(**request)
+        usage = response.usage
+        content = response.choices[0].message.content or ""
+        _emit(_parse_results(content))
+
+    complete = time.monotonic() - start
+    _record_latency(first_result, complete)
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+        inc("asr_llm_tokens_total", usage.prompt_tokens or 0, backend="rag", kind="input")
+        inc("asr_llm_tokens_total", usage.completion_tokens or 0, backend="rag", kind="output")
+        inc("asr_llm_tokens_total", cached or 0, backend="rag", kind="cache_read_input")
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("OpenAI response: %s", content.strip())
+        first_str = f"{first_result * 1000:.0f} ms" if first_result is not None else "-"
+        log.debug("first result after %s, complete after %.0f ms", first_str, complete * 1000)
+        if usage is not None:
+            log.debug("usage: prompt=%s (cached=%s) completion=%s",
+                      usage.prompt_tokens, cached or 0, usage.completion_tokens)
 
-            msgs.append({
-                "class_id": classmap[cls_name]["id"],
-                "class_name": cls_name,
-                "intent": intent,
-                "transcription": transcript,
-                "message_text": message_text,
-                "timestamp": timestamp
-            })
+    return results
+
+
+def _results_to_messages(results: list, transcript: str, timestamp: str, classmap: dict,
+                         debounce: bool = True) -> list:
+    """Validate model results against the class map / intents and build message dicts."""
+    from classifier import should_send  # avoid circular import
+
+    msgs = []
+    for res in results:
+        cls_name = res.get("class_name", "")
+        intent = res.get("intent", "")
+        message_text = res.get("message_text", "")
+
+        # A class outside the candidate list: leave it to the local pipeline
+        if cls_name == OTHER_CLASS:
+            log.debug("model reported a class outside the candidate list")
+            continue
+
+        # Validate class exists in classmap
+        if cls_name not in classmap:
+            log.debug("skipping unknown class: '%s'", cls_name)
+            continue
+
+        # Validate intent
+        if intent not in VALID_INTENTS:
+            log.debug("skipping unknown intent: '%s'", intent)
+            continue
+
+        # Check debounce
+        if debounce and not should_send(cls_name, intent):
+            log.debug("debounced: %s / %s", cls_name, intent)
+            continue
+
+        msgs.append({
+            "class_id": classmap[cls_name]["id"],
+            "class_name": cls_name,
+            "intent": intent,
+            "transcription": transcript,
+            "message_text": message_text,
+            "timestamp": timestamp
+        })
+    return msgs
+
+
+def classify_with_rag(transcript: str, timestamp: str, candidate_classes: list = None,
+                      debounce: bool = True, raise_errors: bool = False,
+                      on_message=None) -> list:
+    """
+    Main RAG classification entry point.
 
-        if DEBUG:
-            print(f"[rag] classified {len(msgs)} messages from transcript")
+    1. Retrieve relevant knowledge base chunks
+    2. Build the per-transcript user prompt (context, candidates, transcript)
+       after the static system prompt
+    3. Call OpenAI GPT for class + intent classification
+    4. Parse and validate response
+    5. Return list of message dicts matching pipeline schema
+
+    candidate_classes is the pruned class list to offer the model (see
+    classifier.rank_candidate_classes); it is computed here if not given,
+    and the track-scoped catalogue is used if there is no evidence.
+    With debounce=False the caller applies should_send itself.
+    With RAG_BATCH_ENABLED the call is queued on the micro-batcher and
+    blocks until its batch has been classified.
+
+    on_message(msg), if given, receives each validated message as soon as
+    its result has streamed in, before this returns (from the batcher's
+    thread when batching). The returned list still holds every message.
+
+    Falls back to empty list on error (caller handles fallback), or re-raises
+    with raise_errors=True so the caller can tell a failure from "no classes".
+    """
+    classmap = get_classmap()
+    if not classmap:
+        return []
+
+    candidate_classes = _resolve_candidate_classes(transcript, candidate_classes)
+
+    # No-op once warm_up() has run; waits for it if still in progress. Done in
+    # the caller's thread, so under a circuit breaker a KB failure counts
+    try:
+        initialize_knowledge_base(raise_errors=True)
+    except Exception:
+        if raise_errors:
+            raise
+        # otherwise classify without retrieved context
+
+    if RAG_BATCH_ENABLED:
+        future = _get_batcher().submit({
+            "transcript": transcript,
+            "timestamp": timestamp,
+            "candidate_classes": candidate_classes,
+            "debounce": debounce,
+            "on_message": on_message,
+        })
+        timeout = RAG_BATCH_WINDOW_MS / 1000 + 2 * LLM_REQUEST_TIMEOUT  # window + embeddings + chat
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()  # if its batch has not started yet, it is left out
+            error = TimeoutError(f"no batch result within {timeout:g}s")
+        except Exception as e:
+            error = e
+        log.warning("classification error: %s", error)
+        if raise_errors:
+            raise error
+        return []
+
+    # Step 1: Retrieve relevant context (scoped to the active track if known)
+    scope = get_active_scope()
+    retrieved = retrieve_relevant_chunks(transcript, scope=scope)
+
+    # Step 2: Build the prompt — static prefix first, per-query content last
+    system_prompt = _get_system_prompt()
+    user_prompt = "\n".join(
+        _transcript_prompt_parts(transcript, retrieved, candidate_classes)
+        + ["Identify all class mentions and intents. Output JSON:"]
+    )
+
+    if log.isEnabledFor(logging.DEBUG):
+        n_likely = len(candidate_classes) if candidate_classes else 0
+        log.debug("prompt tokens: system=%s (static) user=%s (%s likely classes)",
+                  count_tokens(system_prompt), count_tokens(user_prompt), n_likely)
+
+    msgs = []
+
+    def on_result(res):
+        # Steps 4-5 per result: validate and hand on as soon as it is parsed
+        new_msgs = _results_to_messages([res], transcript, timestamp, classmap, debounce)
+        msgs.extend(new_msgs)
+        if on_message is not None:
+            for m in new_msgs:
+                on_message(m)
+
+    try:
+        # Step 3: Call OpenAI
+        _complete(system_prompt, user_prompt, on_result=on_result, class_names=candidate_classes)
+
+        log.debug("classified %s messages from transcript", len(msgs))
 
         return msgs
 
     except Exception as e:
-        if DEBUG:
-            print(f"[rag] classification error: {e}")
+        log.warning("classification error: %s", e)
+        if raise_errors:
+            raise
         return []  # Caller will fall back to existing pipeline
+
+
+# ===========================
+# Micro-batching (RAG_BATCH_ENABLED)
+# ===========================
+def _classify_batch(items: list) -> list:
+    """
+    Classify several queued transcripts together. Returns one message list
+    per item, in order.
+
+    All queries that need retrieval are embedded in a single embeddings
+    request. A single item is sent exactly like an unbatched call; several
+    items share one chat request whose results carry an "utterance" number.
+    Streamed results are validated and handed to their item's on_message
+    as they arrive.
+    """
+    classmap = get_classmap()
+    scope = get_active_scope()
+
+    embeddings = None
+    if _needs_query_embedding(scope):
+        embeddings = embed_texts([item["transcript"] for item in items])
+
+    prompt_parts = []
+    for i, item in enumerate(items):
+        retrieved = retrieve_relevant_chunks(
+            item["transcript"], scope=scope,
+            query_embedding=embeddings[i] if embeddings is not None else None
+        )
+        prompt_parts.append(_transcript_prompt_parts(item["transcript"], retrieved,
+                                                     item["candidate_classes"]))
+
+    batched = len(items) > 1
+    if not batched:
+        user_prompt = "\n".join(
+            prompt_parts[0] + ["Identify all class mentions and intents. Output JSON:"]
+        )
+    else:
+        lines = [
+            f"The following {len(items)} transcripts are independent announcements; "
+            "classify each one separately.",
+            'Set "utterance" on every result object to its transcript number.',
+            "",
+        ]
+        for n, parts in enumerate(prompt_parts, start=1):
+            lines += [f"=== TRANSCRIPT {n} ==="] + parts
+        lines.append("Identify all class mentions and intents for every transcript. Output JSON:")
+        user_prompt = "\n".join(lines)
+
+    system_prompt = _get_system_prompt()
+    log.debug("batch of %s: system=%s (static) user=%s tokens",
+              len(items), count_tokens(system_prompt), count_tokens(user_prompt))
+
+    # Fan results back out to their transcripts as they stream in
+    per_item = [[] for _ in items]
+
+    def on_result(res):
+        n = 1
+        if batched:
+            try:
+                n = int(res.get("utterance"))
+            except (TypeError, ValueError):
+                n = 0
+            if not 1 <= n <= len(items):
+                log.debug("batch result without a valid utterance number: %s", res)
+                return
+        item = items[n - 1]
+        new_msgs = _results_to_messages([res], item["transcript"], item["timestamp"], classmap,
+                                        item["debounce"])
+        per_item[n - 1].extend(new_msgs)
+        if item["on_message"] is not None:
+            for m in new_msgs:
+                item["on_message"](m)
+
+    # One schema for the whole batch: every item's candidates, unless one has none
+    class_names = None
+    if all(item["candidate_classes"] for item in items):
+        class_names = {c for item in items for c in item["candidate_classes"]}
+    _complete(system_prompt, user_prompt, max_tokens=500 * len(items),
+              on_result=on_result, batched=batched, class_names=class_names)
+    return per_item
+
+
+class _RagBatcher:
+    """
+    Collects concurrent classify_with_rag calls for up to RAG_BATCH_WINDOW_MS
+    after the first one arrives (or until RAG_BATCH_MAX_SIZE are waiting) and
+    classifies them together on a pool of LLM_MAX_WORKERS threads, so the
+    next batch is collected while earlier ones are in flight. Each caller
+    gets its own result back through a Future; a failed batch fails every
+    call in it, and a call cancelled before its batch starts is left out.
+    """
+
+    def __init__(self):
+        self._pending = []           # (item, Future)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._workers = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="rag-batch")
+        self.batches = 0             # batches classified, and the calls in them
+        self.items = 0
+
+    def submit(self, item: dict) -> Future:
+        future = Future()
+        with self._cond:
+            self._pending.append((item, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name="rag-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _collect(self):
+        window = RAG_BATCH_WINDOW_MS / 1000
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + window
+                while len(self._pending) < RAG_BATCH_MAX_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:RAG_BATCH_MAX_SIZE]
+                del self._pending[:RAG_BATCH_MAX_SIZE]
+
+            self._workers.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list):
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        with self._cond:
+            self.batches += 1
+            self.items += len(batch)
+        try:
+            results = _classify_batch([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), msgs in zip(batch, results):
+            future.set_result(msgs)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def _get_batcher() -> _RagBatcher:
+    """Lazily create the process-wide micro-batcher."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = _RagBatcher()
+    return _batcher
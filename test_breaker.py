@@ -0,0 +1,212 @@
+"""
+test_breaker.py - classifier.CircuitBreaker state transitions
+
+Drives one breaker on a fake monotonic clock and checks that:
+  1. a closed breaker opens only once BREAKER_MIN_CALLS calls are in the
+     window and BREAKER_FAILURE_RATIO of them failed or were slow, and
+     outcomes older than BREAKER_WINDOW_SECONDS no longer count
+  2. an open breaker skips calls for BREAKER_OPEN_SECONDS, then lets exactly
+     one half-open probe through; a failed probe re-opens it, a good one
+     closes it with a fresh window, and a call admitted before the breaker
+     opened does not decide the probe
+  3. call() records exceptions as failures and re-raises them
+  4. on the escalation path the RAG knowledge base is loaded under the
+     breaker: load failures open it, and an open breaker skips the load
+
+Usage:
+  python test_breaker.py
+  (or: python -m pytest test_breaker.py)
+"""
+
+import contextlib
+import sys
+import types
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import rag_classifier as rc
+from classifier import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@contextlib.contextmanager
+def fake_clock():
+    """classifier's time.monotonic replaced by a clock the test advances."""
+    clock = FakeClock()
+    saved = classifier.time
+    classifier.time = types.SimpleNamespace(monotonic=clock)
+    try:
+        yield clock
+    finally:
+        classifier.time = saved
+
+
+def fail(breaker, n=1, latency=0.1):
+    for _ in range(n):
+        ticket = breaker.allow()
+        assert ticket
+        breaker.record(latency, ok=False, ticket=ticket)
+
+
+def succeed(breaker, n=1, latency=0.1):
+    for _ in range(n):
+        ticket = breaker.allow()
+        assert ticket
+        breaker.record(latency, ok=True, ticket=ticket)
+
+
+# ===========================
+# Tests
+# ===========================
+def test_opens_on_failure_ratio():
+    """Test 1: minimum calls, failure ratio, slow calls and the rolling window."""
+    print("\n" + "=" * 60)
+    print("TEST 1: closed → open on the windowed failure ratio")
+    print("=" * 60)
+
+    with fake_clock() as clock:
+        breaker = CircuitBreaker("test")
+        fail(breaker, classifier.BREAKER_MIN_CALLS - 1)
+        assert breaker.snapshot()["state"] == CircuitBreaker.CLOSED
+        print(f"  ✓ {classifier.BREAKER_MIN_CALLS - 1} failures: still closed (below BREAKER_MIN_CALLS)")
+
+        # Those failures age out of the window; successes keep the ratio low
+        clock.advance(classifier.BREAKER_WINDOW_SECONDS + 1)
+        succeed(breaker, 2)
+        fail(breaker)
+        snap = breaker.snapshot()
+        assert snap["state"] == CircuitBreaker.CLOSED and snap["window_calls"] == 3, snap
+        print("  ✓ old failures aged out: 1/3 failed in the window, still closed")
+
+        # A successful but slow call counts as a failure
+        breaker.record(classifier.BREAKER_SLOW_CALL_SECONDS + 0.1, ok=True)
+        snap = breaker.snapshot()
+        assert snap["state"] == CircuitBreaker.OPEN and snap["opened"] == 1, snap
+        assert snap["failures"] == classifier.BREAKER_MIN_CALLS + 1, snap
+        print(f"  ✓ slow call tips it to 2/4 ≥ {classifier.BREAKER_FAILURE_RATIO}: open")
+
+
+def test_half_open_probe():
+    """Test 2: skip while open, one probe, re-open on failure, close on success."""
+    print("\n" + "=" * 60)
+    print("TEST 2: open → half-open probe → open / closed")
+    print("=" * 60)
+
+    with fake_clock() as clock:
+        breaker = CircuitBreaker("test")
+        fail(breaker, classifier.BREAKER_MIN_CALLS)
+        assert breaker.snapshot()["state"] == CircuitBreaker.OPEN
+
+        clock.advance(classifier.BREAKER_OPEN_SECONDS - 1)
+        assert not breaker.allow()
+        assert breaker.snapshot()["skipped"] == 1
+        print("  ✓ calls skipped while open")
+
+        clock.advance(1)
+        probe = breaker.allow()
+        assert probe, "no probe after BREAKER_OPEN_SECONDS"
+        assert breaker.snapshot()["state"] == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow(), "second call let through while probing"
+
+        # Calls admitted while still closed finish during the probe
+        straggler = True
+        breaker.record(0.1, ok=True, ticket=straggler)
+        breaker.record(0.1, ok=False, ticket=straggler)
+        snap = breaker.snapshot()
+        assert snap["state"] == CircuitBreaker.HALF_OPEN and snap["opened"] == 1, snap
+        assert not breaker.allow(), "straggler released the probe"
+        print("  ✓ results without the probe's ticket leave it half-open")
+
+        breaker.record(0.1, ok=False, ticket=probe)
+        snap = breaker.snapshot()
+        assert snap["state"] == CircuitBreaker.OPEN and snap["opened"] == 2, snap
+        assert not breaker.allow(), "open timer not restarted by the failed probe"
+        print("  ✓ one probe at a time; a failed probe re-opens for another full period")
+
+        clock.advance(classifier.BREAKER_OPEN_SECONDS)
+        succeed(breaker)
+        snap = breaker.snapshot()
+        assert snap["state"] == CircuitBreaker.CLOSED, snap
+        assert snap["window_calls"] == 1 and snap["window_failure_ratio"] == 0.0, snap
+        succeed(breaker, 2)
+        print("  ✓ a good probe closes it with a fresh window; calls flow again")
+
+
+def test_call_records_outcome():
+    """Test 3: call() wraps a backend function."""
+    print("\n" + "=" * 60)
+    print("TEST 3: call() records outcomes")
+    print("=" * 60)
+
+    breaker = CircuitBreaker("test")
+    assert breaker.call(lambda x: x * 2, 21) == 42
+
+    def boom():
+        raise RuntimeError("backend down")
+
+    try:
+        breaker.call(boom)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("call() swallowed the exception")
+    snap = breaker.snapshot()
+    assert (snap["calls"], snap["failures"], snap["window_calls"]) == (2, 1, 2), snap
+    print("  ✓ result returned, exception re-raised, both recorded")
+
+
+def test_kb_load_under_breaker():
+    """Test 4: knowledge base failures count; an open breaker skips the load."""
+    print("\n" + "=" * 60)
+    print("TEST 4: RAG knowledge base loaded under the breaker")
+    print("=" * 60)
+
+    loads = []
+
+    def broken_kb(raise_errors=False):
+        loads.append(raise_errors)
+        raise RuntimeError("embeddings unavailable")
+
+    saved = classifier._breakers["rag"], classifier.USE_RAG_CLASSIFIER, rc.initialize_knowledge_base
+    classifier._breakers["rag"] = breaker = CircuitBreaker("rag")
+    classifier.USE_RAG_CLASSIFIER = True
+    rc.initialize_knowledge_base = broken_kb
+    try:
+        for _ in range(classifier.BREAKER_MIN_CALLS):
+            assert classifier._build_messages_with_escalation("super pro to the lanes",
+                                                              "2026-06-01T12:00:00Z", [], None) == []
+        snap = breaker.snapshot()
+        assert loads == [True] * classifier.BREAKER_MIN_CALLS
+        assert snap["state"] == CircuitBreaker.OPEN and snap["failures"] == classifier.BREAKER_MIN_CALLS, snap
+        print(f"  ✓ {len(loads)} failed KB loads recorded: breaker open")
+
+        classifier._build_messages_with_escalation("super pro to the lanes", "2026-06-01T12:00:00Z", [], None)
+        assert len(loads) == classifier.BREAKER_MIN_CALLS and breaker.snapshot()["skipped"] == 1
+        print("  ✓ open breaker: KB load not attempted")
+    finally:
+        classifier._breakers["rag"], classifier.USE_RAG_CLASSIFIER, rc.initialize_knowledge_base = saved
+
+
+def main():
+    test_opens_on_failure_ratio()
+    test_half_open_probe()
+    test_call_records_outcome()
+    test_kb_load_under_breaker()
+    print("\nAll circuit breaker tests passed.")
+
+
+if __name__ == "__main__":
+    main()
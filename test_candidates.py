@@ -0,0 +1,159 @@
+"""
+test_candidates.py - Candidate class pruning for the RAG prompt
+
+Runs rag_classifier.classify_with_rag against a fake OpenAI client that
+records each request and returns a canned answer, and checks that:
+  1. rank_candidate_classes returns at most LLM_CANDIDATE_TOP_N classes,
+     the likeliest first, and only those reach the user message, each with
+     its aliases
+  2. the response schema limits class_name to the candidates plus OTHER
+     (and leaves it open when there are no candidates)
+  3. an OTHER answer produces no message, while valid answers in the same
+     response still do
+
+Usage:
+  python test_candidates.py
+  (or: python -m pytest test_candidates.py)
+"""
+
+import contextlib
+import json
+import sys
+import types
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import rag_classifier as rc
+
+TRANSCRIPT = "soupr pro staging lanes"
+
+
+class FakeOpenAI:
+    """Just enough of the OpenAI client: chat.completions.create, non-streamed."""
+
+    def __init__(self, results):
+        self.results = results
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **request):
+        self.requests.append(request)
+        message = types.SimpleNamespace(content=json.dumps({"results": self.results}))
+        return types.SimpleNamespace(usage=None, choices=[types.SimpleNamespace(message=message)])
+
+
+@contextlib.contextmanager
+def fake_openai(results=()):
+    """classify_with_rag on a FakeOpenAI, unbatched, unstreamed and without the KB or retrieval."""
+    client = FakeOpenAI(list(results))
+    saved = {name: getattr(rc, name) for name in
+             ("_get_client", "RAG_STREAMING", "RAG_BATCH_ENABLED", "initialize_knowledge_base",
+              "retrieve_relevant_chunks")}
+    rc._get_client = lambda: client
+    rc.RAG_STREAMING = False
+    rc.RAG_BATCH_ENABLED = False
+    rc.initialize_knowledge_base = lambda raise_errors=False: None
+    rc.retrieve_relevant_chunks = lambda *args, **kwargs: []
+    try:
+        yield client
+    finally:
+        for name, value in saved.items():
+            setattr(rc, name, value)
+
+
+def user_message(request):
+    return next(m["content"] for m in request["messages"] if m["role"] == "user")
+
+
+def class_name_schema(request):
+    schema = request["response_format"]["json_schema"]["schema"]
+    return schema["properties"]["results"]["items"]["properties"]["class_name"]
+
+
+# ===========================
+# Tests
+# ===========================
+def test_candidates_in_user_message():
+    """Test 1: top-N candidates, with aliases, in the user message."""
+    print("\n" + "=" * 60)
+    print("TEST 1: top-N candidates and their aliases in the prompt")
+    print("=" * 60)
+
+    top_n = 3
+    candidates = classifier.rank_candidate_classes(TRANSCRIPT, top_n=top_n)
+    assert len(candidates) == top_n and "Super Pro" in candidates, candidates
+    scores = classifier.score_class_candidates(TRANSCRIPT)
+    assert [scores[c] for c in candidates] == sorted((scores[c] for c in candidates), reverse=True)
+    assert min(scores[c] for c in candidates) >= max(
+        (s for c, s in scores.items() if c not in candidates), default=0), scores
+
+    classmap = classifier.get_classmap()
+    with fake_openai() as client:
+        rc.classify_with_rag(TRANSCRIPT, "2026-06-01T12:00:00Z", candidate_classes=candidates,
+                             debounce=False)
+    text = user_message(client.requests[0])
+    for cls in candidates:
+        aliases = classmap[cls]["aliases"]
+        assert f"- {cls} (aliases/phonetics: {', '.join(aliases)})" in text, cls
+    listed = [line for line in text.splitlines() if line.startswith("- ")]
+    assert len(listed) == top_n, listed
+    assert f'Transcript: "{TRANSCRIPT}"' in text
+    print(f"  ✓ {candidates} listed with aliases, no other class in the user message")
+
+
+def test_schema_enum():
+    """Test 2: class_name enum = candidates + OTHER."""
+    print("\n" + "=" * 60)
+    print("TEST 2: schema enum limited to the candidates")
+    print("=" * 60)
+
+    candidates = ["Super Pro", "Pro", "Super Gas"]
+    with fake_openai() as client:
+        rc.classify_with_rag(TRANSCRIPT, "2026-06-01T12:00:00Z", candidate_classes=candidates,
+                             debounce=False)
+    enum = class_name_schema(client.requests[0])["enum"]
+    assert set(enum) == set(candidates) | {rc.OTHER_CLASS} and len(enum) == len(candidates) + 1, enum
+    print(f"  ✓ enum {enum}")
+
+    # No candidates (full catalogue): class_name stays an open string
+    saved = rc._resolve_candidate_classes
+    rc._resolve_candidate_classes = lambda transcript, candidate_classes=None: None
+    try:
+        with fake_openai() as client:
+            rc.classify_with_rag(TRANSCRIPT, "2026-06-01T12:00:00Z", debounce=False)
+    finally:
+        rc._resolve_candidate_classes = saved
+    assert class_name_schema(client.requests[0]) == {"type": "string"}
+    print("  ✓ no candidates: no enum")
+
+
+def test_other_yields_no_message():
+    """Test 3: OTHER is dropped, the rest of the answer kept."""
+    print("\n" + "=" * 60)
+    print("TEST 3: an OTHER answer yields no message")
+    print("=" * 60)
+
+    other = {"class_name": rc.OTHER_CLASS, "intent": "CLASS_TO_LANES", "message_text": "Nitro Harley to the lanes"}
+    known = {"class_name": "Super Pro", "intent": "CLASS_TO_LANES", "message_text": "Super Pro to the lanes"}
+    with fake_openai([other]):
+        assert rc.classify_with_rag(TRANSCRIPT, "2026-06-01T12:00:00Z", candidate_classes=["Super Pro"],
+                                    debounce=False) == []
+    with fake_openai([other, known]):
+        msgs = rc.classify_with_rag(TRANSCRIPT, "2026-06-01T12:00:00Z", candidate_classes=["Super Pro"],
+                                    debounce=False)
+    assert [(m["class_name"], m["intent"]) for m in msgs] == [("Super Pro", "CLASS_TO_LANES")], msgs
+    print("  ✓ OTHER alone → no messages; OTHER + Super Pro → Super Pro only")
+
+
+def main():
+    test_candidates_in_user_message()
+    test_schema_enum()
+    test_other_yields_no_message()
+    print("\nAll candidate pruning tests passed.")
+
+
+if __name__ == "__main__":
+    main()
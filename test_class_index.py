@@ -0,0 +1,142 @@
+"""
+test_class_index.py - Precompiled class index artifact (classifier.save/load_class_index)
+
+Writes the artifact for a temporary class map and checks that:
+  1. it loads back to the same alias, phonetic and intent indexes
+  2. it is keyed on the class map's content hash: a snapshot with the same
+     classes under a new version number still loads, while a patch, a
+     changed snapshot or changed intent patterns make it stale
+  3. a stale or unreadable artifact is rebuilt and rewritten by the first
+     lookup (_ensure_alias_map)
+
+Usage:
+  python test_class_index.py
+  (or: python -m pytest test_class_index.py)
+"""
+
+import sys
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import config
+from test_classmap import CLASSES, isolated_classmap, patch
+
+
+def indexes():
+    return (dict(classifier._alias_to_canonical),
+            {code: set(names) for code, names in classifier._phonetic_index.items()},
+            dict(classifier._intent_choices), classifier._alias_subset(None)[0])
+
+
+def reset():
+    """Forget the built indexes, as at boot."""
+    classifier._alias_map_ready = False
+    classifier._alias_map_key = None
+
+
+# ===========================
+# Tests
+# ===========================
+def test_round_trip():
+    """Test 1: save, forget, load."""
+    print("\n" + "=" * 60)
+    print("TEST 1: artifact round trip")
+    print("=" * 60)
+
+    try:
+        with isolated_classmap() as tmp:
+            path = tmp / "class_index.pkl"
+            classifier.rebuild_alias_map()
+            built = indexes()
+            classifier.save_class_index(path)
+            reset()
+            assert classifier.load_class_index(path)
+            assert classifier._alias_map_ready and indexes() == built
+            print(f"  ✓ {len(built[0])} aliases, {len(built[1])} phonetic codes loaded back unchanged")
+    finally:
+        classifier.rebuild_alias_map()   # back to the real class map
+
+
+def test_staleness_follows_content_hash():
+    """Test 2: what does and does not invalidate the artifact."""
+    print("\n" + "=" * 60)
+    print("TEST 2: staleness keyed on the class map hash")
+    print("=" * 60)
+
+    saved_patterns = classifier.INTENT_PATTERNS
+    try:
+        with isolated_classmap() as tmp:
+            path = tmp / "class_index.pkl"
+            classifier.rebuild_alias_map()
+            classifier.save_class_index(path)
+
+            config.update_classmap_from_json({"version": 2, "classes": CLASSES})
+            assert classifier.load_class_index(path)
+            print("  ✓ same classes under a new version number: still current")
+
+            add = {"op": "add", "class": {"id": 90, "name": "Pro Mod", "aliases": ["pro mod"]}}
+            assert config.apply_classmap_patch(patch(2, 3, add)) is not None
+            assert not classifier.load_class_index(path)
+            config.update_classmap_from_json({"version": 4, "classes": CLASSES})
+            assert classifier.load_class_index(path)
+            print("  ✓ stale after a patch; current again once the map is back to its content")
+
+            renamed = [dict(CLASSES[0], aliases=["super pro", "spr"])] + CLASSES[1:]
+            config.update_classmap_from_json({"version": 5, "classes": renamed})
+            assert not classifier.load_class_index(path)
+            config.update_classmap_from_json({"version": 6, "classes": CLASSES})
+
+            classifier.INTENT_PATTERNS = dict(saved_patterns, RESULTS=["results are posted"])
+            assert not classifier.load_class_index(path)
+            print("  ✓ stale after an alias change or new intent patterns")
+    finally:
+        classifier.INTENT_PATTERNS = saved_patterns
+        classifier.rebuild_alias_map()
+
+
+def test_stale_artifact_is_rewritten():
+    """Test 3: the first lookup rebuilds and refreshes a stale or broken artifact."""
+    print("\n" + "=" * 60)
+    print("TEST 3: stale / unreadable artifact rebuilt on first use")
+    print("=" * 60)
+
+    saved_path = classifier.CLASS_INDEX_PATH
+    try:
+        with isolated_classmap() as tmp:
+            classifier.CLASS_INDEX_PATH = path = tmp / "class_index.pkl"
+            classifier.rebuild_alias_map()
+            classifier.save_class_index(path)
+
+            remove = {"op": "remove", "name": "Super Gas"}
+            assert config.apply_classmap_patch(patch(1, 2, remove)) is not None
+            reset()
+            assert "Super Gas" not in classifier.find_classes("super gas to the lanes")
+            assert classifier._alias_map_key == classifier._class_index_key()
+            reset()
+            assert classifier.load_class_index(path), "stale artifact not rewritten"
+            assert "sg" not in classifier._alias_to_canonical
+            print("  ✓ stale artifact rebuilt for the patched map and rewritten")
+
+            path.write_bytes(b"not a pickle")
+            reset()
+            assert classifier.find_classes("super pro to the lanes") == ["Super Pro"]
+            reset()
+            assert classifier.load_class_index(path)
+            print("  ✓ unreadable artifact ignored and replaced")
+    finally:
+        classifier.CLASS_INDEX_PATH = saved_path
+        classifier.rebuild_alias_map()
+
+
+def main():
+    test_round_trip()
+    test_staleness_follows_content_hash()
+    test_stale_artifact_is_rewritten()
+    print("\nAll class index tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+test_classmap.py - Class-map snapshots, patches and the patch journal
+
+Points config at a temporary class_config.json / journal and checks that:
+  1. a snapshot replaces the journal only once the snapshot file is written,
+     so a restart before that still loads the old file plus its patches
+  2. a restart replays the journaled patches to the same map and revision,
+     skips a torn last line and never journals a rejected patch
+  3. classifier.update_alias_map leaves the alias and phonetic indexes
+     exactly as a full rebuild_alias_map() would, including aliases shared
+     between classes and an alias equal to another class's name
+
+Usage:
+  python test_classmap.py
+  (or: python -m pytest test_classmap.py)
+"""
+
+import contextlib
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import config
+
+CLASSES = [{"id": 73, "name": "Super Pro", "aliases": ["super pro", "spro"]},
+           {"id": 12, "name": "Pro Stock", "aliases": ["pro stock"]},
+           {"id": 5, "name": "Super Gas", "aliases": ["super gas", "sg"]}]
+
+
+@contextlib.contextmanager
+def isolated_classmap(classes=CLASSES, version=1):
+    """config reading and writing a temporary class_config.json + journal, restored afterwards."""
+    names = ("CLASS_CONFIG_PATH", "CLASS_CONFIG_JOURNAL_PATH", "CLASS_CONFIG_WRITE_DELAY",
+             "_class_map", "_class_map_version", "_class_map_revision", "_journal_entries")
+    saved = {name: getattr(config, name) for name in names}
+    config._config_writer.flush()
+    tmp = Path(tempfile.mkdtemp())
+    config.CLASS_CONFIG_PATH = tmp / "class_config.json"
+    config.CLASS_CONFIG_JOURNAL_PATH = tmp / "class_config.journal"
+    config.CLASS_CONFIG_WRITE_DELAY = 60.0   # writes land only on flush()
+    config._config_writer._last_hash = None
+    config.CLASS_CONFIG_PATH.write_text(json.dumps({"version": version, "classes": classes}))
+    config.initialize_classmap()
+    try:
+        yield tmp
+    finally:
+        config._config_writer._pending = None
+        config._config_writer._last_hash = None
+        for name, value in saved.items():
+            setattr(config, name, value)
+
+
+def restart():
+    """What a fresh process would load: the snapshot file plus the journal."""
+    config.initialize_classmap()
+    return config.get_classmap_revision(), config.get_classmap()
+
+
+def patch(base, version, *ops):
+    return {"base_version": base, "version": version, "ops": list(ops)}
+
+
+# ===========================
+# Tests
+# ===========================
+def test_snapshot_clears_journal_once_written():
+    """Test 1: the journal survives until the snapshot that supersedes it is on disk."""
+    print("\n" + "=" * 60)
+    print("TEST 1: snapshot replaces the journal only once written")
+    print("=" * 60)
+
+    with isolated_classmap():
+        add = {"op": "add", "class": {"id": 90, "name": "Pro Mod", "aliases": ["pro mod"]}}
+        assert config.apply_classmap_patch(patch(1, 2, add)) is not None
+        journal = config.CLASS_CONFIG_JOURNAL_PATH
+        assert journal.exists()
+
+        config.update_classmap_from_json({"version": 5, "classes": CLASSES[:2]})
+        assert config.get_classmap_revision() == 5
+        assert journal.exists(), "journal dropped before the snapshot was written"
+
+        # Crash here: the old file + journal is still a consistent state
+        revision, classmap = restart()
+        assert revision == 2 and "Pro Mod" in classmap, (revision, sorted(classmap))
+        print("  ✓ before the write lands, a restart loads the old snapshot + patch")
+
+        config.update_classmap_from_json({"version": 5, "classes": CLASSES[:2]})
+        config._config_writer.flush()
+        assert not journal.exists(), "journal kept after the snapshot was written"
+        revision, classmap = restart()
+        assert revision == 5 and sorted(classmap) == ["Pro Stock", "Super Pro"], (revision, sorted(classmap))
+        print("  ✓ once written, the journal is dropped and a restart loads the snapshot")
+
+        # A patch on top of an unwritten snapshot keeps the journal
+        config.update_classmap_from_json({"version": 6, "classes": CLASSES})
+        remove = {"op": "remove", "name": "Super Gas"}
+        assert config.apply_classmap_patch(patch(6, 7, remove)) is not None
+        config._config_writer.flush()
+        assert journal.exists()
+        revision, classmap = restart()
+        assert revision == 7 and "Super Gas" not in classmap, (revision, sorted(classmap))
+        print("  ✓ a patch that arrived before the write keeps its journal entry")
+
+
+def test_journal_replay():
+    """Test 2: a restart replays the journal to the state the patches produced."""
+    print("\n" + "=" * 60)
+    print("TEST 2: journal replay")
+    print("=" * 60)
+
+    with isolated_classmap():
+        patches = [
+            patch(1, 2, {"op": "add", "class": {"id": 90, "name": "Pro Mod", "aliases": ["pro mod"]}}),
+            patch(2, 3, {"op": "alias", "name": "Super Pro", "add": ["sp"], "remove": ["spro"]}),
+            patch(3, 4, {"op": "remove", "name": "Pro Stock"}),
+        ]
+        for p in patches:
+            assert config.apply_classmap_patch(p) is not None, p
+        expected = (config.get_classmap_revision(), config.get_classmap(), config.get_classmap_version())
+
+        # Rejected: wrong base version, unknown class, unknown op
+        assert config.apply_classmap_patch(patch(2, 5, {"op": "remove", "name": "Super Gas"})) is None
+        assert config.apply_classmap_patch(patch(4, 5, {"op": "remove", "name": "Pro Stock"})) is None
+        assert config.apply_classmap_patch(patch(4, 5, {"op": "rename", "name": "Super Gas"})) is None
+        journal = config.CLASS_CONFIG_JOURNAL_PATH
+        assert len(journal.read_text().splitlines()) == len(patches)
+
+        revision, classmap = restart()
+        assert (revision, classmap, config.get_classmap_version()) == expected, (revision, sorted(classmap))
+        assert classmap["Super Pro"]["aliases"] == ["super pro", "sp"], classmap["Super Pro"]
+        print(f"  ✓ {len(patches)} journaled patches replayed to revision {revision}; rejected patches not journaled")
+
+        # A crash mid-append leaves a torn last line
+        with journal.open("a", encoding="utf-8") as f:
+            f.write('{"base_version": 4, "version": 5, "ops": [{"op": "rem')
+        revision, classmap = restart()
+        assert (revision, classmap) == expected[:2], (revision, sorted(classmap))
+        print("  ✓ torn last line ignored")
+
+
+def test_alias_patch_matches_rebuild():
+    """Test 3: incremental alias map updates equal a full rebuild after every patch."""
+    print("\n" + "=" * 60)
+    print("TEST 3: update_alias_map matches rebuild_alias_map")
+    print("=" * 60)
+
+    def indexes():
+        return (dict(classifier._alias_to_canonical),
+                {code: set(names) for code, names in classifier._phonetic_index.items()},
+                sorted(classifier._alias_choices), list(classifier._canonical_names))
+
+    steps = [
+        # "sg" shared with Super Gas: the later class owns it ...
+        ("add a class sharing an alias", {"op": "add", "class": {"id": 7, "name": "Stock Gas", "aliases": ["sg", "stock gas"]}},
+         ("sg", "Stock Gas")),
+        # ... and dropping it there hands it back to Super Gas
+        ("drop the shared alias", {"op": "alias", "name": "Stock Gas", "remove": ["sg"]}, ("sg", "Super Gas")),
+        ("share an alias the other way", {"op": "alias", "name": "Pro Stock", "add": ["spro"]}, ("spro", "Pro Stock")),
+        ("remove the class holding it", {"op": "remove", "name": "Pro Stock"}, ("spro", "Super Pro")),
+        # An alias beats another class's own name
+        ("alias another class's name", {"op": "add", "class": {"id": 8, "name": "Comp", "aliases": ["super gas"]}},
+         ("super gas", "Comp")),
+        ("remove that class", {"op": "remove", "name": "Comp"}, ("super gas", "Super Gas")),
+        ("replace a class's aliases", {"op": "add", "class": {"id": 73, "name": "Super Pro", "aliases": ["sp", "s pro"]}},
+         ("spro", None)),
+    ]
+    try:
+        with isolated_classmap():
+            classifier.rebuild_alias_map()
+            for revision, (label, op, (alias, owner)) in enumerate(steps, start=1):
+                changes = config.apply_classmap_patch(patch(revision, revision + 1, op))
+                assert changes is not None, label
+                classifier.update_alias_map(changes)
+                assert classifier._alias_to_canonical.get(alias) == owner, (label, alias)
+                patched = indexes()
+                classifier.rebuild_alias_map()
+                assert patched == indexes(), f"{label}: {patched} != {indexes()}"
+                print(f"  ✓ {label}: {alias!r} → {owner}")
+    finally:
+        classifier.rebuild_alias_map()   # back to the real class map
+
+
+def main():
+    test_snapshot_clears_journal_once_written()
+    test_journal_replay()
+    test_alias_patch_matches_rebuild()
+    print("\nAll class map tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+test_expiry.py - expiry.ExpiryWindow expiry and size cap
+
+Drives windows with explicit `now` values and checks that:
+  1. a key is suppressed for exactly `window` seconds after it was recorded,
+     and a suppressed repeat does not extend the window
+  2. expired keys leave the set as time passes, and a key recorded again
+     after expiring starts a new window
+  3. past max_entries the oldest key is evicted early and counted
+  4. concurrent check_and_set calls for one key record it exactly once
+  5. evicting live keys is logged as a warning at most once per window
+  6. classifier's debounce and dedup key on class ids, so a renamed class
+     stays suppressed, and the debounce cap covers every class+intent pair
+
+Usage:
+  python test_expiry.py
+  (or: python -m pytest test_expiry.py)
+"""
+
+import logging
+import sys
+import threading
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import config
+from expiry import ExpiryWindow
+from test_classmap import CLASSES, isolated_classmap
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+# ===========================
+# Tests
+# ===========================
+def test_window_not_extended():
+    """Test 1: suppressed within the window, recorded again at its end."""
+    print("\n" + "=" * 60)
+    print("TEST 1: window length")
+    print("=" * 60)
+
+    w = ExpiryWindow(10.0, 100)
+    assert w.check_and_set("a", now=100.0) is False
+    assert w.check_and_set("a", now=105.0) is True
+    assert w.check_and_set("a", now=109.9) is True, "repeat at +5s extended the window"
+    assert w.check_and_set("a", now=110.0) is False
+    assert w.check_and_set("a", now=119.9) is True
+    print("  ✓ suppressed for 10s from the first record, repeats do not extend it")
+
+
+def test_expiry():
+    """Test 2: keys expire in record order."""
+    print("\n" + "=" * 60)
+    print("TEST 2: expiry as time passes")
+    print("=" * 60)
+
+    w = ExpiryWindow(10.0, 100)
+    for i, key in enumerate("abcde"):
+        w.check_and_set(key, now=100.0 + i)
+    assert len(w) == 5
+    assert w.check_and_set("f", now=112.5) is False
+    assert len(w) == 3, "a, b and c should have expired"   # d, e, f
+    assert w.check_and_set("a", now=112.5) is False
+    assert w.check_and_set("d", now=112.9) is True
+    # "a" was re-recorded at 112.5: it now outlives d and e
+    assert w.check_and_set("g", now=121.0) is False
+    assert len(w) == 3 and w.check_and_set("a", now=121.0) is True   # f, a, g
+    assert w.evicted == 0
+    print("  ✓ expired keys dropped oldest first; a re-recorded key starts a new window")
+
+    w.clear()
+    assert len(w) == 0 and w.check_and_set("g", now=121.0) is False
+    print("  ✓ clear() forgets everything")
+
+
+def test_cap():
+    """Test 3: max_entries evicts the oldest key early."""
+    print("\n" + "=" * 60)
+    print("TEST 3: size cap")
+    print("=" * 60)
+
+    w = ExpiryWindow(60.0, 3)
+    for i in range(5):
+        assert w.check_and_set(f"k{i}", now=100.0 + i) is False
+    assert len(w) == 3 and w.evicted == 2
+    assert w.check_and_set("k4", now=105.0) is True
+    assert w.check_and_set("k0", now=105.0) is False, "evicted key still suppressed"
+    assert len(w) == 3 and w.evicted == 3   # k0 pushed k2 out
+    assert w.check_and_set("k2", now=105.0) is False
+    print("  ✓ 5 keys into a cap of 3: oldest evicted early, counted in evicted")
+
+
+def test_concurrent_check_and_set():
+    """Test 4: one winner per key across threads."""
+    print("\n" + "=" * 60)
+    print("TEST 4: concurrent check_and_set")
+    print("=" * 60)
+
+    w = ExpiryWindow(60.0, 1000)
+    results = []
+    barrier = threading.Barrier(16)
+
+    def worker():
+        barrier.wait()
+        for i in range(200):
+            results.append((i, w.check_and_set(f"key{i}")))
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    recorded = [i for i, suppressed in results if not suppressed]
+    assert sorted(recorded) == list(range(200)), len(recorded)
+    assert len(w) == 200
+    print("  ✓ 16 threads × 200 keys: each key recorded once")
+
+
+def test_live_eviction_warning():
+    """Test 5: warn on evicting live keys, once per window."""
+    print("\n" + "=" * 60)
+    print("TEST 5: live-key eviction warning")
+    print("=" * 60)
+
+    handler = Collect()
+    logger = logging.getLogger("asr.expiry")
+    logger.addHandler(handler)
+    try:
+        w = ExpiryWindow(10.0, 2, name="debounce")
+        for i in range(6):
+            w.check_and_set(f"k{i}", now=100.0 + i)
+        assert w.evicted == 4 and handler.messages == [
+            "debounce: over 2 entries, evicted 1 live key(s) early"], handler.messages
+        w.check_and_set("k6", now=112.0)   # k4 and k5 still live: one more eviction
+        assert handler.messages[1:] == ["debounce: over 2 entries, evicted 4 live key(s) early"], handler.messages
+        print("  ✓ first eviction warned; the next warning a window later carries the count since")
+    finally:
+        logger.removeHandler(handler)
+
+
+def test_classifier_keys_on_class_id():
+    """Test 6: renamed class still debounced; cap sized from the class map."""
+    print("\n" + "=" * 60)
+    print("TEST 6: debounce / dedup keyed on class ids")
+    print("=" * 60)
+
+    try:
+        with isolated_classmap():
+            classifier.rebuild_alias_map()
+            classifier._debounce.clear()
+            classifier._dedup.clear()
+            assert classifier.should_send("Super Pro", "CLASS_TO_LANES")
+            assert not classifier.is_duplicate_result(["Super Pro", "Pro Stock"], "CLASS_STANDBY")
+
+            renamed = [dict(CLASSES[0], name="Super Pro Eliminator")] + CLASSES[1:]
+            config.update_classmap_from_json({"version": 2, "classes": renamed})
+            classifier.rebuild_alias_map()
+            assert not classifier.should_send("Super Pro Eliminator", "CLASS_TO_LANES")
+            assert classifier.should_send("Super Pro Eliminator", "CLASS_STANDBY")
+            assert classifier.is_duplicate_result(["Pro Stock", "Super Pro Eliminator"], "CLASS_STANDBY")
+            print("  ✓ same id under a new name: still debounced and deduplicated")
+
+            many = [{"id": i, "name": f"Class {i}", "aliases": []} for i in range(10000)]
+            config.update_classmap_from_json({"version": 3, "classes": many})
+            classifier.rebuild_alias_map()
+            pairs = len(many) * len(config.INTENT_PATTERNS)
+            assert classifier._debounce.max_entries == max(config.DEBOUNCE_MAX_ENTRIES, pairs)
+            print(f"  ✓ {len(many)} classes: debounce cap {classifier._debounce.max_entries}")
+    finally:
+        classifier._debounce.clear()
+        classifier._dedup.clear()
+        classifier.rebuild_alias_map()
+
+
+def main():
+    test_window_not_extended()
+    test_expiry()
+    test_cap()
+    test_concurrent_check_and_set()
+    test_live_eviction_warning()
+    test_classifier_keys_on_class_id()
+    print("\nAll expiry window tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+test_gate.py - Confidence-gated LLM escalation (classifier._gate_decision)
+
+Scores transcripts against the shipped class_config.json and checks that:
+  1. score_transcript's confidence is the weakest class evidence times the
+     weakest intent, with no confidence for a class without an intent and a
+     penalty for conflicting intents
+  2. _gate_decision answers locally at LOCAL_ACCEPT_CONFIDENCE and above,
+     escalates below it, and with no class detected escalates only a
+     near-miss scoring LOCAL_ESCALATE_MIN_SCORE (otherwise drops it)
+  3. build_messages calls the LLM only for escalated transcripts, passes it
+     the ranked candidate classes, and counts every decision
+
+Usage:
+  python test_gate.py
+  (or: python -m pytest test_gate.py)
+"""
+
+import sys
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+from classifier import _gate_decision, score_transcript
+
+NO_CLASS = {"classes": [], "shadowed": [], "evidence": {}, "intents": {}, "confidence": 0.0}
+
+
+# ===========================
+# Tests
+# ===========================
+def test_confidence():
+    """Test 1: confidence from class evidence and intent strength."""
+    print("\n" + "=" * 60)
+    print("TEST 1: score_transcript confidence")
+    print("=" * 60)
+
+    exact = score_transcript("super pro to the lanes")
+    assert exact["classes"] == ["Super Pro"] and exact["confidence"] == 1.0, exact
+    print("  ✓ exact class + exact intent → 1.0")
+
+    fuzzy = score_transcript("soupr pro staging lanes")
+    expected = min(fuzzy["evidence"].values()) * min(fuzzy["intents"].values())
+    assert 0 < fuzzy["confidence"] == expected < 1.0, fuzzy
+    print(f"  ✓ fuzzy evidence → weakest class × weakest intent = {fuzzy['confidence']:.2f}")
+
+    no_intent = score_transcript("super pro")
+    assert no_intent["classes"] == ["Super Pro"] and no_intent["confidence"] == 0.0, no_intent
+    conflict = score_transcript("super pro to the lanes and super pro standby")
+    assert {"CLASS_TO_LANES", "CLASS_STANDBY"} <= set(conflict["intents"]), conflict
+    assert conflict["confidence"] == classifier._CONFLICT_PENALTY, conflict
+    print(f"  ✓ class without intent → 0.0; lanes + standby → {conflict['confidence']:.2f}")
+
+
+def test_gate_decision():
+    """Test 2: the accept threshold and the no-class near-miss rule."""
+    print("\n" + "=" * 60)
+    print("TEST 2: _gate_decision thresholds")
+    print("=" * 60)
+
+    threshold = classifier.LOCAL_ACCEPT_CONFIDENCE
+    at = dict(NO_CLASS, classes=["Super Pro"], confidence=threshold)
+    below = dict(at, confidence=threshold - 0.01)
+    assert _gate_decision(at, "super pro to the lanes", None) == ("local", None)
+    assert _gate_decision(below, "super pro to the lanes", None) == ("escalated", None)
+    print(f"  ✓ confidence {threshold} → local, {threshold - 0.01:.2f} → escalated")
+
+    decision, scores = _gate_decision(NO_CLASS, "supper proe", None)
+    assert decision == "escalated" and scores["Super Pro"] >= classifier.LOCAL_ESCALATE_MIN_SCORE, scores
+    decision, scores = _gate_decision(NO_CLASS, "uh okay thanks everyone", None)
+    assert decision == "dropped", scores
+    assert max(scores.values(), default=0) < classifier.LOCAL_ESCALATE_MIN_SCORE, scores
+    print("  ✓ no class: near-miss escalated with its scores, chatter dropped")
+
+    # The near-miss rule only looks at the scoped classes
+    decision, _ = _gate_decision(NO_CLASS, "supper proe", ["Top Fuel"])
+    assert decision == "dropped"
+    print("  ✓ a near-miss outside the track scope is dropped")
+
+
+def test_build_messages_routing():
+    """Test 3: only escalated transcripts reach the LLM."""
+    print("\n" + "=" * 60)
+    print("TEST 3: build_messages routes on the gate")
+    print("=" * 60)
+
+    llm_calls = []
+
+    def fake_llm(transcript, timestamp, classes, candidate_classes=None):
+        llm_calls.append((transcript, candidate_classes))
+        return []
+
+    saved = {name: getattr(classifier, name) for name in
+             ("_build_messages_with_escalation", "USE_RAG_CLASSIFIER", "get_candidate_classes")}
+    saved_counts = dict(classifier._gate_counts)
+    classifier._build_messages_with_escalation = fake_llm
+    classifier.USE_RAG_CLASSIFIER = True
+    classifier.get_candidate_classes = lambda: None
+    classifier._debounce.clear()
+    classifier._dedup.clear()
+    for decision in classifier._gate_counts:
+        classifier._gate_counts[decision] = 0
+    try:
+        msgs = classifier.build_messages("super pro to the lanes", "2026-06-01T12:00:00Z")
+        assert [(m["class_name"], m["intent"]) for m in msgs] == [("Super Pro", "CLASS_TO_LANES")], msgs
+        assert classifier.build_messages("uh okay thanks everyone", "2026-06-01T12:00:01Z") == []
+        assert llm_calls == []
+        print("  ✓ confident transcript answered locally, chatter dropped, no LLM call")
+
+        classifier.build_messages("soupr pro staging lanes", "2026-06-01T12:00:02Z")
+        assert len(llm_calls) == 1, llm_calls
+        transcript, candidates = llm_calls[0]
+        assert transcript == "soupr pro staging lanes" and "Super Pro" in candidates, candidates
+        assert len(candidates) <= classifier.LLM_CANDIDATE_TOP_N, candidates
+        print(f"  ✓ ambiguous transcript escalated with candidates {candidates}")
+
+        stats = classifier.get_gate_stats()
+        assert (stats["local"], stats["escalated"], stats["dropped"]) == (1, 1, 1), stats
+        assert abs(stats["escalation_rate"] - 1 / 3) < 1e-9, stats
+        print("  ✓ gate counts local=1 escalated=1 dropped=1")
+    finally:
+        for name, value in saved.items():
+            setattr(classifier, name, value)
+        classifier._gate_counts.update(saved_counts)
+        classifier._debounce.clear()
+        classifier._dedup.clear()
+
+
+def main():
+    test_confidence()
+    test_gate_decision()
+    test_build_messages_routing()
+    print("\nAll gate tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+test_log.py - Rate limiting and JSON output of the pipeline logger (log.py)
+
+Feeds records through log's filters and formatters on a test logger and
+checks that:
+  1. a burst from one log call is cut to LOG_RATE_LIMIT records a second,
+     and the next record let through reports how many were suppressed;
+     warnings and other call sites are not limited
+  2. JSON lines carry the subsystem, level, structured fields and, under a
+     trace, its trace_id and trace_ms, read when the record was made even
+     though it is formatted later on another thread
+
+Usage:
+  python test_log.py
+  (or: python -m pytest test_log.py)
+"""
+
+import contextvars
+import json
+import logging
+import sys
+import threading
+import types
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import log
+import tracing
+
+
+class Collect(logging.Handler):
+    """Keeps the records that pass its filters, unformatted."""
+
+    def __init__(self, *filters):
+        super().__init__()
+        self.records = []
+        for f in filters:
+            self.addFilter(f)
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_logger(handler):
+    logger = logging.getLogger("asr.test")
+    logger.handlers[:] = [handler]
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+# ===========================
+# Tests
+# ===========================
+def test_rate_limit():
+    """Test 1: a burst collapses into LOG_RATE_LIMIT records plus a suppressed count."""
+    print("\n" + "=" * 60)
+    print("TEST 1: rate-limited burst")
+    print("=" * 60)
+
+    clock = types.SimpleNamespace(now=100.0)
+    saved = log.time
+    log.time = types.SimpleNamespace(monotonic=lambda: clock.now)
+    handler = Collect(log._RateLimitFilter(5))
+    logger = make_logger(handler)
+
+    def burst(n):
+        for i in range(n):
+            logger.debug("frames %s", i)   # one call site
+
+    try:
+        burst(20)
+        logger.info("other call site")
+        logger.warning("overflow")
+        for _ in range(3):
+            logger.warning("overflow")
+        assert [r.getMessage() for r in handler.records] == [f"frames {i}" for i in range(5)] + \
+            ["other call site"] + ["overflow"] * 4
+        print("  ✓ 20 identical calls in a second: 5 through; other sites and warnings untouched")
+
+        clock.now += 1.0
+        handler.records.clear()
+        burst(2)
+        first = handler.records[0]
+        assert first.suppressed == 15 and not hasattr(handler.records[1], "suppressed")
+        assert log._TextFormatter().format(first) == "[test] frames 0 (15 similar suppressed)"
+        assert json.loads(log._JsonFormatter().format(first))["suppressed"] == 15
+        print("  ✓ next window: first record reports 15 suppressed, in text and JSON")
+    finally:
+        log.time = saved
+        logger.handlers.clear()
+
+
+def test_json_trace_fields():
+    """Test 2: JSON line with fields and the trace of the logging context."""
+    print("\n" + "=" * 60)
+    print("TEST 2: JSON output with trace fields")
+    print("=" * 60)
+
+    handler = Collect(log._ContextFilter())
+    logger = make_logger(handler)
+
+    def utterance():
+        trace = tracing.start_trace()
+        logger.info("sent %s", "Super Pro", extra={"fields": {"class_name": "Super Pro"}})
+        return trace
+
+    try:
+        trace = contextvars.Context().run(utterance)
+        logger.warning("no trace here")
+
+        lines = []
+        # Formatted on another thread, as the QueueListener does
+        formatter = threading.Thread(target=lambda: lines.extend(
+            json.loads(log._JsonFormatter().format(r)) for r in handler.records))
+        formatter.start()
+        formatter.join()
+
+        traced, untraced = lines
+        assert traced["msg"] == "sent Super Pro" and traced["subsystem"] == "test" and traced["level"] == "info"
+        assert traced["class_name"] == "Super Pro"
+        assert traced["trace_id"] == trace.trace_id and traced["trace_ms"] >= 0, traced
+        assert untraced["level"] == "warning" and "trace_id" not in untraced and "trace_ms" not in untraced
+        print(f"  ✓ {json.dumps(traced)}")
+        print("  ✓ a record made outside a trace has no trace fields")
+    finally:
+        logger.handlers.clear()
+
+
+def main():
+    test_rate_limit()
+    test_json_trace_fields()
+    print("\nAll log tests passed.")
+
+
+if __name__ == "__main__":
+    main()
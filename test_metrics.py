@@ -0,0 +1,149 @@
+"""
+test_metrics.py - Prometheus exposition of counters, collectors and stage histograms (metrics.py)
+
+Renders render_prometheus() against a clean registry and checks that:
+  1. counters are typed as counters, summed per label set, with labels
+     sorted and escaped
+  2. Outbox.metric_samples, registered as a collector, exports the outbox
+     gauges and lifetime counters read at scrape time; a failing collector
+     is skipped and None values are left out
+  3. stage latencies come out as a cumulative histogram, and snapshot()
+     carries the same values for JSON
+
+Usage:
+  python test_metrics.py
+  (or: python -m pytest test_metrics.py)
+"""
+
+import contextlib
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import metrics
+import tracing
+from metrics import inc, register_collector, render_prometheus, snapshot
+from outbox import Outbox
+from test_outbox import PAYLOAD, payloads
+
+
+@contextlib.contextmanager
+def clean_registry():
+    """Empty counters, collectors and stage histograms, restored afterwards."""
+    saved = dict(metrics._counters), list(metrics._collectors)
+    metrics._counters.clear()
+    metrics._collectors.clear()
+    tracing.reset_trace_stats()
+    try:
+        yield
+    finally:
+        metrics._counters.clear()
+        metrics._counters.update(saved[0])
+        metrics._collectors[:] = saved[1]
+        tracing.reset_trace_stats()
+
+
+def lines_of(text, name):
+    return [line for line in text.splitlines() if line.split("{")[0].split(" ")[0] == name
+            or line.startswith(f"# TYPE {name} ")]
+
+
+# ===========================
+# Tests
+# ===========================
+def test_counters():
+    """Test 1: counter lines, label sets and escaping."""
+    print("\n" + "=" * 60)
+    print("TEST 1: counters")
+    print("=" * 60)
+
+    with clean_registry():
+        inc("asr_transcripts_total")
+        inc("asr_transcripts_total")
+        inc("asr_llm_tokens_total", 12, kind="prompt", backend="rag")
+        inc("asr_llm_tokens_total", 3, backend="rag", kind="prompt")
+        inc("asr_llm_tokens_total", 5, backend="rag", kind="completion")
+        inc("asr_ws_reconnects_total")
+        inc("asr_audio_overflow_events_total")
+        inc("asr_llm_errors_total", error='say "hi"\n')
+        text = render_prometheus()
+
+        assert lines_of(text, "asr_transcripts_total") == ["# TYPE asr_transcripts_total counter",
+                                                           "asr_transcripts_total 2"]
+        assert sorted(lines_of(text, "asr_llm_tokens_total")) == [
+            "# TYPE asr_llm_tokens_total counter",
+            'asr_llm_tokens_total{backend="rag",kind="completion"} 5',
+            'asr_llm_tokens_total{backend="rag",kind="prompt"} 15',
+        ], text
+        assert "asr_ws_reconnects_total 1" in text and "asr_audio_overflow_events_total 1" in text
+        assert 'asr_llm_errors_total{error="say \\"hi\\"\\n"} 1' in text
+        print("  ✓ one TYPE line per counter, label sets summed independently, labels escaped")
+
+
+def test_outbox_gauges():
+    """Test 2: the outbox collector at scrape time."""
+    print("\n" + "=" * 60)
+    print("TEST 2: outbox gauges via a collector")
+    print("=" * 60)
+
+    box = Outbox(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+    with clean_registry():
+        register_collector(box.metric_samples)
+        register_collector(lambda: 1 / 0)
+        register_collector(lambda: [("asr_mqtt_inflight", {}, None)])
+
+        box.put_many(payloads(3) + [PAYLOAD, dict(PAYLOAD, message_text="second call")])
+        text = render_prometheus()
+        assert lines_of(text, "asr_outbox_depth") == ["# TYPE asr_outbox_depth gauge", "asr_outbox_depth 4"]
+        assert lines_of(text, "asr_outbox_superseded_total") == ["# TYPE asr_outbox_superseded_total counter",
+                                                                 "asr_outbox_superseded_total 1"]
+        for name in ("asr_outbox_oldest_unsent_age_seconds", "asr_outbox_size_bytes"):
+            assert f"# TYPE {name} gauge" in text and float(lines_of(text, name)[1].split()[1]) >= 0
+        assert "asr_mqtt_inflight" not in text
+        print("  ✓ depth, age and size as gauges, superseded as a counter; failing collector skipped")
+
+        box.ack([id_ for id_, _ in box.pending(10)])
+        assert "asr_outbox_depth 0" in render_prometheus()
+        print("  ✓ read again on the next scrape")
+    box.close()
+
+
+def test_stage_histogram():
+    """Test 3: cumulative buckets, sum and count; the same in snapshot()."""
+    print("\n" + "=" * 60)
+    print("TEST 3: stage histogram exposition")
+    print("=" * 60)
+
+    with clean_registry():
+        for seconds in (0.003, 0.004, 0.2):
+            tracing.record("rag", seconds)
+        text = render_prometheus()
+        assert "# TYPE asr_stage_seconds histogram" in text
+        assert 'asr_stage_seconds_bucket{stage="rag",le="0.0025"} 0' in text
+        assert 'asr_stage_seconds_bucket{stage="rag",le="0.005"} 2' in text
+        assert 'asr_stage_seconds_bucket{stage="rag",le="0.25"} 3' in text
+        assert 'asr_stage_seconds_bucket{stage="rag",le="+Inf"} 3' in text
+        assert 'asr_stage_seconds_count{stage="rag"} 3' in text
+        assert 'asr_stage_seconds_sum{stage="rag"} 0.207' in text
+        print("  ✓ cumulative buckets up to +Inf, sum and count")
+
+        inc("asr_delivered_total", 2)
+        snap = snapshot()
+        assert snap["metrics"]["asr_delivered_total"] == [{"labels": {}, "value": 2}]
+        assert snap["stages"]["rag"]["count"] == 3 and "buckets" not in snap["stages"]["rag"]
+        print("  ✓ snapshot() carries the same counters and stage summaries")
+
+
+def main():
+    test_counters()
+    test_outbox_gauges()
+    test_stage_histogram()
+    print("\nAll metrics tests passed.")
+
+
+if __name__ == "__main__":
+    main()
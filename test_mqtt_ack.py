@@ -0,0 +1,474 @@
+"""
+test_mqtt_ack.py - PUBACK tracking in mqtt_sender against a local broker stand-in
+
+Runs a minimal MQTT 3.1.1 broker on localhost (CONNECT, SUBSCRIBE, PUBLISH
+QoS 0/1, PINGREQ, DISCONNECT; no routing) that can delay or withhold
+PUBACKs or drop its clients, and checks that:
+  1. send_now returns only after the PUBACK
+  2. publish_batch pipelines publishes, never exceeding MQTT_INFLIGHT_WINDOW
+  3. a withheld PUBACK stops publish_batch at the acknowledged prefix
+  4. flush_outbox marks only acknowledged rows sent
+  5. MQTT_BATCH_PUBLISH sends one compact publish per utterance
+  6. mqtt_async.AsyncMqttClient runs callbacks on the event loop, awaits
+     PUBACKs and hands config updates to its executor
+  7. with the broker connection down nothing is handed to paho (which
+     would replay it on reconnect), and a publish that races the drop is
+     delivered once, by paho's replay
+  8. AsyncMqttClient fails publishes while disconnected and fails its
+     in-flight ones when the connection drops, without paho replaying them
+
+Usage:
+  python test_mqtt_ack.py
+  (or: python -m pytest test_mqtt_ack.py)
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import paho.mqtt.client as mqtt
+
+import mqtt_sender
+from mqtt_async import AsyncMqttClient
+
+
+# ===========================
+# Broker stand-in
+# ===========================
+class StubBroker:
+    """
+    Accepts MQTT clients and acknowledges their publishes. ack_delay delays
+    each PUBACK under MQTT_TOPIC; withhold(n) drops the PUBACK of the n-th
+    announcement (1-based) so it never arrives; drop() closes every client
+    connection. Other topics (the config request sent on connect) are acked
+    at once and not recorded.
+    """
+
+    def __init__(self, ack_delay: float = 0.0):
+        self.ack_delay = ack_delay
+        self.received = []          # (topic, payload bytes) of announcements, in arrival order
+        self.max_unacked = 0        # most QoS 1 publishes awaiting a PUBACK at once
+        self._withheld = set()
+        self._unacked = 0
+        self._conns = []
+        self._lock = threading.Lock()
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen()
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def withhold(self, n: int):
+        self._withheld.add(n)
+
+    def drop(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        self._sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _read_exact(conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("client closed")
+            data += chunk
+        return data
+
+    def _read_packet(self, conn):
+        header = self._read_exact(conn, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self._read_exact(conn, 1)[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self._read_exact(conn, length)
+
+    def _serve(self, conn):
+        send_lock = threading.Lock()
+
+        def send(data):
+            with send_lock:
+                conn.sendall(data)
+
+        def ack_later(mid):
+            time.sleep(self.ack_delay)
+            with self._lock:
+                self._unacked -= 1
+            send(struct.pack("!BBH", 0x40, 2, mid))
+
+        try:
+            while True:
+                header, body = self._read_packet(conn)
+                kind = header >> 4
+                if kind == 1:       # CONNECT → CONNACK
+                    send(b"\x20\x02\x00\x00")
+                elif kind == 3:     # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_len = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + topic_len].decode("utf-8")
+                    pos = 2 + topic_len
+                    mid = None
+                    if qos:
+                        mid = struct.unpack("!H", body[pos:pos + 2])[0]
+                        pos += 2
+                    if not topic.startswith(mqtt_sender.MQTT_TOPIC):
+                        if qos:
+                            send(struct.pack("!BBH", 0x40, 2, mid))
+                        continue
+                    with self._lock:
+                        self.received.append((topic, body[pos:]))
+                        n = len(self.received)
+                        if qos:
+                            self._unacked += 1
+                            self.max_unacked = max(self.max_unacked, self._unacked)
+                    if qos and n not in self._withheld:
+                        threading.Thread(target=ack_later, args=(mid,), daemon=True).start()
+                elif kind == 8:     # SUBSCRIBE → SUBACK granting QoS 1
+                    mid = struct.unpack("!H", body[:2])[0]
+                    send(struct.pack("!BBHB", 0x90, 3, mid, 1))
+                elif kind == 12:    # PINGREQ → PINGRESP
+                    send(b"\xd0\x00")
+                elif kind == 14:    # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            conn.close()
+
+
+def _connect(broker: StubBroker):
+    """Point mqtt_sender at the stub broker and wait for the connection."""
+    mqtt_sender.MQTT_BROKER = "127.0.0.1"
+    mqtt_sender.MQTT_PORT = broker.port
+    mqtt_sender.init_mqtt()
+    _wait_connected(True)
+
+
+def _wait_connected(connected: bool, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while mqtt_sender._connected.is_set() != connected:
+        assert time.monotonic() < deadline, f"client connected={not connected} after {timeout}s"
+        time.sleep(0.01)
+
+
+def _disconnect():
+    mqtt_sender._client.disconnect()
+    mqtt_sender._client.loop_stop()
+    mqtt_sender._client = None
+
+
+PAYLOAD = {"class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+           "message_text": "Super Pro to the lanes"}
+
+
+# ===========================
+# Tests
+# ===========================
+def test_send_now_waits_for_puback():
+    """Test 1: send_now blocks until the broker acknowledges."""
+    print("\n" + "=" * 60)
+    print("TEST 1: send_now waits for PUBACK")
+    print("=" * 60)
+
+    broker = StubBroker(ack_delay=0.2)
+    _connect(broker)
+    try:
+        t0 = time.monotonic()
+        mqtt_sender.send_now(PAYLOAD, timeout=2.0)
+        elapsed = time.monotonic() - t0
+        assert elapsed >= 0.2, elapsed
+        print(f"  ✓ returned after the PUBACK ({elapsed * 1000:.0f} ms)")
+    finally:
+        _disconnect()
+        broker.close()
+
+
+def test_publish_batch_pipelines_within_window():
+    """Test 2: publishes are pipelined, at most MQTT_INFLIGHT_WINDOW unacked."""
+    print("\n" + "=" * 60)
+    print("TEST 2: publish_batch pipelining")
+    print("=" * 60)
+
+    window = mqtt_sender.MQTT_INFLIGHT_WINDOW
+    broker = StubBroker(ack_delay=0.05)
+    _connect(broker)
+    try:
+        n = window * 3
+        t0 = time.monotonic()
+        sent, error = mqtt_sender.publish_batch([PAYLOAD] * n, timeout=2.0)
+        elapsed = time.monotonic() - t0
+        assert (sent, error) == (n, None), (sent, error)
+        assert len(broker.received) == n
+        assert 1 < broker.max_unacked <= window, broker.max_unacked
+        # Serial publish-and-wait would take n * ack_delay
+        assert elapsed < n * broker.ack_delay / 2, elapsed
+        print(f"  ✓ {n} acked in {elapsed * 1000:.0f} ms, "
+              f"max {broker.max_unacked} in flight (window {window})")
+    finally:
+        _disconnect()
+        broker.close()
+
+
+def test_publish_batch_stops_at_missing_puback():
+    """Test 3: a withheld PUBACK limits delivery to the acknowledged prefix."""
+    print("\n" + "=" * 60)
+    print("TEST 3: missing PUBACK")
+    print("=" * 60)
+
+    broker = StubBroker()
+    broker.withhold(4)
+    _connect(broker)
+    try:
+        sent, error = mqtt_sender.publish_batch([PAYLOAD] * 10, timeout=0.5)
+        assert sent == 3, sent
+        assert isinstance(error, TimeoutError), error
+        print(f"  ✓ delivered {sent}, then: {error}")
+    finally:
+        _disconnect()
+        broker.close()
+
+
+def test_flush_outbox_acks_only_delivered_rows():
+    """Test 4: flush_outbox leaves unacknowledged rows queued."""
+    print("\n" + "=" * 60)
+    print("TEST 4: flush_outbox marks only PUBACKed rows sent")
+    print("=" * 60)
+
+    broker = StubBroker()
+    broker.withhold(6)
+    _connect(broker)
+    tmp = tempfile.mkdtemp()
+    saved = mqtt_sender.QUEUE_DB, mqtt_sender.MQTT_ACK_TIMEOUT
+    mqtt_sender.QUEUE_DB = os.path.join(tmp, "outbox.db")
+    mqtt_sender.MQTT_ACK_TIMEOUT = 0.5
+    try:
+        outbox = mqtt_sender.get_outbox(mqtt_sender.QUEUE_DB)
+        outbox.put_many([dict(PAYLOAD, class_name=f"Class {i}") for i in range(8)])
+        mqtt_sender.flush_outbox()
+        assert outbox.depth() == 3, outbox.depth()
+        assert [p["class_name"] for _, p in outbox.pending(10)] == ["Class 5", "Class 6", "Class 7"]
+        print(f"  ✓ 5 rows marked sent, {outbox.depth()} still queued")
+        outbox.close()
+    finally:
+        mqtt_sender.QUEUE_DB, mqtt_sender.MQTT_ACK_TIMEOUT = saved
+        _disconnect()
+        broker.close()
+
+
+def test_batched_publish_per_utterance():
+    """Test 5: one compact publish per utterance, acked as all its messages."""
+    print("\n" + "=" * 60)
+    print("TEST 5: batched per-utterance publish")
+    print("=" * 60)
+
+    broker = StubBroker()
+    _connect(broker)
+    saved = mqtt_sender.MQTT_BATCH_PUBLISH, mqtt_sender._batch_encoding
+    mqtt_sender.MQTT_BATCH_PUBLISH, mqtt_sender._batch_encoding = True, "jsonz"
+    try:
+        first = dict(PAYLOAD, transcription="super pro and pro stock to the lanes", timestamp="t1")
+        utterance = [first, dict(first, class_id=12, class_name="Pro Stock")]
+        later = dict(PAYLOAD, transcription="super pro on standby", timestamp="t2", intent="CLASS_STANDBY")
+        sent, error = mqtt_sender.publish_batch(utterance + [later], timeout=2.0)
+        assert (sent, error) == (3, None), (sent, error)
+        assert len(broker.received) == 2, broker.received
+
+        topic, data = broker.received[0]
+        assert topic == mqtt_sender.MQTT_TOPIC + "/batch/jsonz", topic
+        envelope = json.loads(zlib.decompress(data))
+        assert envelope["transcription"] == first["transcription"]
+        assert [m["class_name"] for m in envelope["messages"]] == ["Super Pro", "Pro Stock"]
+        assert "transcription" not in envelope["messages"][0]
+
+        separate = sum(len(json.dumps(dict(p, event_id=None))) for p in utterance)
+        print(f"  ✓ 3 messages in 2 publishes; utterance of 2 is {len(data)} bytes "
+              f"(vs {separate} as separate JSON messages)")
+    finally:
+        mqtt_sender.MQTT_BATCH_PUBLISH, mqtt_sender._batch_encoding = saved
+        _disconnect()
+        broker.close()
+
+
+def test_async_adapter():
+    """Test 6: the asyncio adapter publishes and dispatches on the loop."""
+    print("\n" + "=" * 60)
+    print("TEST 6: asyncio MQTT adapter")
+    print("=" * 60)
+
+    broker = StubBroker(ack_delay=0.05)
+    mqtt_sender.MQTT_BROKER = "127.0.0.1"
+    mqtt_sender.MQTT_PORT = broker.port
+    saved_apply = mqtt_sender.apply_config_update
+    config_threads = []
+    mqtt_sender.apply_config_update = lambda payload: config_threads.append(threading.get_ident())
+
+    async def run():
+        loop_thread = threading.get_ident()
+        client = AsyncMqttClient()
+        await client.start()
+        try:
+            deadline = time.monotonic() + 5
+            while not client._client.is_connected():
+                assert time.monotonic() < deadline, "adapter did not connect to the stub broker"
+                await asyncio.sleep(0.01)
+
+            ack_threads = set()
+            on_publish = client._client.on_publish
+            def record_thread(c, userdata, mid):
+                ack_threads.add(threading.get_ident())
+                on_publish(c, userdata, mid)
+            client._client.on_publish = record_thread
+
+            n = mqtt_sender.MQTT_INFLIGHT_WINDOW * 2
+            sent, error = await client.publish_many([PAYLOAD] * n, timeout=2.0)
+            assert (sent, error) == (n, None), (sent, error)
+            assert ack_threads == {loop_thread}, "on_publish ran off the event loop"
+            stats = client.get_publish_stats()
+            assert stats["acked"] == n and stats["inflight"] == 0, stats
+
+            msg = mqtt.MQTTMessage(topic=mqtt_sender.MQTT_CONFIG_TOPIC.encode())
+            msg.payload = b'{"classes": []}'
+            client._on_message(client._client, None, msg)
+            await asyncio.get_running_loop().run_in_executor(client._config_executor, lambda: None)
+            assert config_threads and config_threads[0] != loop_thread, config_threads
+
+            print(f"  ✓ {n} acked on the loop thread, avg publish→PUBACK "
+                  f"{stats['latency_avg'] * 1000:.0f} ms (max {stats['latency_max'] * 1000:.0f} ms); "
+                  "config update ran in the executor")
+        finally:
+            await client.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        mqtt_sender.apply_config_update = saved_apply
+        broker.close()
+
+
+def test_publish_while_disconnected():
+    """Test 7: no publish is handed to paho while the broker connection is down."""
+    print("\n" + "=" * 60)
+    print("TEST 7: broker connection lost")
+    print("=" * 60)
+
+    broker = StubBroker()
+    _connect(broker)
+    client = mqtt_sender._client
+    client.reconnect_delay_set(min_delay=1, max_delay=1)
+    try:
+        broker.drop()
+        _wait_connected(False)
+        sent, error = mqtt_sender.publish_batch([PAYLOAD] * 3, timeout=0.5)
+        assert sent == 0 and isinstance(error, ConnectionError), (sent, error)
+        kept = [m for m in client._out_messages.values() if m.topic.startswith(mqtt_sender.MQTT_TOPIC)]
+        assert not kept, "paho kept an announcement to replay on reconnect"
+        _wait_connected(True)
+        time.sleep(0.2)
+        assert broker.received == [], broker.received
+        print(f"  ✓ nothing published while down ({error}); nothing replayed on reconnect")
+
+        # Lost between the connection check and the publish: paho returns
+        # MQTT_ERR_NO_CONN but keeps the message and replays it.
+        broker.drop()
+        _wait_connected(False)
+        mqtt_sender._connected.set()
+        sent, error = mqtt_sender.publish_batch([PAYLOAD], timeout=5.0)
+        assert (sent, error) == (1, None), (sent, error)
+        assert len(broker.received) == 1, broker.received
+        print("  ✓ publish racing the drop delivered once, by paho's replay after reconnect")
+    finally:
+        _disconnect()
+        broker.close()
+
+
+def test_async_adapter_connection_lost():
+    """Test 8: the asyncio adapter fails in-flight and new publishes while disconnected."""
+    print("\n" + "=" * 60)
+    print("TEST 8: asyncio MQTT adapter, broker connection lost")
+    print("=" * 60)
+
+    broker = StubBroker()
+    broker.withhold(1)
+    mqtt_sender.MQTT_BROKER = "127.0.0.1"
+    mqtt_sender.MQTT_PORT = broker.port
+
+    async def wait_connected(client, connected):
+        deadline = time.monotonic() + 5
+        while client._connected.is_set() != connected:
+            assert time.monotonic() < deadline, f"adapter connected={not connected} after 5s"
+            await asyncio.sleep(0.01)
+
+    async def run():
+        client = AsyncMqttClient()
+        await client.start()
+        try:
+            await wait_connected(client, True)
+            inflight = asyncio.ensure_future(client.publish_many([PAYLOAD], timeout=5.0))
+            while not broker.received:
+                await asyncio.sleep(0.01)
+            broker.drop()
+            sent, error = await inflight
+            assert sent == 0 and isinstance(error, ConnectionError), (sent, error)
+            assert client.get_publish_stats()["inflight"] == 0
+
+            sent, error = await client.publish_many([PAYLOAD] * 2, timeout=1.0)
+            assert sent == 0 and isinstance(error, ConnectionError), (sent, error)
+            print(f"  ✓ in-flight publish failed on the drop, new ones fail while down ({error})")
+
+            await wait_connected(client, True)
+            sent, error = await client.publish_many([PAYLOAD], timeout=2.0)
+            assert (sent, error) == (1, None), (sent, error)
+            assert len(broker.received) == 2, broker.received
+            print("  ✓ after reconnect: the failed publish was not replayed, a new one is acked")
+        finally:
+            await client.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        broker.close()
+
+
+def main():
+    test_send_now_waits_for_puback()
+    test_publish_batch_pipelines_within_window()
+    test_publish_batch_stops_at_missing_puback()
+    test_flush_outbox_acks_only_delivered_rows()
+    test_batched_publish_per_utterance()
+    test_async_adapter()
+    test_publish_while_disconnected()
+    test_async_adapter_connection_lost()
+    print("\nAll MQTT ack tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+test_mqtt_encoding.py - mqtt_sender publish encoding (_publish_units / _encode)
+
+Encodes publish units without a broker and checks that:
+  1. unbatched messages go to MQTT_TOPIC as one JSON object each, with the
+     current event_id
+  2. with MQTT_BATCH_PUBLISH an utterance goes to MQTT_TOPIC/batch/<encoding>
+     as one envelope, and every encoding decodes back to the original
+     messages
+  3. without orjson the JSON is the same, and without msgpack a msgpack
+     configuration falls back to jsonz
+
+Usage:
+  python test_mqtt_encoding.py
+  (or: python -m pytest test_mqtt_encoding.py)
+"""
+
+import json
+import sys
+import zlib
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import mqtt_sender
+
+FIRST = {"class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+         "message_text": "Super Pro to the lanes", "timestamp": "2026-06-01T12:00:00Z",
+         "transcription": "super pro and pro stock to the lanes"}
+UTTERANCE = [FIRST, dict(FIRST, class_id=12, class_name="Pro Stock", message_text="Pro Stock to the lanes")]
+LATER = dict(FIRST, intent="CLASS_STANDBY", timestamp="2026-06-01T12:01:00Z", transcription="super pro on standby")
+
+DECODERS = {
+    "json": json.loads,
+    "jsonz": lambda data: json.loads(zlib.decompress(data)),
+    "msgpack": lambda data: mqtt_sender.msgpack.unpackb(data),
+}
+
+
+def batching(encoding, event_id="evt_123"):
+    """Set MQTT_BATCH_PUBLISH, the batch encoding and event_id; returns the saved values."""
+    saved = mqtt_sender.MQTT_BATCH_PUBLISH, mqtt_sender._batch_encoding, mqtt_sender.event_id
+    mqtt_sender.MQTT_BATCH_PUBLISH = encoding is not None
+    mqtt_sender._batch_encoding = encoding or mqtt_sender.MQTT_BATCH_ENCODING
+    mqtt_sender.event_id = event_id
+    return saved
+
+
+def restore(saved):
+    mqtt_sender.MQTT_BATCH_PUBLISH, mqtt_sender._batch_encoding, mqtt_sender.event_id = saved
+
+
+def unpack(envelope):
+    """The messages an envelope carries, with the shared fields put back."""
+    shared = {k: envelope[k] for k in mqtt_sender._SHARED_FIELDS}
+    return [dict(m, **shared) for m in envelope["messages"]]
+
+
+# ===========================
+# Tests
+# ===========================
+def test_unbatched():
+    """Test 1: one JSON publish per message on MQTT_TOPIC."""
+    print("\n" + "=" * 60)
+    print("TEST 1: unbatched encoding")
+    print("=" * 60)
+
+    saved = batching(None)
+    try:
+        units = mqtt_sender._publish_units(UTTERANCE + [LATER])
+        assert units == [[p] for p in UTTERANCE + [LATER]]
+        topic, data = mqtt_sender._encode(units[0])
+        assert topic == mqtt_sender.MQTT_TOPIC
+        assert json.loads(data) == dict(FIRST, event_id="evt_123")
+        assert "event_id" not in FIRST, "_encode modified the payload"
+        print(f"  ✓ 3 publishes on {topic}, each a JSON object with event_id")
+    finally:
+        restore(saved)
+
+
+def test_batch_envelope_round_trip():
+    """Test 2: topic per encoding, envelope decodes to the original messages."""
+    print("\n" + "=" * 60)
+    print("TEST 2: batch envelope topic and round trip")
+    print("=" * 60)
+
+    encodings = ["json", "jsonz"] + (["msgpack"] if mqtt_sender.msgpack is not None else [])
+    for encoding in encodings:
+        saved = batching(encoding)
+        try:
+            units = mqtt_sender._publish_units(UTTERANCE + [LATER])
+            assert [len(u) for u in units] == [2, 1], units
+            topic, data = mqtt_sender._encode(units[0])
+            assert topic == f"{mqtt_sender.MQTT_TOPIC}/batch/{encoding}", topic
+            envelope = DECODERS[encoding](data)
+            assert envelope["v"] == 1 and envelope["event_id"] == "evt_123"
+            assert all("transcription" not in m for m in envelope["messages"])
+            assert unpack(envelope) == [dict(p, event_id="evt_123") for p in UTTERANCE]
+            assert unpack(DECODERS[encoding](mqtt_sender._encode(units[1])[1])) == [dict(LATER, event_id="evt_123")]
+        finally:
+            restore(saved)
+        print(f"  ✓ {encoding}: {topic}, {len(data)} bytes, decodes to the 2 messages")
+    if mqtt_sender.msgpack is None:
+        print("  - msgpack not installed, its round trip not run")
+
+
+def test_fallbacks():
+    """Test 3: no orjson → stdlib JSON; no msgpack → jsonz."""
+    print("\n" + "=" * 60)
+    print("TEST 3: fallbacks without orjson / msgpack")
+    print("=" * 60)
+
+    saved_libs = mqtt_sender.orjson, mqtt_sender.msgpack
+    saved = batching("jsonz")
+    try:
+        with_orjson = mqtt_sender._encode(UTTERANCE)
+        mqtt_sender.orjson = None
+        without = mqtt_sender._encode(UTTERANCE)
+        # Same topic and, for ASCII text, byte-identical compact JSON
+        assert without[0] == with_orjson[0]
+        assert zlib.decompress(without[1]) == zlib.decompress(with_orjson[1])
+        print("  ✓ without orjson: the same compact JSON")
+
+        mqtt_sender.msgpack = None
+        assert mqtt_sender._pick_batch_encoding("msgpack") == "jsonz"
+        assert mqtt_sender._pick_batch_encoding("json") == "json"
+        mqtt_sender.MQTT_BATCH_PUBLISH = False
+        assert mqtt_sender._pick_batch_encoding("msgpack") == "msgpack"   # unused when not batching
+        print("  ✓ without msgpack: a msgpack batch encoding falls back to jsonz")
+    finally:
+        mqtt_sender.orjson, mqtt_sender.msgpack = saved_libs
+        restore(saved)
+
+
+def main():
+    test_unbatched()
+    test_batch_envelope_round_trip()
+    test_fallbacks()
+    print("\nAll MQTT encoding tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+test_outbox.py - outbox.Outbox queueing and the OutboxDrainer on a temporary database
+
+Checks that:
+  1. the drainer sends a multi-batch backlog in order and then goes idle,
+     deciding from the rows it fetched rather than the in-memory depth
+     (a row that lapses between expire() and pending() must not keep it
+     spinning)
+  2. maintain() deletes finished rows past OUTBOX_RETENTION_HOURS and keeps
+     unsent ones; over OUTBOX_MAX_BYTES it deletes every finished row, then
+     drops unsent rows intent by intent in OUTBOX_DROP_ORDER until the file
+     is back under the cap
+  3. a row is deliverable only within its intent's OUTBOX_TTL_SECONDS;
+     expire() marks lapsed rows and keeps depth and stats in step, and
+     intents without a TTL never expire
+  4. a newer CLASS_TO_LANES / CLASS_STANDBY message supersedes older unsent
+     ones with the same class+intent, in the table and within one batch,
+     and the counters survive a reopen
+  5. deliver() sends a fresh message directly only if its class has no
+     backlog, and a drained row superseded while its batch is going out is
+     skipped rather than sent
+
+Usage:
+  python test_outbox.py
+  (or: python -m pytest test_outbox.py)
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import outbox as outbox_mod
+from outbox import Outbox, OutboxDrainer
+
+PAYLOAD = {"class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+           "message_text": "Super Pro to the lanes"}
+
+
+def new_outbox() -> Outbox:
+    return Outbox(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+
+
+def payloads(n, intent="GENERAL_ANNOUNCEMENT"):
+    """n messages in distinct classes, so none supersedes another."""
+    return [dict(PAYLOAD, class_name=f"Class {i}", intent=intent) for i in range(n)]
+
+
+def backdate(box, seconds):
+    """Make every row look `seconds` older."""
+    with box._lock, box._conn:
+        box._conn.execute("UPDATE outbox SET created_at = created_at - ?", (seconds,))
+
+
+# ===========================
+# Tests
+# ===========================
+def test_drainer_goes_idle_after_backlog():
+    """Test 1: the backlog drains in order, then the drain loop stops polling."""
+    print("\n" + "=" * 60)
+    print("TEST 1: drainer drains the backlog, then goes idle")
+    print("=" * 60)
+
+    box = new_outbox()
+    n = outbox_mod.OUTBOX_BATCH_SIZE * 2 + 5
+    box.put_many(payloads(n))
+
+    # A queued CLASS_TO_LANES row whose TTL lapses just after expire() ran:
+    # depth() still counts it, pending() no longer returns it
+    box.put(PAYLOAD)
+    backdate(box, outbox_mod.OUTBOX_TTL_SECONDS["CLASS_TO_LANES"] + 1)
+    box.expire = lambda: 0
+
+    sent = []
+    fetches = []
+    pending = box.pending
+    box.pending = lambda limit: fetches.append(limit) or pending(limit)
+
+    def send_many(batch):
+        sent.extend(p["class_name"] for p in batch)
+        return len(batch), None
+
+    async def run():
+        drainer = OutboxDrainer(box, send=None, queue=box.put_many, send_many=send_many)
+        drainer.start()
+        await asyncio.sleep(0.3)
+        await drainer.stop()
+
+    asyncio.run(run())
+    assert sent == [f"Class {i}" for i in range(n)], sent[:5]
+    assert box.depth() == 1, box.depth()
+    assert len(fetches) == 3, f"drain loop polled {len(fetches)} times"
+    print(f"  ✓ {n} rows sent in {len(fetches)} batches; idle with a lapsed row still counted")
+    box.close()
+
+
+def test_retention_and_size_cap():
+    """Test 2: retention purge, then the size cap and drop order."""
+    print("\n" + "=" * 60)
+    print("TEST 2: retention and size cap")
+    print("=" * 60)
+
+    box = new_outbox()
+    box.put_many(payloads(10, intent="RESULTS"))   # no TTL: still deliverable a day later
+    box.ack([id_ for id_, _ in box.pending(4)])
+    backdate(box, outbox_mod.OUTBOX_RETENTION_HOURS * 3600 + 1)
+    box.put_many(payloads(3, intent="RESULTS"))
+    box.ack([id_ for id_, _ in box.pending(100)][-1:])   # a recent sent row
+
+    result = box.maintain()
+    assert (result["purged"], result["dropped"], box.depth()) == (4, 0, 8), (result, box.depth())
+    print("  ✓ 4 old sent rows purged; old unsent and recent sent rows kept")
+
+    filler = "x" * 2000
+    box.put_many([dict(PAYLOAD, class_name=f"Class {i}", intent=intent, message_text=filler)
+                  for i in range(300) for intent in ("GENERAL_ANNOUNCEMENT", "CLASS_STANDBY", "CLASS_TO_LANES")])
+    depth = box.depth()
+    saved = outbox_mod.OUTBOX_MAX_BYTES
+    # Room for everything but the lanes calls (a third of the filler)
+    outbox_mod.OUTBOX_MAX_BYTES = cap = int(box.size_bytes() * 0.75)
+    try:
+        result = box.maintain()
+    finally:
+        outbox_mod.OUTBOX_MAX_BYTES = saved
+    intents = Counter(p["intent"] for _, p in box.pending(10_000))
+    assert result["purged"] == 1 and result["dropped"] == 300, result
+    assert result["size_bytes"] <= cap and box.size_bytes() == result["size_bytes"], (result, cap)
+    assert intents == {"RESULTS": 8, "GENERAL_ANNOUNCEMENT": 300, "CLASS_STANDBY": 300}, intents
+    assert box.depth() == depth - 300 == sum(intents.values()), (box.depth(), intents)
+    assert (box.stats()["purged"], box.stats()["dropped"]) == (5, 300)
+    print(f"  ✓ over the cap: recent sent row purged, 300 lanes calls dropped first, "
+          f"{result['size_bytes'] // 1024} KiB ≤ {cap // 1024} KiB")
+    box.close()
+
+
+def test_ttl_expiry():
+    """Test 3: per-intent TTL on delivery, expire() bookkeeping."""
+    print("\n" + "=" * 60)
+    print("TEST 3: queued messages expire by intent TTL")
+    print("=" * 60)
+
+    box = new_outbox()
+    intents = ["CLASS_TO_LANES", "CLASS_STANDBY", "GENERAL_ANNOUNCEMENT", "RESULTS"]
+    box.put_many([dict(PAYLOAD, intent=intent) for intent in intents])
+    ttl = outbox_mod.OUTBOX_TTL_SECONDS
+    assert "RESULTS" not in ttl
+
+    backdate(box, ttl["CLASS_TO_LANES"] + 1)
+    assert [p["intent"] for _, p in box.pending(10)] == intents[1:]
+    assert box.depth() == 4, "pending() changed the depth"
+    assert box.expire() == 1
+    stats = box.stats()
+    assert (box.depth(), box.depth("Super Pro"), stats["expired"]) == (3, 3, 1), stats
+    assert ttl["CLASS_TO_LANES"] < stats["oldest_unsent_age"] < ttl["CLASS_STANDBY"], stats
+    print(f"  ✓ CLASS_TO_LANES lapsed after {ttl['CLASS_TO_LANES']}s; expire() marked it, depth 4 → 3")
+
+    backdate(box, ttl["GENERAL_ANNOUNCEMENT"])
+    assert box.expire() == 2
+    assert [p["intent"] for _, p in box.pending(10)] == ["RESULTS"]
+    assert (box.depth(), box.stats()["expired"], box.expire()) == (1, 3, 0)
+    print("  ✓ the other TTL intents lapse in turn; an intent without a TTL is still delivered")
+    box.close()
+
+
+def test_supersession():
+    """Test 4: newer class+intent messages replace older unsent ones."""
+    print("\n" + "=" * 60)
+    print("TEST 4: newer messages supersede older ones")
+    print("=" * 60)
+
+    box = new_outbox()
+    standby = dict(PAYLOAD, intent="CLASS_STANDBY", message_text="Super Pro on standby")
+    box.put(dict(PAYLOAD, message_text="first call"))
+    box.put(standby)
+    box.put(dict(PAYLOAD, message_text="second call"))
+    assert [p["message_text"] for _, p in box.pending(10)] == ["Super Pro on standby", "second call"]
+    assert (box.depth(), box.depth("Super Pro"), box.stats()["superseded"]) == (2, 2, 1)
+    print("  ✓ a second lanes call replaces the queued first one, standby kept")
+
+    # Within one batch only the newest per class+intent is kept; other intents stack up
+    box.put_many([dict(PAYLOAD, message_text="third call"), dict(PAYLOAD, message_text="fourth call"),
+                  dict(PAYLOAD, intent="GENERAL_ANNOUNCEMENT"), dict(PAYLOAD, intent="GENERAL_ANNOUNCEMENT")])
+    texts = [(p["intent"], p["message_text"]) for _, p in box.pending(10)]
+    assert texts == [("CLASS_STANDBY", "Super Pro on standby"), ("CLASS_TO_LANES", "fourth call"),
+                     ("GENERAL_ANNOUNCEMENT", PAYLOAD["message_text"]),
+                     ("GENERAL_ANNOUNCEMENT", PAYLOAD["message_text"])], texts
+    assert (box.depth(), box.stats()["superseded"]) == (4, 3)
+    print("  ✓ in a batch the last lanes call wins; announcements are never superseded")
+
+    # Sent rows are not superseded, and the counters match the table after a reopen
+    box.ack([id_ for id_, p in box.pending(10) if p["intent"] == "CLASS_TO_LANES"])
+    box.put(dict(PAYLOAD, message_text="fifth call"))
+    assert box.stats()["superseded"] == 3
+    reopened = Outbox(box.path)
+    assert (reopened.depth(), reopened.depth("Super Pro")) == (box.depth(), box.depth("Super Pro")) == (4, 4)
+    print("  ✓ an already sent call is left alone; depth matches after a reopen")
+    reopened.close()
+    box.close()
+
+
+def test_fast_path_and_superseded_in_flight():
+    """Test 5: no direct send past a backlog; no send of a row superseded mid-batch."""
+    print("\n" + "=" * 60)
+    print("TEST 5: fast path and rows superseded in flight")
+    print("=" * 60)
+
+    box = new_outbox()
+    sent = []
+
+    async def send(payload):
+        sent.append((payload["class_name"], payload["message_text"]))
+
+    drainer = OutboxDrainer(box, send=send, queue=box.put_many)
+    box.put(dict(PAYLOAD, intent="GENERAL_ANNOUNCEMENT"))
+    standby = dict(PAYLOAD, intent="CLASS_STANDBY", message_text="Super Pro on standby")
+    asyncio.run(drainer.deliver([standby, dict(payloads(1)[0], message_text="Class 0 now")]))
+    assert sent == [("Class 0", "Class 0 now")], sent
+    assert box.depth("Super Pro") == 2 and box.depth() == 2
+    print("  ✓ fresh message behind its class's backlog queued; other class sent directly")
+
+    box = new_outbox()
+    sent.clear()
+    box.put_many([payloads(1)[0], dict(PAYLOAD, message_text="first call"),
+                  dict(payloads(2)[1], message_text="Class 1 later")])
+
+    async def send_and_queue(payload):
+        if not sent:   # a newer lanes call is queued while the batch is going out
+            box.put(dict(PAYLOAD, message_text="second call"))
+        await send(payload)
+
+    drainer = OutboxDrainer(box, send=send_and_queue, queue=box.put_many)
+    asyncio.run(drainer._drain_once())
+    assert [text for _, text in sent] == [PAYLOAD["message_text"], "Class 1 later"], sent
+    assert (box.depth(), box.depth("Super Pro"), box.stats()["superseded"]) == (1, 1, 1)
+    asyncio.run(drainer._drain_once())
+    assert sent[-1] == ("Super Pro", "second call") and box.depth() == 0, sent
+    statuses = dict(box._conn.execute("SELECT json_extract(payload, '$.message_text'), sent FROM outbox"))
+    assert statuses["first call"] == 3 and statuses["second call"] == 1, statuses
+    assert Outbox(box.path).depth() == 0
+    print("  ✓ superseded row skipped mid-batch, left superseded by the ack; the newer call follows")
+    box.close()
+
+
+def main():
+    test_drainer_goes_idle_after_backlog()
+    test_retention_and_size_cap()
+    test_ttl_expiry()
+    test_supersession()
+    test_fast_path_and_superseded_in_flight()
+    print("\nAll outbox tests passed.")
+
+
+if __name__ == "__main__":
+    main()
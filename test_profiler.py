@@ -0,0 +1,164 @@
+"""
+test_profiler.py - On-demand profiling captures (profiler.start_profile / stop_profile)
+
+Runs short captures into a temporary PROFILE_DIR and checks that:
+  1. a "sample" capture stopped early with stop_profile() writes collapsed
+     stacks ("thread;outer;...;inner count") that include a busy thread,
+     and a second capture is refused while one runs
+  2. PROFILE_SIGNAL delivered through loop.add_signal_handler, as main
+     installs it, starts a "cprofile" capture on the event loop thread that
+     ends by itself after its seconds and writes a loadable .pstats file
+  3. with PROFILE_TRACEMALLOC the capture also writes the memory growth
+     report and the raw snapshot, and stops the tracing it started
+
+Usage:
+  python test_profiler.py
+  (or: python -m pytest test_profiler.py)
+"""
+
+import asyncio
+import contextlib
+import os
+import pstats
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import profiler
+from profiler import start_profile, stop_profile
+
+
+@contextlib.contextmanager
+def profile_dir(tracemalloc_on=False):
+    """PROFILE_DIR in a fresh temporary directory (and PROFILE_TRACEMALLOC); yields it."""
+    saved = profiler.PROFILE_DIR, profiler.PROFILE_TRACEMALLOC
+    profiler.PROFILE_DIR = Path(tempfile.mkdtemp()) / "profiles"
+    profiler.PROFILE_TRACEMALLOC = tracemalloc_on
+    try:
+        yield profiler.PROFILE_DIR
+    finally:
+        stop_profile()
+        wait_written()
+        profiler.PROFILE_DIR, profiler.PROFILE_TRACEMALLOC = saved
+
+
+def wait_written(timeout=10.0):
+    """Wait for the capture's writer thread; the capture slot is free once it is done."""
+    for t in threading.enumerate():
+        if t.name == "profiler-write":
+            t.join(timeout)
+    assert profiler._capture is None, "capture still registered after writing"
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+
+# ===========================
+# Tests
+# ===========================
+def test_sample_capture():
+    """Test 1: sample capture stopped early."""
+    print("\n" + "=" * 60)
+    print("TEST 1: sample capture → collapsed stacks")
+    print("=" * 60)
+
+    stop = threading.Event()
+    busy = threading.Thread(target=spin, args=(stop,), name="busy")
+    busy.start()
+    try:
+        with profile_dir() as out:
+            assert start_profile(seconds=30, mode="sample")
+            assert not start_profile(seconds=30, mode="sample"), "second capture started"
+            time.sleep(0.3)
+            stop_profile()
+            wait_written()
+
+            files = list(out.iterdir())
+            assert [f.name.endswith("-stacks.txt") for f in files] == [True], files
+            lines = files[0].read_text(encoding="utf-8").splitlines()
+            stacks = dict(line.rsplit(" ", 1) for line in lines)
+            busy_samples = sum(int(n) for stack, n in stacks.items()
+                               if stack.startswith("busy;") and "spin (test_profiler.py:" in stack)
+            assert busy_samples >= 10, busy_samples   # ~97 Hz for 0.3s
+            assert not any(stack.startswith("profiler;") for stack in stacks)
+            print(f"  ✓ {files[0].name}: {len(lines)} stacks, {busy_samples} samples in the busy thread")
+
+            assert start_profile(seconds=0.1, mode="sample"), "slot not freed after the capture"
+            print("  ✓ one capture at a time; the next starts once it is written")
+    finally:
+        stop.set()
+        busy.join()
+
+
+def test_signal_starts_cprofile():
+    """Test 2: PROFILE_SIGNAL on the event loop → cprofile capture."""
+    print("\n" + "=" * 60)
+    print("TEST 2: signal → cprofile capture on the event loop")
+    print("=" * 60)
+
+    if not hasattr(signal, "SIGUSR1"):
+        print("  - no SIGUSR1 on this platform, skipped")
+        return
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, start_profile, 0.2, "cprofile")
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                sum(i * i for i in range(1000))
+        finally:
+            loop.remove_signal_handler(signal.SIGUSR1)
+
+    with profile_dir() as out:
+        asyncio.run(run())
+        wait_written()
+        files = list(out.iterdir())
+        assert [f.suffix for f in files] == [".pstats"], files
+        stats = pstats.Stats(str(files[0]))
+        functions = {name for _, _, name in stats.stats}
+        assert "run" in functions, sorted(functions)[:20]
+        print(f"  ✓ {files[0].name}: {len(stats.stats)} functions, ended by itself after 0.2s")
+
+
+def test_tracemalloc_report():
+    """Test 3: memory growth report with PROFILE_TRACEMALLOC."""
+    print("\n" + "=" * 60)
+    print("TEST 3: tracemalloc growth report")
+    print("=" * 60)
+
+    assert not tracemalloc.is_tracing()
+    with profile_dir(tracemalloc_on=True) as out:
+        assert start_profile(seconds=30, mode="sample")
+        grown = [bytearray(1024) for _ in range(200)]
+        time.sleep(0.1)
+        stop_profile()
+        wait_written()
+        names = {f.name[len("YYYYmmdd-HHMMSS"):] for f in out.iterdir()}
+        assert names == {"-stacks.txt", "-memory.txt", ".tracemalloc"}, names
+        report = next(out.glob("*-memory.txt")).read_text(encoding="utf-8")
+        assert report.startswith("tracemalloc growth over") and "test_profiler.py" in report, report[:500]
+        assert not tracemalloc.is_tracing(), "capture left tracemalloc on"
+        del grown
+        print("  ✓ memory report names the growing line; raw snapshot written; tracing stopped")
+
+
+def main():
+    test_sample_capture()
+    test_signal_starts_cprofile()
+    test_tracemalloc_report()
+    print("\nAll profiler tests passed.")
+
+
+if __name__ == "__main__":
+    main()
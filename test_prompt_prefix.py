@@ -0,0 +1,157 @@
+"""
+test_prompt_prefix.py - Static, cacheable system prompt prefix (prompt_utils.get_scoped_prompt)
+
+Captures the requests the RAG path (fake OpenAI client) and the Bedrock
+path (fake bedrock-runtime client) send, and checks that:
+  1. two different transcripts under the same scope send byte-identical
+     system messages, built once, with the transcript only in the user
+     message
+  2. the prompt's cache key changes, and the prompt is rebuilt, when the
+     class map content hash changes or the active track scope changes,
+     and the earlier prompt comes back when they are restored
+
+Usage:
+  python test_prompt_prefix.py
+  (or: python -m pytest test_prompt_prefix.py)
+"""
+
+import contextlib
+import io
+import json
+import sys
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import config
+import prompt_utils
+import rag_classifier as rc
+import track_scope
+from test_candidates import fake_openai
+from test_classmap import isolated_classmap, patch
+
+TRANSCRIPTS = [("super pro to the lanes", ["Super Pro", "Pro"]),
+               ("pro stock on standby please", ["Pro Stock", "Pro Stock Motorcycle", "Pro"])]
+
+
+class FakeBedrock:
+    def __init__(self):
+        self.bodies = []
+
+    def invoke_model(self, **kwargs):
+        self.bodies.append(json.loads(kwargs["body"]))
+        return {"body": io.BytesIO(json.dumps({"content": [{"text": "[]"}]}).encode("utf-8"))}
+
+
+@contextlib.contextmanager
+def counted_builds():
+    """Count calls of both system prompt builders; start from an empty prompt cache."""
+    builds = {"rag": 0, "bedrock": 0}
+    saved = rc._build_system_prompt, classifier._build_bedrock_system_prompt
+
+    def rag_build(classes=None):
+        builds["rag"] += 1
+        return saved[0](classes)
+
+    def bedrock_build(classes=None):
+        builds["bedrock"] += 1
+        return saved[1](classes)
+
+    rc._build_system_prompt, classifier._build_bedrock_system_prompt = rag_build, bedrock_build
+    prompt_utils._prompt_cache.clear()
+    try:
+        yield builds
+    finally:
+        rc._build_system_prompt, classifier._build_bedrock_system_prompt = saved
+        prompt_utils._prompt_cache.clear()
+
+
+def rag_system(transcript, candidates):
+    with fake_openai() as client:
+        rc.classify_with_rag(transcript, "2026-06-01T12:00:00Z", candidate_classes=candidates, debounce=False)
+    messages = client.requests[0]["messages"]
+    return messages[0]["content"], messages[1]["content"]
+
+
+def cache_key(name):
+    return prompt_utils._prompt_cache[name][0]
+
+
+# ===========================
+# Tests
+# ===========================
+def test_identical_system_prefix():
+    """Test 1: same scope, different transcripts → same system message."""
+    print("\n" + "=" * 60)
+    print("TEST 1: byte-identical system prefix across transcripts")
+    print("=" * 60)
+
+    bedrock = FakeBedrock()
+    saved = classifier.get_bedrock_client
+    classifier.get_bedrock_client = lambda: bedrock
+    try:
+        with counted_builds() as builds:
+            (sys_a, user_a), (sys_b, user_b) = (rag_system(t, c) for t, c in TRANSCRIPTS)
+            assert sys_a == sys_b and builds["rag"] == 1, builds
+            assert TRANSCRIPTS[0][0] in user_a and TRANSCRIPTS[1][0] in user_b
+            assert not any(t in sys_a for t, _ in TRANSCRIPTS)
+            print(f"  ✓ RAG: system message identical ({len(sys_a)} chars, built once), transcript in the user message")
+
+            for transcript, candidates in TRANSCRIPTS:
+                classifier.build_messages_with_llm(transcript, "2026-06-01T12:00:00Z", candidates[:1],
+                                                   candidate_classes=candidates, debounce=False)
+            (body_a, body_b) = bedrock.bodies
+            assert body_a["system"] == body_b["system"] and builds["bedrock"] == 1, builds
+            assert body_a["messages"] != body_b["messages"]
+            print("  ✓ Bedrock: system identical (built once), user messages differ")
+    finally:
+        classifier.get_bedrock_client = saved
+
+
+def test_cache_key_follows_classmap_and_scope():
+    """Test 2: rebuilt on a class map or scope change, reused otherwise."""
+    print("\n" + "=" * 60)
+    print("TEST 2: cache key = classmap hash + scope")
+    print("=" * 60)
+
+    transcript, candidates = TRANSCRIPTS[0]
+    try:
+        with isolated_classmap(), counted_builds() as builds:
+            base, _ = rag_system(transcript, candidates)
+            base_key = cache_key("rag_system")
+
+            add = {"op": "add", "class": {"id": 90, "name": "Pro Mod", "aliases": ["pro mod"]}}
+            assert config.apply_classmap_patch(patch(1, 2, add)) is not None
+            patched, _ = rag_system(transcript, candidates)
+            patched_key = cache_key("rag_system")
+            assert patched_key != base_key and "Pro Mod" in patched and "Pro Mod" not in base
+            assert builds["rag"] == 2
+            print("  ✓ class map patch → new key, rebuilt with the new class")
+
+            track_scope.set_active_event("sonoma-2026-nationals")
+            scoped, _ = rag_system(transcript, candidates)
+            assert cache_key("rag_system") not in (base_key, patched_key) and scoped != patched
+            assert "Super Pro" not in scoped.split("VALID CLASS NAMES:")[1].split("VALID INTENTS")[0]
+            track_scope.set_active_event(None)
+            assert rag_system(transcript, candidates)[0] == patched
+            assert cache_key("rag_system") == patched_key and builds["rag"] == 4
+            print("  ✓ scope change → new key with the scoped catalogue; same key back without it")
+
+            remove = {"op": "remove", "name": "Pro Mod"}
+            assert config.apply_classmap_patch(patch(2, 3, remove)) is not None
+            assert rag_system(transcript, candidates)[0] == base and cache_key("rag_system") == base_key
+            print("  ✓ same class map content again → original key and prompt")
+    finally:
+        track_scope.set_active_event(None)
+
+
+def main():
+    test_identical_system_prefix()
+    test_cache_key_follows_classmap_and_scope()
+    print("\nAll prompt prefix tests passed.")
+
+
+if __name__ == "__main__":
+    main()
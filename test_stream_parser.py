@@ -0,0 +1,131 @@
+"""
+test_stream_parser.py - rag_classifier.ResultStreamParser on streamed JSON
+
+Feeds {"results": [...]} documents to the incremental parser whole and in
+small pieces, and checks that:
+  1. every result object comes back once, in order, however the text is split
+     (and _parse_results gives the same list for the whole document)
+  2. each result is returned by the feed() that completes it, before the
+     rest of the document has arrived
+  3. braces, brackets and escaped quotes inside strings, and objects nested
+     inside a result, do not start or end a result
+  4. a bare [...] array works, and a malformed result is skipped without
+     losing the ones after it
+
+Usage:
+  python test_stream_parser.py
+  (or: python -m pytest test_stream_parser.py)
+"""
+
+import json
+import sys
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+from rag_classifier import ResultStreamParser, _parse_results
+
+RESULTS = [
+    {"class_name": "Super Pro", "intent": "CLASS_TO_LANES", "message_text": "Super Pro to the lanes"},
+    {"class_name": "Pro Stock", "intent": "CLASS_STANDBY", "message_text": "Pro Stock on standby"},
+    {"class_name": "Super Gas", "intent": "GENERAL_ANNOUNCEMENT", "message_text": "Super Gas meeting at 3"},
+]
+
+
+def feed_pieces(text, size):
+    """Feed text in pieces of `size` characters; returns (results, piece index of each)."""
+    parser = ResultStreamParser()
+    results, at = [], []
+    for i in range(0, len(text), size):
+        for obj in parser.feed(text[i:i + size]):
+            results.append(obj)
+            at.append(i // size)
+    return results, at
+
+
+# ===========================
+# Tests
+# ===========================
+def test_any_split_gives_all_results():
+    """Test 1: whole, per character and in odd-sized pieces."""
+    print("\n" + "=" * 60)
+    print("TEST 1: results independent of how the stream is split")
+    print("=" * 60)
+
+    text = json.dumps({"results": RESULTS}, indent=1)
+    for size in (len(text), 1, 2, 7, 64):
+        results, _ = feed_pieces(text, size)
+        assert results == RESULTS, (size, results)
+    assert _parse_results(text) == RESULTS
+    assert ResultStreamParser().feed('{"results": []}') == []
+    print(f"  ✓ {len(RESULTS)} results for every split and from _parse_results; empty results → []")
+
+
+def test_results_emitted_as_they_complete():
+    """Test 2: a result is returned by the feed() holding its closing brace."""
+    print("\n" + "=" * 60)
+    print("TEST 2: each result is returned as soon as it is complete")
+    print("=" * 60)
+
+    text = json.dumps({"results": RESULTS})
+    _, at = feed_pieces(text, 1)
+    closing = []
+    depth = 0
+    pos = text.index("[")
+    for i, ch in enumerate(text[pos:], start=pos):
+        # Top-level braces of the results array (strings here hold no braces)
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                closing.append(i)
+    assert at == closing, (at, closing)
+    assert at[0] < len(text) - 3, "first result only came back at the end"
+    print(f"  ✓ results returned at characters {at} of {len(text)}")
+
+
+def test_strings_and_nesting():
+    """Test 3: structure characters inside strings and nested objects."""
+    print("\n" + "=" * 60)
+    print("TEST 3: strings and nested objects")
+    print("=" * 60)
+
+    tricky = [
+        {"class_name": "Super Pro", "intent": "CLASS_TO_LANES",
+         "message_text": 'He said "{lanes}]" and \\ left [now]'},
+        {"class_name": "Pro Stock", "intent": "CLASS_STANDBY", "message_text": "ok",
+         "meta": {"scores": [1, {"x": "}"}], "note": "nested"}},
+    ]
+    text = json.dumps({"results": tricky})
+    for size in (len(text), 1, 3):
+        results, _ = feed_pieces(text, size)
+        assert results == tricky, (size, results)
+    print("  ✓ quoted braces, escaped quotes and nested objects kept inside their result")
+
+
+def test_bare_array_and_malformed_result():
+    """Test 4: a top-level array, and a broken result among good ones."""
+    print("\n" + "=" * 60)
+    print("TEST 4: bare array, malformed result")
+    print("=" * 60)
+
+    assert ResultStreamParser().feed(json.dumps(RESULTS)) == RESULTS
+
+    broken = '{"results": [{"class_name": "Super Pro", "intent": }, ' + json.dumps(RESULTS[1]) + "]}"
+    results, _ = feed_pieces(broken, 5)
+    assert results == [RESULTS[1]], results
+    print("  ✓ bare array parsed; malformed result skipped, the next one kept")
+
+
+def main():
+    test_any_split_gives_all_results()
+    test_results_emitted_as_they_complete()
+    test_strings_and_nesting()
+    test_bare_array_and_malformed_result()
+    print("\nAll stream parser tests passed.")
+
+
+if __name__ == "__main__":
+    main()
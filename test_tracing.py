@@ -0,0 +1,156 @@
+"""
+test_tracing.py - Per-utterance traces and stage spans (tracing.py)
+
+Checks that:
+  1. a trace started in a transcript task follows it into an executor job
+     run in contextvars.copy_context(), stays apart from a concurrent
+     transcript's trace, and is not seen by a thread without the context
+  2. nested spans each record their own duration, inner first, on the
+     stage histograms and the current trace, also when the block raises;
+     trace_delivered splits first delivery from late upgrades
+  3. with TRACING_ENABLED = False nothing is recorded
+
+Usage:
+  python test_tracing.py
+  (or: python -m pytest test_tracing.py)
+"""
+
+import asyncio
+import contextvars
+import sys
+import threading
+import time
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import tracing
+from tracing import current_trace, get_trace_stats, record, span, start_trace, trace_delivered
+
+
+def stages(trace):
+    return [stage for stage, _, _ in trace.marks]
+
+
+# ===========================
+# Tests
+# ===========================
+def test_trace_follows_transcript():
+    """Test 1: contextvar trace through copy_context() into the executor."""
+    print("\n" + "=" * 60)
+    print("TEST 1: trace follows its transcript into the executor")
+    print("=" * 60)
+
+    def classify(text):
+        # What build_messages does on its worker thread
+        with span("classify"):
+            time.sleep(0.01)
+        return text, current_trace()
+
+    async def transcript(text):
+        trace = start_trace(time.monotonic() - 0.5)   # speech ended half a second ago
+        loop = asyncio.get_running_loop()
+        _, seen = await loop.run_in_executor(None, contextvars.copy_context().run, classify, text)
+        trace_delivered()
+        return trace, seen
+
+    async def run():
+        # create_task copies the context, as on_transcript does
+        return await asyncio.gather(*(asyncio.create_task(transcript(t)) for t in ("super pro", "pro stock")))
+
+    tracing.reset_trace_stats()
+    try:
+        (first, seen_first), (second, seen_second) = asyncio.run(run())
+        assert seen_first is first and seen_second is second and first is not second
+        for trace in (first, second):
+            assert stages(trace) == ["classify", "speech_to_delivery"], trace.timeline()
+            assert trace.marks[1][2] >= 0.5
+        assert get_trace_stats()["classify"]["count"] == 2
+        print(f"  ✓ each transcript's executor job recorded on its own trace: {first.timeline()}")
+
+        outside = []
+        thread = threading.Thread(target=lambda: outside.append(current_trace()))
+        thread.start()
+        thread.join()
+        assert outside == [None]
+        print("  ✓ a thread started without the context sees no trace")
+    finally:
+        tracing.reset_trace_stats()
+
+
+def test_nested_spans():
+    """Test 2: nesting, durations, exceptions and late deliveries."""
+    print("\n" + "=" * 60)
+    print("TEST 2: nested spans record their durations")
+    print("=" * 60)
+
+    def utterance():
+        trace = start_trace()
+        with span("classify"):
+            time.sleep(0.02)
+            with span("rag"):
+                time.sleep(0.03)
+        try:
+            with span("bedrock"):
+                raise TimeoutError("no answer")
+        except TimeoutError:
+            pass
+        record("mic_queue", 0.004)
+        trace_delivered()
+        trace_delivered()
+        return trace
+
+    tracing.reset_trace_stats()
+    try:
+        trace = contextvars.Context().run(utterance)
+        assert stages(trace) == ["rag", "classify", "bedrock", "mic_queue",
+                                 "speech_to_delivery", "speech_to_late"], trace.timeline()
+        durations = {stage: dur for stage, _, dur in trace.marks}
+        assert durations["rag"] >= 0.03 and durations["classify"] >= durations["rag"] + 0.02, durations
+        assert durations["mic_queue"] == 0.004
+        print(f"  ✓ inner span recorded first, outer includes it: {trace.timeline()}")
+
+        stats = get_trace_stats()
+        assert {stage: s["count"] for stage, s in stats.items()} == dict.fromkeys(durations, 1), stats
+        assert stats["rag"]["max"] == durations["rag"] and stats["mic_queue"]["p50"] == 0.004
+        assert stats["mic_queue"]["buckets"][0.005] == 1
+        print("  ✓ one histogram sample per stage, the raising span included; late delivery split out")
+    finally:
+        tracing.reset_trace_stats()
+
+
+def test_disabled():
+    """Test 3: TRACING_ENABLED = False."""
+    print("\n" + "=" * 60)
+    print("TEST 3: tracing disabled")
+    print("=" * 60)
+
+    def utterance():
+        trace = start_trace()
+        with span("classify"):
+            pass
+        record("mic_queue", 0.001)
+        trace_delivered()
+        return trace, current_trace()
+
+    saved = tracing.TRACING_ENABLED
+    tracing.TRACING_ENABLED = False
+    tracing.reset_trace_stats()
+    try:
+        assert contextvars.Context().run(utterance) == (None, None)
+        assert get_trace_stats() == {}
+        print("  ✓ no trace, no histograms")
+    finally:
+        tracing.TRACING_ENABLED = saved
+
+
+def main():
+    test_trace_follows_transcript()
+    test_nested_spans()
+    test_disabled()
+    print("\nAll tracing tests passed.")
+
+
+if __name__ == "__main__":
+    main()
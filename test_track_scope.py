@@ -0,0 +1,143 @@
+"""
+test_track_scope.py - Event scoping of the class catalogue (track_scope)
+
+Resolves event ids against the shipped TrackTech announcements structure
+(and a small inline one) and checks that:
+  1. an event id naming a track and an event type scopes the candidates to
+     that event family's classes, and find_classes only matches those
+  2. an unknown event id resolves to nothing, leaving the full catalogue
+     (get_candidate_classes() is None and find_classes is unscoped); so does
+     TRACK_SCOPE_ENABLED = False
+  3. an event id with no event type scopes to every class the track runs,
+     a track without event families falls back to the full catalogue, and
+     an id that ties two tracks is not resolved
+
+Usage:
+  python test_track_scope.py
+  (or: python -m pytest test_track_scope.py)
+"""
+
+import contextlib
+import sys
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import track_scope
+
+# Two tracks sharing a facility name, and one without event families
+KB = {
+    "shared_class_sets": {"national": ["Top Fuel", "Funny Car", "Pro Stock"],
+                          "bracket": ["Super Pro", "Pro", "Street"]},
+    "tracks": [
+        {"track_name": "Crestview Dragway", "facility_name": "Thunder Valley Motorsports Park",
+         "event_families": [
+             {"family_name": "NHRA National Event", "class_set_refs": ["national"],
+              "event_examples": ["Crestview Nationals"]},
+             {"family_name": "Friday Brackets", "class_set_refs": ["bracket"], "custom_classes": ["Junior Dragster"],
+              "event_examples": ["Friday Night Brackets"]},
+         ]},
+        {"track_name": "Bristol Dragway", "facility_name": "Thunder Valley"},
+        {"track_name": "Desert Dragstrip", "facility_name": "Desert Dragstrip",
+         "event_families": []},
+    ],
+}
+
+
+@contextlib.contextmanager
+def scope_state(data=None):
+    """Track index from data (default: the shipped KB), restored with no event afterwards."""
+    track_scope.load_track_index(data)
+    try:
+        yield
+    finally:
+        track_scope.set_active_event(None)
+        track_scope.load_track_index()
+
+
+# ===========================
+# Tests
+# ===========================
+def test_matched_event():
+    """Test 1: track + event type → that family's classes."""
+    print("\n" + "=" * 60)
+    print("TEST 1: matched event scopes to its event family")
+    print("=" * 60)
+
+    with scope_state():
+        assert track_scope.resolve_event("sonoma-2026-nationals") == ("Sonoma Dragstrip", "NHRA National Event")
+        track_scope.set_active_event("sonoma-2026-nationals")
+        candidates = track_scope.get_candidate_classes()
+        assert candidates and "Top Fuel" in candidates and "Super Pro" not in candidates, candidates
+        assert candidates <= set(classifier.get_classmap())
+        print(f"  ✓ sonoma-2026-nationals → Sonoma Dragstrip / NHRA National Event, {len(candidates)} classes")
+
+        assert classifier.find_classes("top fuel and super pro to the lanes", candidates=candidates) == ["Top Fuel"]
+        assert classifier.find_classes("super pro to the lanes", candidates=candidates) == []
+        print("  ✓ scoped find_classes ignores classes that do not run at the event")
+
+
+def test_unknown_event_falls_back():
+    """Test 2: no resolution → full catalogue."""
+    print("\n" + "=" * 60)
+    print("TEST 2: unknown event falls back to the full catalogue")
+    print("=" * 60)
+
+    with scope_state():
+        assert track_scope.resolve_event("evt_123") == (None, None)
+        track_scope.set_active_event("evt_123")
+        assert track_scope.get_active_scope() is None
+        assert track_scope.get_candidate_classes() is None
+        assert "Super Pro" in classifier.find_classes("super pro to the lanes",
+                                                      candidates=track_scope.get_candidate_classes())
+        print("  ✓ evt_123 unresolved: no candidates, find_classes unscoped")
+
+        track_scope.set_active_event("sonoma-2026-nationals")
+        saved = track_scope.TRACK_SCOPE_ENABLED
+        track_scope.TRACK_SCOPE_ENABLED = False
+        try:
+            assert track_scope.get_candidate_classes() is None
+        finally:
+            track_scope.TRACK_SCOPE_ENABLED = saved
+        assert track_scope.get_candidate_classes() is not None
+        print("  ✓ TRACK_SCOPE_ENABLED = False ignores a resolved event")
+
+
+def test_track_without_event_type():
+    """Test 3: track only, track without families, ambiguous track."""
+    print("\n" + "=" * 60)
+    print("TEST 3: track without an event type")
+    print("=" * 60)
+
+    with scope_state(KB):
+        assert track_scope.resolve_event("crestview-2026") == ("Crestview Dragway", None)
+        track_scope.set_active_event("crestview-2026")
+        scope = track_scope.get_active_scope()
+        assert scope["classes"] == {"Top Fuel", "Funny Car", "Pro Stock", "Super Pro", "Pro", "Street",
+                                    "Junior Dragster"}, scope
+        # Only the classes that are in the class map become candidates
+        assert track_scope.get_candidate_classes() == scope["classes"] & set(classifier.get_classmap())
+        print(f"  ✓ no event type: all {len(scope['classes'])} classes the track runs")
+
+        assert track_scope.resolve_event("crestview-friday-brackets") == ("Crestview Dragway", "Friday Brackets")
+        track_scope.set_active_event("desert-dragstrip-2026")
+        assert track_scope.get_active_scope()["track_name"] == "Desert Dragstrip"
+        assert track_scope.get_candidate_classes() is None
+        print("  ✓ a track with no event families leaves the full catalogue")
+
+        # "thunder valley" is the whole facility name of both tracks
+        assert track_scope.resolve_event("thunder-valley-2026") == (None, None)
+        print("  ✓ an event id matching two tracks equally is not resolved")
+
+
+def main():
+    test_matched_event()
+    test_unknown_event_falls_back()
+    test_track_without_event_type()
+    print("\nAll track scope tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+test_transcript_loop.py - Transcript handling keeps the event loop responsive
+
+Drives main.on_transcript with the real classifier.build_messages, an
+escalated transcript and an LLM stand-in that answers after the deadline,
+and checks that:
+  1. a task ticking on the event loop keeps ticking while the transcript
+     waits out LLM_DEADLINE_SECONDS and the LLM finishes
+  2. the local result is delivered at the deadline and the LLM's addition
+     arrives afterwards through on_late
+  3. late messages go through the utterance dedup before delivery
+
+Usage:
+  python test_transcript_loop.py
+  (or: python -m pytest test_transcript_loop.py)
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Ensure the project directory is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import main as app
+
+LLM_DELAY = 0.5
+DEADLINE = 0.2
+TRANSCRIPT = "super pro to the lanes"
+
+
+class FakeDrainer:
+    def __init__(self):
+        self.delivered = []     # (monotonic time, [(class_name, intent)])
+
+    async def deliver(self, messages):
+        self.delivered.append((time.monotonic(), [(m["class_name"], m["intent"]) for m in messages]))
+
+
+def _slow_llm(transcript, timestamp, classes, candidate_classes=None, debounce=True, on_message=None):
+    """RAG stand-in: answers after LLM_DELAY with the local class plus one more."""
+    time.sleep(LLM_DELAY)
+    return [{"class_id": 73, "class_name": "Super Pro", "intent": "CLASS_TO_LANES"},
+            {"class_id": 12, "class_name": "Pro Stock", "intent": "CLASS_TO_LANES"}]
+
+
+def _run_transcript(prededuped=()):
+    """on_transcript under the patched classifier; returns (drainer, max tick gap, start time)."""
+    saved = {name: getattr(classifier, name) for name in
+             ("_build_messages_with_escalation", "_gate_decision", "LLM_DEADLINE_SECONDS",
+              "SPECULATIVE_EMIT_CONFIDENCE", "USE_RAG_CLASSIFIER", "CLASS_INDEX_PATH")}
+    classifier._build_messages_with_escalation = _slow_llm
+    classifier._gate_decision = lambda local, transcript, scope: ("escalated", None)
+    classifier.LLM_DEADLINE_SECONDS = DEADLINE
+    classifier.SPECULATIVE_EMIT_CONFIDENCE = 1.01    # always wait for the LLM first
+    classifier.USE_RAG_CLASSIFIER = True
+    classifier.CLASS_INDEX_PATH = Path(tempfile.mkdtemp()) / "class_index.pkl"
+    classifier._debounce.clear()
+    classifier._dedup.clear()
+    for classes, intent in prededuped:
+        classifier.is_duplicate_result(classes, intent)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        app.drainer = FakeDrainer()
+        app.classifier_ready = loop.create_future()
+        app.classifier_ready.set_result(classifier.build_messages)
+
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        tick_task = asyncio.create_task(ticker())
+        start = time.monotonic()
+        await app.on_transcript(TRANSCRIPT, "2026-06-01T12:00:00Z")
+        await asyncio.gather(*app._pending)
+        # The late delivery is scheduled from the LLM worker once it finishes
+        while time.monotonic() - start < LLM_DELAY + 0.3:
+            await asyncio.sleep(0.02)
+        tick_task.cancel()
+        gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+        return app.drainer, max(gaps), start
+
+    try:
+        return asyncio.run(run())
+    finally:
+        for name, value in saved.items():
+            setattr(classifier, name, value)
+
+
+# ===========================
+# Tests
+# ===========================
+def test_loop_stays_responsive_past_deadline():
+    """Tests 1-2: the loop keeps ticking; local result at the deadline, LLM addition late."""
+    print("\n" + "=" * 60)
+    print("TEST 1: event loop responsive while the LLM runs past its deadline")
+    print("=" * 60)
+
+    drainer, max_gap, start = _run_transcript()
+    assert max_gap < 0.1, f"event loop stalled for {max_gap * 1000:.0f} ms"
+    assert len(drainer.delivered) == 2, drainer.delivered
+
+    (t_first, first), (t_late, late) = drainer.delivered
+    assert first == [("Super Pro", "CLASS_TO_LANES")], first
+    assert late == [("Pro Stock", "CLASS_TO_LANES")], late
+    assert DEADLINE <= t_first - start < LLM_DELAY, t_first - start
+    assert t_late - start >= LLM_DELAY, t_late - start
+    print(f"  ✓ longest loop stall {max_gap * 1000:.0f} ms; local result at "
+          f"+{(t_first - start) * 1000:.0f} ms, LLM upgrade at +{(t_late - start) * 1000:.0f} ms")
+
+
+def test_late_messages_are_deduplicated():
+    """Test 3: an LLM upgrade already emitted for this class set + intent is dropped."""
+    print("\n" + "=" * 60)
+    print("TEST 2: late messages go through utterance dedup")
+    print("=" * 60)
+
+    drainer, _, _ = _run_transcript(prededuped=[(["Pro Stock"], "CLASS_TO_LANES")])
+    assert [msgs for _, msgs in drainer.delivered] == [[("Super Pro", "CLASS_TO_LANES")]], drainer.delivered
+    print("  ✓ duplicate late upgrade suppressed")
+
+
+def main():
+    test_loop_stays_responsive_past_deadline()
+    test_late_messages_are_deduplicated()
+    print("\nAll transcript loop tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+tracing.py - Per-utterance latency spans and per-stage histograms
+
+A Trace follows one final transcript from the moment the speech ended
+(Transcribe's EndTime, mapped onto the mic's clock by transcribe_ws) through
+classification to delivery. It travels in a contextvar: the transcript
+handler, build_messages and OutboxDrainer.deliver run in the same task, and
+classifier runs its LLM jobs in a copy of the caller's context, so the late
+upgrades they deliver land on the same trace.
+
+    with span("rag"):              # histogram "rag" + mark on the current trace
+        ...
+    record("mic_queue", seconds)   # same, for a duration measured elsewhere
+
+Stages:
+  mic_queue            audio chunk: mic callback → websocket send
+  endpointing          speech end → final transcript received
+  local_match          local confidence model (score_transcript / find_classes)
+  rag, bedrock         LLM tiers, on the LLM worker pool
+  llm_wait             time build_messages blocks on the speculative LLM
+  classify             whole build_messages call
+  deliver              send / publish until acknowledged
+  speech_to_delivery   speech end → first messages delivered
+  speech_to_late       speech end → LLM upgrades delivered after that
+
+All times are time.monotonic(). get_trace_stats() reports count, mean,
+p50 / p90 / p99 (bucket upper bounds) and max per stage. Log records made
+under a trace carry its trace_id and trace_ms (JSON log output).
+"""
+
+import bisect
+import contextvars
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from config import TRACING_ENABLED, TRACE_LOG_UTTERANCES
+from log import add_context_fields, get_logger
+
+# Histogram bucket upper bounds in seconds; one more bucket catches the rest
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+            1.0, 2.5, 5.0, 10.0, 30.0)
+
+log = get_logger("trace")
+
+_current = contextvars.ContextVar("trace", default=None)
+_trace_ids = itertools.count(1)
+
+
+# ===========================
+# Histograms
+# ===========================
+class Histogram:
+    """Fixed-bucket latency histogram; callers hold _stats_lock."""
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (capped at the max seen)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.50),
+            "p90": self.quantile(0.90),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": dict(zip(_BUCKETS + (float("inf"),), self.counts)),
+        }
+
+
+_histograms = {}   # stage → Histogram
+_stats_lock = threading.Lock()
+
+
+def record(stage, seconds):
+    """Add one duration to the stage's histogram and mark it on the current trace."""
+    if not TRACING_ENABLED:
+        return
+    with _stats_lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = Histogram()
+        hist.observe(seconds)
+    trace = _current.get()
+    if trace is not None:
+        trace.marks.append((stage, time.monotonic(), seconds))
+
+
+@contextmanager
+def span(stage):
+    """Time the with-block as one stage (recorded even if it raises)."""
+    if not TRACING_ENABLED:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(stage, time.monotonic() - start)
+
+
+def get_trace_stats() -> dict:
+    """{stage: histogram snapshot} for every stage recorded so far (seconds)."""
+    with _stats_lock:
+        return {stage: hist.snapshot() for stage, hist in _histograms.items()}
+
+
+def reset_trace_stats():
+    with _stats_lock:
+        _histograms.clear()
+
+
+def format_trace_stats() -> str:
+    """The stage histograms as a text table (milliseconds)."""
+    def ms(v):
+        return f"{v * 1000:>9.1f}" if v is not None else f"{'-':>9}"
+
+    lines = [f"{'stage':<20} {'count':>7} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}"]
+    for stage, s in sorted(get_trace_stats().items()):
+        lines.append(f"{stage:<20} {s['count']:>7} {ms(s['mean'])} {ms(s['p50'])} "
+                     f"{ms(s['p90'])} {ms(s['p99'])} {ms(s['max'])}")
+    return "\n".join(lines)
+
+
+# ===========================
+# Per-utterance traces
+# ===========================
+class Trace:
+    """One utterance: an origin time and the stages recorded against it."""
+
+    __slots__ = ("trace_id", "origin", "marks", "delivered")
+
+    def __init__(self, origin):
+        self.trace_id = next(_trace_ids)
+        self.origin = origin
+        self.marks = []          # (stage, monotonic time recorded, duration)
+        self.delivered = False
+
+    def elapsed(self, at=None):
+        return (time.monotonic() if at is None else at) - self.origin
+
+    def timeline(self) -> str:
+        return " | ".join(f"{stage} {dur * 1000:.0f}ms @+{(at - self.origin) * 1000:.0f}ms"
+                          for stage, at, dur in self.marks)
+
+
+def start_trace(origin=None):
+    """Start a trace in the current context; origin is a time.monotonic() value (default now)."""
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(time.monotonic() if origin is None else origin)
+    _current.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current.get()
+
+
+def _log_fields():
+    """trace_id and ms since speech end for log records made under a trace."""
+    trace = _current.get()
+    if trace is None:
+        return None
+    return {"trace_id": trace.trace_id, "trace_ms": round(trace.elapsed() * 1000, 1)}
+
+
+add_context_fields(_log_fields)
+
+
+def trace_delivered():
+    """
+    Record speech end → now for the current trace: speech_to_delivery the
+    first time its messages go out, speech_to_late for LLM upgrades after.
+    """
+    trace = _current.get()
+    if trace is None:
+        return
+    stage = "speech_to_late" if trace.delivered else "speech_to_delivery"
+    trace.delivered = True
+    record(stage, trace.elapsed())
+    if TRACE_LOG_UTTERANCES:
+        log.debug("%s: %s", trace.trace_id, trace.timeline())
@@ -0,0 +1,230 @@
+"""
+track_scope.py - Active track / event family scoping
+
+The current event_id arrives over MQTT on racetrack/event. This module
+resolves it against the TrackTech announcements structure (the same file
+the RAG knowledge base is built from) and exposes the candidate class set
+for the active track, narrowed to the event family when that can be
+identified.
+
+Both the RAG retrieval (rag_classifier) and the local matcher
+(classifier.find_classes) use the candidate set to restrict their search,
+which cuts prompt size and false positives from classes that never run at
+the active track.
+"""
+
+import json
+import re
+import threading
+
+from config import (
+    RAG_KNOWLEDGE_BASE_PATH, TRACK_SCOPE_ENABLED, TRACK_SCOPE_MIN_MATCH,
+    get_classmap
+)
+from log import get_logger
+
+log = get_logger("scope")
+
+# Words that appear in most track / family names and carry no identity
+_STOPWORDS = {
+    "the", "at", "of", "and", "a", "nhra", "drag", "dragstrip",
+    "dragway", "raceway", "raceways", "race", "races", "racing", "park",
+    "motorsports", "mile", "series", "event", "events",
+}
+
+# ===========================
+# Per-track sub-index
+# ===========================
+_track_index = []         # list of track entries (see _build_track_index)
+_index_loaded = False
+_active_event_id = None
+_active_scope = None      # {"track_name", "family_name", "classes"} or None
+_scope_lock = threading.RLock()
+
+
+def _tokens(s) -> set:
+    """Lowercase identity tokens of a name (no stopwords, no pure numbers)."""
+    words = re.sub(r"[^a-z0-9\s]", " ", str(s).lower()).split()
+    return {w for w in words if w not in _STOPWORDS and not w.isdigit()}
+
+
+def _build_track_index(data: dict) -> list:
+    """
+    Precompute, per track, its identity tokens and the resolved class list of
+    every event family (shared class set refs + custom classes).
+
+    Returns list of:
+      {"track_name", "keys": [token sets], "classes": set,
+       "families": [{"family_name", "keys": [token sets], "classes": set}]}
+    """
+    shared = data.get("shared_class_sets", {})
+    index = []
+
+    for track in data.get("tracks", []):
+        track_name = track.get("track_name", "Unknown Track")
+        keys = [k for k in (_tokens(track_name), _tokens(track.get("facility_name", ""))) if k]
+
+        families = []
+        track_classes = set()
+        for family in track.get("event_families", []):
+            classes = set()
+            for ref in family.get("class_set_refs", []):
+                classes.update(shared.get(ref, []))
+            classes.update(family.get("custom_classes", []))
+            track_classes |= classes
+
+            # Family keys exclude the track's own name ("DENSO NHRA Sonoma Nationals")
+            names = [family.get("family_name", "")] + family.get("event_examples", [])
+            families.append({
+                "family_name": family.get("family_name", "Unknown Family"),
+                "keys": [k for k in (_tokens(n).difference(*keys) for n in names) if k],
+                "classes": classes,
+            })
+
+        index.append({
+            "track_name": track_name,
+            "keys": keys,
+            "classes": track_classes,
+            "families": families,
+        })
+
+    return index
+
+
+def load_track_index(data: dict = None):
+    """
+    (Re)build the per-track sub-index. Pass the already-loaded knowledge base
+    to avoid a second read; otherwise it is loaded from RAG_KNOWLEDGE_BASE_PATH.
+    """
+    global _track_index, _index_loaded
+
+    if data is None:
+        if not RAG_KNOWLEDGE_BASE_PATH.exists():
+            log.debug("knowledge base not found: %s", RAG_KNOWLEDGE_BASE_PATH)
+            return
+        with RAG_KNOWLEDGE_BASE_PATH.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+
+    index = _build_track_index(data)
+    with _scope_lock:
+        _track_index = index
+        _index_loaded = True
+
+    log.debug("indexed %s tracks for event scoping", len(index))
+
+
+def _coverage(ev: set, key: set) -> float:
+    """Fraction of a track's identity tokens present in the event id."""
+    return len(ev & key) / len(key)
+
+
+def _jaccard(ev: set, key: set) -> float:
+    return len(ev & key) / len(ev | key)
+
+
+def resolve_event(event_id):
+    """
+    Resolve an event_id to (track_name, family_name).
+
+    Tracks are scored by how much of their name / facility name the event id
+    covers; event families by token overlap with their name and examples.
+    Either element is None when it cannot be identified unambiguously.
+    """
+    ev = _tokens(event_id or "")
+    if not ev:
+        return None, None
+
+    with _scope_lock:
+        if not _index_loaded:
+            load_track_index()
+        index = _track_index
+
+    best = []  # (score, track_score, family_score, track, family)
+    for track in index:
+        t_score = max((_coverage(ev, k) for k in track["keys"]), default=0.0)
+        # Score families on what is left once the track's own name is removed
+        rest = ev.difference(*track["keys"])
+        for family in track["families"] or [None]:
+            f_score = 0.0
+            if family is not None and rest:
+                f_score = max((_jaccard(rest, k) for k in family["keys"]), default=0.0)
+            best.append((t_score + f_score, t_score, f_score, track, family))
+
+    if not best:
+        return None, None
+
+    best.sort(key=lambda b: b[0], reverse=True)
+    top_score, t_score, f_score, track, family = best[0]
+
+    if t_score < TRACK_SCOPE_MIN_MATCH and f_score < TRACK_SCOPE_MIN_MATCH:
+        return None, None
+
+    # A tie with a different track means the event id does not pin the track down
+    for score, _, _, other, _ in best[1:]:
+        if score < top_score:
+            break
+        if other is not track:
+            log.debug("ambiguous event_id '%s': %s / %s",
+                      event_id, track['track_name'], other['track_name'])
+            return None, None
+
+    family_name = None
+    if family is not None and f_score >= TRACK_SCOPE_MIN_MATCH:
+        family_name = family["family_name"]
+
+    return track["track_name"], family_name
+
+
+def set_active_event(event_id):
+    """Resolve and activate the scope for a new event_id (None clears it)."""
+    global _active_event_id, _active_scope
+
+    track_name, family_name = resolve_event(event_id) if event_id else (None, None)
+
+    scope = None
+    if track_name is not None:
+        with _scope_lock:
+            track = next(t for t in _track_index if t["track_name"] == track_name)
+        classes = track["classes"]
+        if family_name is not None:
+            family = next(f for f in track["families"] if f["family_name"] == family_name)
+            # Families that only name a promoter have no class list of their own
+            if family["classes"]:
+                classes = family["classes"]
+        scope = {
+            "track_name": track_name,
+            "family_name": family_name,
+            "classes": frozenset(classes),
+        }
+
+    with _scope_lock:
+        _active_event_id = event_id
+        _active_scope = scope
+
+    if scope:
+        log.info("event '%s' → %s / %s (%s classes)",
+                 event_id, track_name, family_name or 'all families', len(scope['classes']))
+    else:
+        log.info("event '%s' not resolved, using all tracks", event_id)
+
+
+def get_active_scope():
+    """Return the active {"track_name", "family_name", "classes"} or None."""
+    if not TRACK_SCOPE_ENABLED:
+        return None
+    with _scope_lock:
+        return _active_scope
+
+
+def get_candidate_classes():
+    """
+    Canonical class names (from the current class map) that run in the active
+    scope, or None when no scope is active or nothing in it is in the class map.
+    """
+    scope = get_active_scope()
+    if scope is None:
+        return None
+
+    scoped = {c.lower() for c in scope["classes"]}
+    candidates = frozenset(c for c in get_classmap() if c.lower() in scoped)
+    return candidates or None
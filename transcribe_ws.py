@@ -9,15 +9,22 @@ import hashlib
 import struct
 import zlib
 import urllib.parse
+import time
 import aiohttp
-import sounddevice as sd
 import numpy as np
-import boto3
 
 from config import (
     AWS_REGION, LANGUAGE_CODE, MIC_SAMPLE_RATE, STREAM_SAMPLE_RATE, 
-    FRAME_MS, DEBUG, MIC_DEVICE_INDEX
+    FRAME_MS, MIC_DEVICE_INDEX
 )
+from tracing import record, start_trace
+from metrics import inc
+from log import get_logger
+
+log = get_logger("transcribe")
+mic_log = get_logger("mic")  # debug is per audio block; LOG_LEVELS keeps it at INFO
+
+_ws_connected_before = False  # a connect after the first one counts as a reconnect
 
 # ----------------------------
 # Fixed EventStream Marshaller for AWS Transcribe
@@ -161,11 +168,45 @@ def resample_pcm16(data, in_rate, out_rate):
     ).astype(np.int16)
     return resampled
 
+# ----------------------------
+# Audio clock: Transcribe offsets → time.monotonic()
+# ----------------------------
+class AudioClock:
+    """
+    Transcribe reports StartTime / EndTime as seconds of audio since the
+    stream began. The mic callback counts captured frames and when it saw
+    them, so an offset maps back to the monotonic time that audio was
+    captured (against the latest block, so clock drift does not accumulate).
+    """
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._ref = (0, None)   # (frames captured, monotonic time of the last block)
+
+    def advance(self, frames):
+        """Called from the mic callback for each captured block."""
+        total, _ = self._ref
+        self._ref = (total + frames, time.monotonic())
+
+    def to_monotonic(self, offset):
+        """Capture time of the audio at offset seconds, or None if unknown."""
+        total, at = self._ref
+        if at is None or offset is None:
+            return None
+        return at - (total / self._rate - offset)
+
 # ----------------------------
 # Main streaming function
 # ----------------------------
 async def stream_audio(on_transcript):
-    audio_q = asyncio.Queue()
+    global _ws_connected_before
+    # Imported here rather than at module level: sounddevice loads PortAudio
+    # and boto3 is ~100 ms of imports, neither needed until the stream starts
+    import sounddevice as sd
+    import boto3
+
+    audio_q = asyncio.Queue()   # (PCM16 bytes, monotonic capture time), None to stop
+    audio_clock = AudioClock(MIC_SAMPLE_RATE)
     
     # Selection logic for microphone
     target_mic = MIC_DEVICE_INDEX
@@ -178,8 +219,7 @@ async def stream_audio(on_transcript):
         for i, dev in enumerate(devices):
             if dev['max_input_channels'] > 0:
                 target_mic = i
-                if DEBUG:
-                    print(f"[mic] auto-detected input device: {i} ({dev['name']})")
+                mic_log.info("auto-detected input device: %s (%s)", i, dev['name'])
                 break
     
     if target_mic is None:
@@ -189,8 +229,7 @@ async def stream_audio(on_transcript):
     try:
         dev = sd.query_devices(target_mic)
         if dev['max_input_channels'] == 0:
-            if DEBUG:
-                print(f"[mic] warning: selected device {target_mic} has 0 input channels. Falling back...")
+            mic_log.warning("selected device %s has 0 input channels, falling back", target_mic)
             # Fallback to first available
             for i, d in enumerate(devices):
                 if d['max_input_channels'] > 0:
@@ -198,8 +237,7 @@ async def stream_audio(on_transcript):
                     dev = d
                     break
     except Exception as e:
-        if DEBUG:
-             print(f"[mic] error querying device {target_mic}: {e}")
+        mic_log.error("error querying device %s: %s", target_mic, e)
         raise
 
     session = boto3.session.Session()
@@ -266,15 +304,18 @@ async def stream_audio(on_transcript):
     async def mic_sender(ws):
         try:
             while True:
-                chunk = await audio_q.get()
-                if chunk is None:
-                    if DEBUG: print("[mic_sender] shutdown")
+                item = await audio_q.get()
+                if item is None:
+                    mic_log.debug("sender shutdown")
                     break
+                chunk, captured_at = item
                 marshalled_chunk = EventStreamMarshaller.marshall_audio_event(chunk)
                 await ws.send_bytes(marshalled_chunk)
-                if DEBUG: print("[mic_sender] sent EventStream chunk len", len(marshalled_chunk))
+                record("mic_queue", time.monotonic() - captured_at)
+                inc("asr_ws_bytes_sent_total", len(marshalled_chunk))
+                mic_log.debug("sent EventStream chunk len %s", len(marshalled_chunk))
         except asyncio.CancelledError:
-            if DEBUG: print("[mic_sender] cancelled")
+            mic_log.debug("sender cancelled")
             raise
 
     # ----------------------------
@@ -282,14 +323,25 @@ async def stream_audio(on_transcript):
     # ----------------------------
     async with aiohttp.ClientSession() as session:
         async with session.ws_connect(signed_url, timeout=10) as ws:
-            if DEBUG: print("[transcribe] connected")
+            log.info("connected")
+            inc("asr_ws_connects_total")
+            if _ws_connected_before:
+                inc("asr_ws_reconnects_total")
+            _ws_connected_before = True
 
             # Capture the main loop here
             loop = asyncio.get_running_loop()
 
             def callback(indata, frames, time_info, status):
                 if status:
-                    print("[mic cb] status:", status)
+                    mic_log.warning("status: %s", status)
+                    if status.input_overflow:
+                        # One per callback flagged as overflowed; PortAudio does
+                        # not say how many input frames it dropped
+                        inc("asr_audio_overflow_events_total")
+                audio_clock.advance(frames)
+                inc("asr_audio_frames_total", frames)
+                captured_at = time.monotonic()
                 try:
                     mono = (indata[:, 0] * 32767).astype(np.int16)
                 except Exception:
@@ -301,16 +353,15 @@ async def stream_audio(on_transcript):
                 for i in range(0, len(resampled), max_chunk_size):
                     chunk = resampled[i:i+max_chunk_size]
                     chunk_bytes = chunk.tobytes()
-                    asyncio.run_coroutine_threadsafe(audio_q.put(chunk_bytes), loop)
+                    asyncio.run_coroutine_threadsafe(audio_q.put((chunk_bytes, captured_at)), loop)
 
-                if DEBUG:
-                    print("[mic cb] frames", frames, "resampled len", len(resampled))
+                mic_log.debug("frames %s resampled len %s", frames, len(resampled))
 
             sender_task = asyncio.create_task(mic_sender(ws))
 
             try:
-                if DEBUG:
-                    print("[mic] using device:", dev['name'], "index:", target_mic, "channels:", dev['max_input_channels'], "rate:", MIC_SAMPLE_RATE)
+                mic_log.info("using device: %s index: %s channels: %s rate: %s",
+                             dev['name'], target_mic, dev['max_input_channels'], MIC_SAMPLE_RATE)
 
                 with sd.InputStream(device=target_mic,
                                     samplerate=MIC_SAMPLE_RATE,
@@ -327,17 +378,23 @@ async def stream_audio(on_transcript):
                                     for r in transcript_data["Transcript"]["Results"]:
                                         if not r.get("IsPartial") and r.get("Alternatives"):
                                             text = r["Alternatives"][0]["Transcript"]
+                                            inc("asr_transcripts_total")
                                             ts = datetime.datetime.utcnow().isoformat() + "Z"
+                                            # The utterance's trace starts when the speech ended
+                                            speech_end = audio_clock.to_monotonic(r.get("EndTime"))
+                                            trace = start_trace(speech_end)
+                                            if trace is not None and speech_end is not None:
+                                                record("endpointing", trace.elapsed())
                                             await on_transcript(text, ts)
                             elif decoded['headers'].get(':message-type') == 'exception':
                                 error_data = json.loads(decoded['payload'].decode('utf-8'))
-                                if DEBUG: print("[transcribe] exception:", error_data)
+                                log.warning("exception: %s", error_data)
                                 break
                         elif msg.type == aiohttp.WSMsgType.ERROR:
-                            if DEBUG: print("[transcribe] ws error", msg)
+                            log.warning("ws error %s", msg)
                             break
                         elif msg.type == aiohttp.WSMsgType.CLOSE:
-                            if DEBUG: print("[transcribe] ws closed")
+                            log.debug("ws closed")
                             break
             finally:
                 await audio_q.put(None)
@@ -347,5 +404,5 @@ async def stream_audio(on_transcript):
                     try:
                         await sender_task
                     except asyncio.CancelledError:
-                        if DEBUG: print("[mic_sender] cancelled on shutdown")
-                if DEBUG: print("[transcribe] connection closed")
+                        mic_log.debug("sender cancelled on shutdown")
+                log.debug("connection closed")